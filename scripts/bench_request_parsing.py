@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Microbenchmark for the per request header parsing cost of the server.
+
+Times parse_request plus get_environ of the server's request handler, the
+way every request goes through them, against the code they replaced: the
+BaseHTTPRequestHandler parse_request, which builds a mimetools.Message, and
+a get_environ that split and upper-cased every header again and left the
+url to be reconstructed a second time by the namespace chooser.
+
+The old get_environ also looked up the client's host name; that lookup is
+left out, it would only measure the resolver.
+
+    python scripts/bench_request_parsing.py [iterations]
+"""
+
+import os
+import sys
+import time
+import urllib
+from urlparse import urlparse
+from cStringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from windmill.server.https import WindmillHTTPRequestHandler
+from windmill.server.wsgi import reconstruct_url
+
+REQUEST = ('GET http://tutorial.getwindmill.com/windmill-serv/js/wm/windmill.js?1234 HTTP/1.1\r\n'
+           'Host: tutorial.getwindmill.com\r\n'
+           'User-Agent: Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.10) Gecko/2009042316 Firefox/3.0.10\r\n'
+           'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+           'Accept-Language: en-us,en;q=0.5\r\n'
+           'Accept-Encoding: gzip,deflate\r\n'
+           'Accept-Charset: ISO-8859-1,utf-8;q=0.7,*;q=0.7\r\n'
+           'Keep-Alive: 300\r\n'
+           'Proxy-Connection: keep-alive\r\n'
+           'Referer: http://tutorial.getwindmill.com/windmill-serv/start.html\r\n'
+           'Cookie: sessionid=0123456789abcdef; csrftoken=fedcba9876543210\r\n'
+           'If-Modified-Since: Thu, 21 May 2009 17:48:10 GMT\r\n'
+           '\r\n')
+
+class FakeServer(object):
+    keepalive = True
+    base_environ = {'SERVER_NAME': 'localhost', 'GATEWAY_INTERFACE': 'CGI/1.1',
+                    'SERVER_PORT': '4444', 'REMOTE_HOST': '',
+                    'CONTENT_LENGTH': '', 'SCRIPT_NAME': ''}
+
+class RequestFromString:
+    """A handler reading its request from a string instead of a socket"""
+
+    def __init__(self, server, data):
+        self.server = server
+        self.client_address = ('127.0.0.1', 50000)
+        self.rfile = StringIO(data)
+        self.raw_requestline = self.rfile.readline()
+
+class OldHandler(RequestFromString, BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def get_environ(self):
+        env = self.server.base_environ.copy()
+        env['SERVER_PROTOCOL'] = self.request_version
+        env['REQUEST_METHOD'] = self.command
+        if '?' in self.path:
+            path, query = self.path.split('?', 1)
+        else:
+            path, query = self.path,''
+        env['PATH_INFO'] = urllib.unquote(path)
+        env['QUERY_STRING'] = query
+        env['REMOTE_ADDR'] = self.client_address[0]
+
+        if self.headers.typeheader is not None:
+            env['CONTENT_TYPE'] = self.headers.typeheader
+
+        length = self.headers.getheader('content-length')
+        if length:
+            env['CONTENT_LENGTH'] = length
+
+        for header in self.headers.headers:
+            key, value = header.split(':', 1)
+            key = key.replace('-', '_').upper()
+            value = value.strip()
+            if key in env:
+                continue  # skip content length, type,etc.
+            if 'HTTP_' + key in env:
+                env['HTTP_' + key] += ',' + value
+            else:
+                env['HTTP_' + key] = value
+        env['wsgi.url_scheme'] = urlparse(self.path).scheme
+
+        clen = self.headers.getheader('content-length')
+        if clen is not None and int(clen) > 0:
+            i = self.rfile.read(int(clen))
+            env['wsgi.input'] = StringIO(i)
+        else:
+            env['wsgi.input'] = self.rfile
+        self.reconstruct_url(env)
+        return env
+
+    def reconstruct_url(self, environ):
+        url = environ['wsgi.url_scheme']+'://'
+        if environ.get('HTTP_HOST'):
+            url += environ['HTTP_HOST']
+        else:
+            url += environ['SERVER_NAME']
+            if environ['wsgi.url_scheme'] == 'https':
+                if environ['SERVER_PORT'] != '443':
+                    url += ':' + environ['SERVER_PORT']
+            else:
+                if environ['SERVER_PORT'] != '80':
+                    url += ':' + environ['SERVER_PORT']
+        url += environ.get('SCRIPT_NAME','')
+        if '://' in self.path:
+            url = self.path
+        else:
+            url += self.path
+        environ['reconstructed_url'] = url
+        return url
+
+class NewHandler(RequestFromString, WindmillHTTPRequestHandler):
+    pass
+
+server = FakeServer()
+
+def old_parse(data):
+    handler = OldHandler(server, data)
+    handler.parse_request()
+    env = handler.get_environ()
+    # The namespace chooser always reconstructed it again
+    reconstruct_url(env)
+    return env
+
+def new_parse(data):
+    handler = NewHandler(server, data)
+    handler.parse_request()
+    return handler.get_environ()
+
+def bench(func, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        func(REQUEST)
+    return (time.time() - start) / iterations * 1000000
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    else:
+        iterations = 20000
+    old = bench(old_parse, iterations)
+    new = bench(new_parse, iterations)
+    print 'mimetools parser   %6.1f usec/request' % old
+    print 'single pass parser %6.1f usec/request' % new
+    print 'speedup            %6.1fx' % (old / new)
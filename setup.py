@@ -52,6 +52,9 @@ if sys.version.startswith('2.4'):
 if sys.platform == 'cygwin':
     dependencies.append('cygwinreg')
 
+# Serves mounted files with sendfile() on pythons without os.sendfile
+extra_dependencies = {'sendfile': ['pysendfile']}
+
 setup(name=PACKAGE_NAME,
       version=PACKAGE_VERSION,
       description=SUMMARY,
@@ -66,6 +69,7 @@ setup(name=PACKAGE_NAME,
                            '*.crt', '*.key', '*.csr', 'cert8.db' ],},
       platforms =['Any'],
       install_requires = dependencies,
+      extras_require = extra_dependencies,
       entry_points = {
                 'nose.plugins': [
                     'windmill = windmill.authoring.nose_plugin:WindmillNosePlugin'
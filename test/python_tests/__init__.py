@@ -2,7 +2,6 @@
 
 import windmill
 from windmill.bin import admin_lib
-from time import sleep
 
 def setup_module(module):
     """setup_module function for functest based python tests"""
@@ -21,4 +20,3 @@ def teardown_module(module):
         module.windmill_dict['xmlrpc_client'].stop_runserver() 
     else:
         admin_lib.teardown(module.windmill_dict)
-    sleep(.25)
\ No newline at end of file
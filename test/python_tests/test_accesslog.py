@@ -0,0 +1,66 @@
+import socket
+import httplib
+import xmlrpclib
+from time import sleep
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.accesslog import AccessLog
+
+
+def entry(url, status='200 OK'):
+    return (0.0, '127.0.0.1', 'GET', url, 'proxy', status, 10, 1.5, '')
+
+def test_ring_buffer():
+    log = AccessLog(size=3)
+    for i in range(5):
+        log.record(entry('/%d' % i))
+    log.record(entry('/cut', ''))
+    log.flush()
+    log.stop()
+    assert [e['url'] for e in log.recent()] == ['/3', '/4', '/cut']
+    assert [e['url'] for e in log.recent(1)] == ['/cut']
+    assert log.recent()[0]['status'] == 200
+    assert log.recent()[-1]['status'] == 0
+
+def test_served_requests_are_logged():
+    httpd = admin_lib.shell_objects_dict['httpd']
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', '/windmill-serv/start.html')
+    connection.getresponse().read()
+    connection.close()
+    # The handler records a request just after sending its response
+    for i in range(100):
+        last = httpd.recent_requests(1)
+        if last and last[0]['url'].endswith('/windmill-serv/start.html'):
+            break
+        sleep(.01)
+    last = last[0]
+    assert last['namespace'] == 'windmill-serv'
+    assert last['status'] == 200
+    assert last['method'] == 'GET'
+    assert last['bytes'] > 0
+
+    proxy = xmlrpclib.ServerProxy('http://localhost:%d/windmill-xmlrpc/' %
+                                  windmill.settings['SERVER_HTTP_PORT'])
+    entries = proxy.recent_requests(5)
+    assert 0 < len(entries) <= 5
+    assert 'duration_ms' in entries[-1]
+
+def test_errors_are_logged():
+    httpd = admin_lib.shell_objects_dict['httpd']
+    for request, code in (('POST /windmill-serv/ HTTP/1.1\r\n'
+                           'Transfer-Encoding: chunked\r\n\r\nzz\r\n', 400),
+                          ('BREW /pot HTTP/1.1\r\n\r\n', 501)):
+        s = socket.create_connection(('localhost',
+                                      windmill.settings['SERVER_HTTP_PORT']))
+        s.sendall(request)
+        assert s.recv(65536).split(' ')[1] == str(code)
+        s.close()
+        for i in range(100):
+            last = httpd.recent_requests(1)
+            if last and last[0]['status'] == code:
+                break
+            sleep(.01)
+        assert last[0]['status'] == code
+    assert last[0]['method'] == 'BREW' and last[0]['url'] == '/pot'
@@ -0,0 +1,103 @@
+import time
+import httplib
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.admission import AdmissionGate, client_key
+
+
+def test_limit_and_queue_full():
+    gate = AdmissionGate(limit=2, queue_size=0, timeout=1)
+    assert gate.enter('a')
+    assert gate.enter('a')
+    assert not gate.enter('b')
+    gate.leave()
+    assert gate.enter('b')
+    stats = gate.stats()
+    assert stats['active'] == 2
+    assert stats['admitted'] == 3
+    assert stats['rejected'] == 1
+
+def test_queue_deadline():
+    gate = AdmissionGate(limit=1, queue_size=4, timeout=.05)
+    assert gate.enter('a')
+    start = time.time()
+    assert not gate.enter('a')
+    assert time.time() - start < 1
+    stats = gate.stats()
+    assert stats['timed_out'] == 1
+    assert stats['waiting'] == 0
+    gate.leave()
+    assert gate.stats()['active'] == 0
+
+def test_clients_take_turns():
+    gate = AdmissionGate(limit=1, queue_size=10, timeout=5)
+    assert gate.enter('busy')
+    order = []
+    def request(client):
+        if gate.enter(client):
+            order.append(client)
+            gate.leave()
+    threads = []
+    for client in ['busy', 'busy', 'busy', 'other']:
+        thread = threading.Thread(target=request, args=(client,))
+        thread.start()
+        threads.append(thread)
+        while gate.stats()['waiting'] < len(threads):
+            time.sleep(.001)
+    gate.leave()
+    for thread in threads:
+        thread.join()
+    # 'other' queued last but only waits for one 'busy' request
+    assert order == ['busy', 'other', 'busy', 'busy']
+
+def test_client_key():
+    firefox = client_key('127.0.0.1', {'HTTP_USER_AGENT': 'Firefox'})
+    safari = client_key('127.0.0.1', {'HTTP_USER_AGENT': 'Safari'})
+    assert firefox != safari
+    assert firefox == client_key('127.0.0.1', {'HTTP_USER_AGENT': 'Firefox'})
+    assert firefox != client_key('10.0.0.2', {'HTTP_USER_AGENT': 'Firefox'})
+    assert client_key('127.0.0.1', {}) == ('127.0.0.1', '')
+
+class RecordingGate(AdmissionGate):
+    def __init__(self):
+        AdmissionGate.__init__(self)
+        self.clients = []
+
+    def enter(self, client):
+        self.clients.append(client)
+        return AdmissionGate.enter(self, client)
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+def test_proxied_requests_queue_per_browser():
+    upstream = HTTPServer(('127.0.0.1', 0), OkHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    httpd = admin_lib.shell_objects_dict['httpd']
+    original = httpd.proxy_gate
+    gate = httpd.proxy_gate = RecordingGate()
+    try:
+        for agent in ('Firefox', 'Safari'):
+            connection = httplib.HTTPConnection('127.0.0.1',
+                                    windmill.settings['SERVER_HTTP_PORT'])
+            connection.request('GET', 'http://127.0.0.1:%d/' %
+                               upstream.server_port,
+                               headers={'User-Agent': agent})
+            assert connection.getresponse().read() == 'ok'
+            connection.close()
+    finally:
+        httpd.proxy_gate = original
+        upstream.shutdown()
+    assert gate.clients == [('127.0.0.1', 'Firefox'), ('127.0.0.1', 'Safari')]
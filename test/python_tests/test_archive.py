@@ -0,0 +1,108 @@
+import httplib
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.archive import ProxyArchive
+
+
+# Every byte value, as in an image or a gzipped page
+binary = ''.join([chr(i) for i in range(256)])
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        body = '%s, answer %d' % (self.path, len(self.requests))
+        content_type = 'text/plain'
+        if self.path == '/binary':
+            body = binary
+            content_type = 'image/png'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Set-Cookie', 'session=%d' % len(self.requests))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+def setup_module(module):
+    module.proxy = admin_lib.shell_objects_dict['httpd'].proxy
+    module.directory = tempfile.mkdtemp()
+    module.upstream = HTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def teardown_module(module):
+    proxy.archive = None
+    upstream.shutdown()
+    upstream.server_close()
+    shutil.rmtree(directory)
+
+def fetch(path, body=None):
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    url = 'http://127.0.0.1:%d%s' % (upstream.server_port, path)
+    if body is None:
+        connection.request('GET', url)
+    else:
+        connection.request('POST', url, body,
+                           {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_key():
+    archive = ProxyArchive(directory, 'replay', ignore_params=['_'])
+    assert archive.key('GET', 'http://host/a?b=1&a=2&_=123') == \
+           archive.key('GET', 'http://host/a?a=2&b=1&_=456#top')
+    assert archive.key('GET', 'http://host/a?a=1') != \
+           archive.key('GET', 'http://host/a?a=2')
+    form = 'application/x-www-form-urlencoded'
+    assert archive.key('POST', 'http://host/a', form, 'x=1&_=1') == \
+           archive.key('POST', 'http://host/a', form, '_=2&x=1')
+    archive = ProxyArchive(directory, 'replay', match_query=False,
+                           match_body=False)
+    assert archive.key('POST', 'http://host/a?a=1', form, 'x=1') == \
+           archive.key('POST', 'http://host/a?a=2', form, 'x=2')
+
+def test_record_then_replay():
+    proxy.archive = ProxyArchive(directory, 'record', ignore_params=['_'])
+    recorded = [fetch('/page?_=1')[1], fetch('/page?_=2')[1],
+                fetch('/form', 'x=1')[1]]
+    assert len(UpstreamHandler.requests) == 3
+    assert proxy.archive.stats()['recorded'] == 3
+
+    proxy.archive = ProxyArchive(directory, 'replay', ignore_params=['_'])
+    response, body = fetch('/page?_=3')
+    assert body == recorded[0]
+    assert response.getheader('set-cookie') == 'session=1'
+    # Replayed in order, then the last answer again
+    assert fetch('/page?_=4')[1] == recorded[1]
+    assert fetch('/page?_=5')[1] == recorded[1]
+    assert fetch('/form', 'x=1')[1] == recorded[2]
+    assert fetch('/form', 'x=2')[0].status == 404
+    assert len(UpstreamHandler.requests) == 3
+    stats = proxy.archive.stats()
+    assert stats['replayed'] == 4 and stats['missed'] == 1
+
+def test_replay_binary_body():
+    proxy.archive = ProxyArchive(directory, 'record')
+    response, body = fetch('/binary')
+    assert body == binary
+    requests = len(UpstreamHandler.requests)
+
+    proxy.archive = ProxyArchive(directory, 'replay')
+    response, body = fetch('/binary')
+    assert response.status == 200
+    assert response.getheader('content-type') == 'image/png'
+    assert body == binary
+    assert len(UpstreamHandler.requests) == requests
@@ -0,0 +1,53 @@
+import httplib
+import socket
+from time import sleep
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.breaker import HostBreaker
+
+
+def test_open_then_half_open():
+    breaker = HostBreaker(threshold=2, cooldown=.1)
+    key = ('http', 'down.example.com')
+    breaker.failure(key)
+    assert breaker.allow(key)
+    breaker.failure(key)
+    assert not breaker.allow(key)
+    assert breaker.allow(('http', 'up.example.com'))
+    assert breaker.stats()['open'] == ['http://down.example.com']
+
+    sleep(.1)
+    # A single request finds out if it's back
+    assert breaker.allow(key)
+    assert not breaker.allow(key)
+    breaker.failure(key)
+    assert not breaker.allow(key)
+    sleep(.1)
+    assert breaker.allow(key)
+    breaker.success(key)
+    assert breaker.allow(key) and breaker.allow(key)
+    stats = breaker.stats()
+    assert stats['open'] == [] and stats['opened'] == 1
+    assert stats['short_circuited'] == 3
+
+def test_dead_host_fails_right_away():
+    # A port nothing listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    statuses = []
+    for i in range(3):
+        connection = httplib.HTTPConnection('localhost',
+                                            windmill.settings['SERVER_HTTP_PORT'])
+        connection.request('GET', 'http://127.0.0.1:%d/' % port)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        statuses.append(response.status)
+    assert statuses == [501, 501, 502]
+    assert response.getheader('retry-after')
+    stats = admin_lib.shell_objects_dict['httpd'].server_stats()['upstream_hosts']
+    assert 'http://127.0.0.1:%d' % port in stats['open']
@@ -0,0 +1,66 @@
+import gzip
+import httplib
+from cStringIO import StringIO
+
+import windmill
+from windmill.server.compression import accepts_gzip, vary_on_encoding, \
+    GzipApplication
+
+
+def test_accepts_gzip():
+    assert accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip,deflate'})
+    assert accepts_gzip({'HTTP_ACCEPT_ENCODING': 'deflate, gzip;q=0.5'})
+    assert not accepts_gzip({'HTTP_ACCEPT_ENCODING': 'gzip;q=0'})
+    assert not accepts_gzip({'HTTP_ACCEPT_ENCODING': 'identity'})
+    assert not accepts_gzip({})
+
+def test_vary_on_encoding():
+    assert vary_on_encoding([('Content-Type', 'text/html')]) == \
+        [('Content-Type', 'text/html'), ('Vary', 'Accept-Encoding')]
+    assert vary_on_encoding([('Vary', 'Cookie')]) == \
+        [('Vary', 'Cookie, Accept-Encoding')]
+    assert vary_on_encoding([('vary', 'accept-encoding')]) == \
+        [('Vary', 'accept-encoding')]
+
+def call(application, environ):
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, dict(headers)]
+    body = ''.join(application(dict({'PATH_INFO': '/'}, **environ),
+                               start_response))
+    return response[0], response[1], body
+
+def test_both_variants_vary():
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', environ['type']),
+                                  ('Vary', 'Cookie')])
+        return ['x' * int(environ['size'])]
+    gzipped = GzipApplication(application, min_size=100)
+    for size in ('10', '1000'):
+        for encoding in ('gzip', 'identity'):
+            status, headers, body = call(gzipped, {'type': 'text/html',
+                'size': size, 'HTTP_ACCEPT_ENCODING': encoding})
+            assert headers['Vary'] == 'Cookie, Accept-Encoding'
+            status, headers, body = call(gzipped, {'type': 'image/png',
+                'size': size, 'HTTP_ACCEPT_ENCODING': encoding})
+            assert headers['Vary'] == 'Cookie'
+
+def fetch(path, headers):
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', path, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_static_files_are_gzipped():
+    plain_response, plain = fetch('/windmill-serv/start.html', {})
+    assert plain_response.getheader('content-encoding') is None
+    assert plain_response.getheader('vary') == 'Accept-Encoding'
+    for i in range(2):
+        response, body = fetch('/windmill-serv/start.html',
+                               {'Accept-Encoding': 'gzip'})
+        assert response.getheader('content-encoding') == 'gzip'
+        assert response.getheader('vary') == 'Accept-Encoding'
+        assert len(body) == int(response.getheader('content-length'))
+        assert gzip.GzipFile(fileobj=StringIO(body)).read() == plain
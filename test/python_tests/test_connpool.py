@@ -0,0 +1,60 @@
+import socket
+import time
+
+from windmill.server.connpool import ConnectionPool
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def test_reuse():
+    pool = ConnectionPool(max_per_host=2)
+    key = ('http', 'example.com')
+    first = pool.checkout(key, FakeConnection)
+    assert not first.reused
+    pool.checkin(key, first)
+    again = pool.checkout(key, FakeConnection)
+    assert again is first and again.reused
+    pool.checkin(key, again, reusable=False)
+    assert first.sock is None
+    stats = pool.stats()
+    assert stats['checkouts'] == 2
+    assert stats['reused'] == 1
+    assert stats['reuse_ratio'] == .5
+    assert stats['idle'] == 0 and stats['busy'] == 0
+
+def test_closed_by_server_is_not_reused():
+    pool = ConnectionPool()
+    key = ('http', 'example.com')
+    connection = pool.checkout(key, FakeConnection)
+    pool.checkin(key, connection)
+    connection.peer.close()
+    fresh = pool.checkout(key, FakeConnection)
+    assert fresh is not connection and not fresh.reused
+    assert pool.stats()['stale'] == 1
+
+def test_idle_timeout():
+    pool = ConnectionPool(idle_timeout=0)
+    key = ('http', 'example.com')
+    connection = pool.checkout(key, FakeConnection)
+    pool.checkin(key, connection)
+    assert pool.checkout(key, FakeConnection) is not connection
+
+def test_host_limit_waits_then_overflows():
+    pool = ConnectionPool(max_per_host=1, wait_timeout=.05)
+    key = ('http', 'example.com')
+    pool.checkout(key, FakeConnection)
+    start = time.time()
+    extra = pool.checkout(key, FakeConnection)
+    assert time.time() - start >= .05
+    assert not extra.reused
+    other = pool.checkout(('https', 'example.com'), FakeConnection)
+    stats = pool.stats()
+    assert stats['waits'] == 1 and stats['overflow'] == 1
+    assert stats['busy'] == 3 and stats['hosts'] == 2
@@ -0,0 +1,78 @@
+import httplib
+import socket
+import threading
+from time import sleep
+
+from windmill.server import wsgi
+
+
+def setup_module(module):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    module.port = s.getsockname()[1]
+    s.close()
+    add_namespace = wsgi.add_namespace
+    module.httpd = wsgi.make_windmill_server(http_port=module.port,
+                                             engine='evented')
+    wsgi.add_namespace = add_namespace
+    thread = threading.Thread(target=module.httpd.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not module.httpd.ready:
+        sleep(.05)
+
+def teardown_module(module):
+    module.httpd.stop()
+
+def test_keepalive_connection_returns_to_loop():
+    connection = httplib.HTTPConnection('localhost', port)
+    for i in range(3):
+        connection.request('GET', '/windmill-serv/start.html')
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200
+        assert not response.will_close
+    sleep(.2)
+    assert httpd.connection_stats()['idle'] >= 1
+    connection.close()
+
+def test_idle_connections_do_not_hold_workers():
+    sockets = []
+    for i in range(50):
+        sockets.append(socket.create_connection(('localhost', port)))
+    sleep(.5)
+    assert httpd.connection_stats()['idle'] >= 50
+    assert httpd.worker_stats()['busy'] == 0
+    for s in sockets:
+        s.close()
+
+def test_pipelined_requests():
+    s = socket.create_connection(('localhost', port))
+    s.sendall('GET /windmill-serv/start.html HTTP/1.1\r\nHost: localhost\r\n\r\n' * 2 +
+              'GET /windmill-serv/start.html HTTP/1.1\r\nHost: localhost\r\n'
+              'Connection: close\r\n\r\n')
+    data = ''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    assert data.count('HTTP/1.1 200 OK') == 3
+
+def test_added_listener_keeps_connections_alive():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    httpd.add_listener(listener)
+    connection = httplib.HTTPConnection('127.0.0.1', listener.getsockname()[1])
+    connection.connect()
+    sock = connection.sock
+    for i in range(3):
+        connection.request('GET', '/windmill-serv/start.html')
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200
+        assert not response.will_close
+        assert connection.sock is sock
+    connection.close()
@@ -0,0 +1,174 @@
+import os
+import shutil
+import httplib
+import logging
+import tempfile
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server import fileserver
+
+
+def setup_module(module):
+    module.directory = tempfile.mkdtemp()
+    module.data = os.urandom(300000)
+    f = open(os.path.join(directory, 'fixture.png'), 'wb')
+    f.write(data)
+    f.close()
+    module.httpd = admin_lib.shell_objects_dict['httpd']
+    httpd.add_namespace('windmill-test-files', fileserver.FileServerApplication(
+                        root_path=directory, mount_point='/windmill-test-files/'))
+
+def teardown_module(module):
+    del httpd.namespaces['windmill-test-files']
+    shutil.rmtree(directory)
+
+def fetch():
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', '/windmill-test-files/fixture.png')
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_file_wrapper_without_sendfile():
+    original = fileserver.sendfile
+    fileserver.sendfile = None
+    try:
+        response, body = fetch()
+    finally:
+        fileserver.sendfile = original
+    assert response.status == 200
+    assert body == data
+
+def test_sendfile_fast_path():
+    calls = []
+    def fake_sendfile(out_fd, in_fd, offset, count):
+        calls.append(count)
+        os.lseek(in_fd, offset, 0)
+        return os.write(out_fd, os.read(in_fd, min(count, 65536)))
+    original = fileserver.sendfile
+    fileserver.sendfile = fake_sendfile
+    try:
+        response, body = fetch()
+    finally:
+        fileserver.sendfile = original
+    assert body == data
+    assert int(response.getheader('content-length')) == len(data)
+    assert calls and calls[0] == len(data)
+
+def test_sendfile():
+    if fileserver.sendfile is None:
+        # pysendfile isn't installed
+        return
+    calls = []
+    def counting_sendfile(out_fd, in_fd, offset, count):
+        calls.append(count)
+        return original(out_fd, in_fd, offset, count)
+    original = fileserver.sendfile
+    fileserver.sendfile = counting_sendfile
+    try:
+        response, body = fetch()
+    finally:
+        fileserver.sendfile = original
+    assert body == data
+    assert calls and calls[0] == len(data)
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def test_missing_sendfile_is_logged_once():
+    original = fileserver.sendfile, fileserver.missing_sendfile_logged
+    fileserver.sendfile = None
+    fileserver.missing_sendfile_logged = False
+    handler = Records()
+    fileserver.logger.addHandler(handler)
+    level = fileserver.logger.level
+    fileserver.logger.setLevel(logging.INFO)
+    try:
+        for i in range(2):
+            assert fetch()[1] == data
+    finally:
+        fileserver.sendfile, fileserver.missing_sendfile_logged = original
+        fileserver.logger.removeHandler(handler)
+        fileserver.logger.setLevel(level)
+    assert len(handler.records) == 1
+    assert 'pysendfile' in handler.records[0].getMessage()
+
+def test_etag_revalidation():
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', '/windmill-serv/start.html')
+    response = connection.getresponse()
+    response.read()
+    etag = response.getheader('etag')
+    assert etag
+
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'If-None-Match': etag})
+    response = connection.getresponse()
+    assert response.status == 304
+    assert response.read() == ''
+    assert response.getheader('content-length') is None
+
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'If-None-Match': '"stale"'})
+    response = connection.getresponse()
+    assert response.status == 200
+    assert response.read()
+    connection.close()
+
+def test_gzip_variant_has_its_own_etag():
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'Accept-Encoding': 'gzip'})
+    response = connection.getresponse()
+    response.read()
+    etag = response.getheader('etag')
+    assert etag.endswith('-gzip"')
+
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 304
+    assert response.getheader('etag') == etag
+    connection.close()
+
+class TestStaticCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_changed_files_are_reloaded(self):
+        cache = fileserver.StaticCache()
+        path = self.write('a.js', 'one')
+        entry = cache.put(path, os.stat(path), 'one')
+        assert cache.get(path, os.stat(path)) is entry
+        self.write('a.js', 'three')
+        assert cache.get(path, os.stat(path)) is None
+
+    def test_least_recently_used_files_are_evicted(self):
+        cache = fileserver.StaticCache(budget=25)
+        paths = [self.write('%d.js' % i, 'x' * 10) for i in range(3)]
+        cache.put(paths[0], os.stat(paths[0]), 'x' * 10)
+        cache.put(paths[1], os.stat(paths[1]), 'x' * 10)
+        cache.get(paths[0], os.stat(paths[0]))
+        cache.put(paths[2], os.stat(paths[2]), 'x' * 10)
+        assert cache.get(paths[0], os.stat(paths[0])) is not None
+        assert cache.get(paths[1], os.stat(paths[1])) is None
+        assert cache.stats()['bytes'] == 20
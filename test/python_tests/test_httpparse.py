@@ -0,0 +1,72 @@
+from StringIO import StringIO
+
+from windmill.server import httpparse
+
+
+def test_parse_request_line():
+    command, path, version, number = httpparse.parse_request_line(
+                               'GET http://example.com/a?b=c HTTP/1.1')
+    assert (command, path, version, number) == \
+           ('GET', 'http://example.com/a?b=c', 'HTTP/1.1', (1, 1))
+
+def test_bad_request_version():
+    try:
+        httpparse.parse_request_line('GET / FTP/1.0')
+    except httpparse.RequestError, e:
+        assert e.code == 400
+    else:
+        assert False, 'RequestError not raised'
+
+def test_headers_build_environ_keys():
+    rfile = StringIO('Host: example.com\r\n'
+                     'Content-Type: text/plain\r\n'
+                     'Content-Length: 12\r\n'
+                     'Accept-Encoding: gzip\r\n'
+                     'Cookie: a=1\r\n'
+                     'Cookie: b=2\r\n'
+                     'X-Folded: one\r\n'
+                     '  two\r\n'
+                     '\r\n'
+                     'body')
+    headers = httpparse.read_headers(rfile)
+
+    assert headers.environ['HTTP_HOST'] == 'example.com'
+    assert headers.environ['CONTENT_TYPE'] == 'text/plain'
+    assert headers.environ['CONTENT_LENGTH'] == '12'
+    assert 'HTTP_CONTENT_LENGTH' not in headers.environ
+    assert headers.environ['HTTP_ACCEPT_ENCODING'] == 'gzip'
+    assert headers.environ['HTTP_COOKIE'] == 'a=1,b=2'
+    assert headers.environ['HTTP_X_FOLDED'] == 'one two'
+    assert headers.get('content-type') == headers.typeheader == 'text/plain'
+    assert rfile.read() == 'body'
+
+def test_bounded_input_stops_at_length():
+    body = httpparse.BoundedInput(StringIO('line one\nline two\nGET / HTTP/1.1'), 18)
+    assert body.readline() == 'line one\n'
+    assert body.read() == 'line two\n'
+    assert body.read() == ''
+    assert body.remaining == 0
+
+def test_bounded_input_drain():
+    rfile = StringIO('0123456789next')
+    assert httpparse.BoundedInput(rfile, 10).drain(16)
+    assert rfile.read() == 'next'
+    assert not httpparse.BoundedInput(StringIO('0123456789'), 10).drain(4)
+
+def test_read_chunked():
+    rfile = StringIO('5;name=value\r\nhello\r\n6\r\n world\r\n0\r\n'
+                     'Trailer: x\r\n\r\nnext request')
+    body, length = httpparse.read_chunked(rfile, 1024)
+    assert (body.read(), length) == ('hello world', 11)
+    assert rfile.read() == 'next request'
+    body, length = httpparse.read_chunked(StringIO('400\r\n' + 'x' * 1024 +
+                                                   '\r\n0\r\n\r\n'), 100, 100)
+    assert not hasattr(body, 'getvalue')
+    assert body.read() == 'x' * 1024
+    for bad in ('zz\r\nhello\r\n0\r\n\r\n', '5\r\nhel', '5\r\nhelloXX0\r\n\r\n'):
+        try:
+            httpparse.read_chunked(StringIO(bad), 1024)
+        except httpparse.RequestError, e:
+            assert e.code == 400
+        else:
+            assert False, 'RequestError not raised for %r' % bad
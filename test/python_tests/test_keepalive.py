@@ -0,0 +1,136 @@
+import httplib
+import socket
+import threading
+import time
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server import wsgi
+
+
+def get_connection():
+    return httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+
+def test_connection_is_reused_between_requests():
+    connection = get_connection()
+    connection.request('GET', '/windmill-serv/start.html')
+    response = connection.getresponse()
+    body = response.read()
+    assert response.status == 200
+    assert len(body) == int(response.getheader('content-length'))
+    assert not response.will_close
+    sock = connection.sock
+
+    connection.request('GET', '/windmill-serv/start.html')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 200
+    assert connection.sock is sock
+    connection.close()
+
+def test_connection_close_is_honoured():
+    connection = get_connection()
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'Connection': 'close'})
+    response = connection.getresponse()
+    response.read()
+    assert response.getheader('connection') == 'close'
+    assert response.will_close
+    connection.close()
+
+def test_http_10_keepalive():
+    connection = get_connection()
+    connection._http_vsn, connection._http_vsn_str = 10, 'HTTP/1.0'
+    connection.request('GET', '/windmill-serv/start.html',
+                       headers={'Connection': 'keep-alive'})
+    response = connection.getresponse()
+    response.read()
+    assert response.getheader('connection') == 'keep-alive'
+    connection.close()
+
+def streamed_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    for i in range(100):
+        yield 'line %d\n' % i
+
+def test_streamed_response_is_chunked():
+    httpd = admin_lib.shell_objects_dict['httpd']
+    httpd.add_namespace('windmill-test-stream', streamed_app)
+    try:
+        connection = get_connection()
+        for i in range(2):
+            connection.request('GET', '/windmill-test-stream/')
+            response = connection.getresponse()
+            body = response.read()
+            assert response.getheader('transfer-encoding') == 'chunked'
+            assert body == ''.join(['line %d\n' % i for i in range(100)])
+            assert not response.will_close
+        connection.close()
+
+        # HTTP/1.0 can't do chunked, the connection is closed instead
+        connection = get_connection()
+        connection._http_vsn, connection._http_vsn_str = 10, 'HTTP/1.0'
+        connection.request('GET', '/windmill-test-stream/')
+        response = connection.getresponse()
+        assert response.getheader('transfer-encoding') is None
+        assert response.read().startswith('line 0\n')
+        assert response.will_close
+        connection.close()
+    finally:
+        del httpd.namespaces['windmill-test-stream']
+
+def test_error_after_a_response_on_the_same_connection():
+    connection = get_connection()
+    connection.request('GET', '/windmill-serv/start.html')
+    connection.getresponse().read()
+    connection.request('PUT', '/windmill-serv/start.html', 'data')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 501
+    assert response.version == 11
+    connection.close()
+
+def start_small_server(workers):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    saved = dict([(key, windmill.settings[key]) for key in
+                  ('SERVER_MAX_WORKERS', 'SERVER_MIN_WORKERS')])
+    windmill.settings['SERVER_MAX_WORKERS'] = workers
+    windmill.settings['SERVER_MIN_WORKERS'] = workers
+    add_namespace = wsgi.add_namespace
+    try:
+        httpd = wsgi.make_windmill_server(http_port=port,
+                                          compression_enabled=False)
+    finally:
+        windmill.settings.update(saved)
+        wsgi.add_namespace = add_namespace
+    thread = threading.Thread(target=httpd.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not httpd.ready:
+        time.sleep(.05)
+    return httpd, port
+
+def test_idle_connections_give_up_their_workers():
+    httpd, port = start_small_server(2)
+    try:
+        start = time.time()
+        idle = []
+        for i in range(3):
+            connection = httplib.HTTPConnection('localhost', port)
+            connection.request('GET', '/windmill-serv/start.html')
+            connection.getresponse().read()
+            idle.append(connection)
+        # Every worker was waiting on an idle connection, the third
+        # connection only got served once one of them let go
+        connection = httplib.HTTPConnection('localhost', port)
+        connection.request('GET', '/windmill-serv/start.html')
+        assert connection.getresponse().read()
+        assert time.time() - start < 2
+        connection.close()
+        for connection in idle:
+            connection.close()
+    finally:
+        httpd.stop(timeout=1)
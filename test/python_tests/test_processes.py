@@ -0,0 +1,157 @@
+import os
+import httplib
+import socket
+import threading
+from time import sleep
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.server import wsgi
+from windmill.server import processes
+from windmill.server.timing import simplejson
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+class SiteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+def start_site(address, path, body):
+    site = HTTPServer((address, 0), SiteHandler)
+    site.path = path
+    site.body = body
+    thread = threading.Thread(target=site.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return site
+
+def setup_module(module):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    module.port = s.getsockname()[1]
+    s.close()
+    add_namespace = wsgi.add_namespace
+    module.httpd = wsgi.make_windmill_server(http_port=module.port, processes=3)
+    wsgi.add_namespace = add_namespace
+    thread = threading.Thread(target=module.httpd.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not module.httpd.ready:
+        sleep(.05)
+
+def teardown_module(module):
+    module.httpd.stop()
+
+def fetch(path, with_response=False):
+    connection = httplib.HTTPConnection('localhost', port)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    if with_response:
+        return response
+    return response.status, body
+
+def test_workers_are_running():
+    if not processes.can_fork_workers():
+        return
+    assert len(httpd.workers.pids) == 2
+    for i in range(20):
+        assert fetch('/windmill-serv/start.html')[0] == 200
+
+def test_namespaces_added_later_are_served_by_the_parent():
+    httpd.add_namespace('windmill-pid', pid_app)
+    sleep(.1)
+    for i in range(20):
+        assert fetch('/windmill-pid/') == (200, str(os.getpid()))
+
+def test_test_url_applies_to_every_process():
+    if not processes.can_fork_workers():
+        return
+    test_url = windmill.settings['FORWARDING_TEST_URL']
+    httpd.jsonrpc_methods_instance.set_test_url('http://test.example')
+    sleep(.1)
+    try:
+        for i in range(20):
+            response = fetch('http://other.example/page', True)
+            assert response.status == 302
+            assert response.getheader('location') == 'http://test.example/page'
+    finally:
+        httpd.jsonrpc_methods_instance.set_test_url(test_url)
+
+def test_forwarding_state_is_shared():
+    if not processes.can_fork_workers():
+        return
+    # The proxy doesn't forward localhost or 127.0.0.1
+    test_site = start_site('127.0.0.2', '/', 'test site')
+    other_site = start_site('127.0.0.3', '/data', 'other site')
+    test_url = windmill.settings['FORWARDING_TEST_URL']
+    before = simplejson.loads(fetch('/windmill-stats/')[1])['processes']
+    httpd.jsonrpc_methods_instance.set_test_url('http://127.0.0.2:%d/' %
+                                                test_site.server_port)
+    sleep(.1)
+    try:
+        response = fetch('http://127.0.0.3:%d/data' % other_site.server_port, True)
+        assert response.status == 302
+        location = response.getheader('location')
+        assert location == 'http://127.0.0.2:%d/data' % test_site.server_port
+        # Whichever process the browser comes back to knows where it
+        # was forwarded from
+        for i in range(20):
+            assert fetch(location) == (200, 'other site')
+        after = simplejson.loads(fetch('/windmill-stats/')[1])['processes']
+        # The workers proxied themselves
+        proxied = 0
+        for pid in after:
+            proxied += after[pid]['upstream_pool']['checkouts'] - \
+                       before[pid]['upstream_pool']['checkouts']
+        assert proxied > 0
+    finally:
+        httpd.jsonrpc_methods_instance.set_test_url(test_url)
+        for site in (test_site, other_site):
+            site.shutdown()
+            site.server_close()
+
+def test_stats_include_the_workers():
+    if not processes.can_fork_workers():
+        return
+    for i in range(20):
+        fetch('/windmill-serv/start.html')
+    stats = simplejson.loads(fetch('/windmill-stats/')[1])
+    pids = stats['processes'].keys()
+    pids.sort()
+    expected = [str(pid) for pid in httpd.workers.pids]
+    expected.sort()
+    assert pids == expected
+    served = stats['routes']['hits'].get('windmill-serv', 0)
+    for pid in pids:
+        served += stats['processes'][pid]['routes']['hits'].get('windmill-serv', 0)
+    assert served >= 20
+
+def test_workers_exit_on_stop():
+    if not processes.can_fork_workers():
+        return
+    pids = list(httpd.workers.pids)
+    workers = httpd.workers
+    httpd.workers = None
+    workers.stop()
+    assert workers.join(5) == []
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            pass
+        else:
+            assert False, 'worker %d still running' % pid
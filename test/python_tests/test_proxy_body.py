@@ -0,0 +1,63 @@
+import socket
+import threading
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.server import proxy
+
+
+def environ_for(body):
+    return {'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body)}
+
+def test_small_body_is_read_in_memory():
+    body = proxy.read_request_body(environ_for('a=1&b=2'), 1024)
+    assert body == 'a=1&b=2'
+
+def test_large_body_is_spooled():
+    data = 'x' * 5000
+    body = proxy.read_request_body(environ_for(data), 1024, blocksize=1000)
+    assert not isinstance(body, str)
+    assert body.read() == data
+    body.close()
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_chunked_body_is_proxied():
+    upstream = HTTPServer(('127.0.0.1', 0), EchoHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        s = socket.create_connection(('127.0.0.1',
+                                      windmill.settings['SERVER_HTTP_PORT']), 5)
+        request = ('POST http://127.0.0.1:%d/echo HTTP/1.1\r\n'
+                   'Host: 127.0.0.1:%d\r\nTransfer-Encoding: chunked\r\n' %
+                   (upstream.server_port, upstream.server_port))
+        # The connection stays usable after a chunked body
+        s.sendall(request + '\r\n6\r\nchunk \r\n0\r\n\r\n' +
+                  request + 'Connection: close\r\n\r\n'
+                  '6\r\nchunk \r\n4\r\nbody\r\n0\r\n\r\n')
+        data = ''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        s.close()
+        assert data.startswith('HTTP/1.1 200 ')
+        assert data.count('HTTP/1.1 200 ') == 2
+        assert '\r\n\r\nchunk HTTP/1.1 200 ' in data
+        assert data.endswith('\r\n\r\nchunk body')
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
@@ -0,0 +1,151 @@
+import httplib
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.proxycache import ProxyCache
+
+
+# Every byte value, as in an image or a gzipped page
+binary = ''.join([chr(i) for i in range(256)])
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    requests = []
+    # Current version of /etag
+    version = 1
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        etag = '"v%d"' % self.version
+        if self.path == '/etag' and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = 'body of %s' % self.path
+        headers = {'/fresh': [('Cache-Control', 'max-age=3600')],
+                   '/etag': [('ETag', etag)],
+                   '/vary': [('Cache-Control', 'max-age=3600'),
+                             ('Vary', 'Accept-Language')],
+                   '/cookie': [('Cache-Control', 'max-age=3600'),
+                               ('Set-Cookie', 'session=1')],
+                   '/binary': [('Cache-Control', 'max-age=3600'),
+                               ('Content-Type', 'image/png')]}[self.path]
+        if self.path == '/binary':
+            body = binary
+        if self.path == '/vary':
+            body += ' in %s' % self.headers.get('Accept-Language')
+        if self.path == '/etag' and self.version > 1:
+            body += ' v%d' % self.version
+            headers.append(('Cache-Control', 'max-age=3600'))
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def setup_module(module):
+    module.proxy = admin_lib.shell_objects_dict['httpd'].proxy
+    module.directory = tempfile.mkdtemp()
+    module.upstream = HTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def teardown_module(module):
+    proxy.cache = None
+    upstream.shutdown()
+    upstream.server_close()
+    shutil.rmtree(directory)
+
+def setup():
+    proxy.cache = ProxyCache(directory)
+    proxy.cache.clear()
+    del UpstreamHandler.requests[:]
+    UpstreamHandler.version = 1
+
+def url(path):
+    return 'http://127.0.0.1:%d%s' % (upstream.server_port, path)
+
+def fetch(path, headers={}):
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', url(path), headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_fresh_response_is_served_from_disk():
+    for i in range(3):
+        response, body = fetch('/fresh')
+        assert body == 'body of /fresh'
+        # The browser still doesn't cache it
+        assert 'no-store' in response.getheader('cache-control')
+    assert UpstreamHandler.requests == [('/fresh', None)]
+    stats = proxy.cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 1 and stats['stored'] == 1
+    assert stats['hit_ratio'] == 2 / 3.0
+
+    # Kept across runs
+    cache = ProxyCache(directory)
+    assert cache.lookup(url('/fresh'), {}) is not None
+test_fresh_response_is_served_from_disk.setup = setup
+
+def test_binary_response_is_served_after_a_restart():
+    assert fetch('/binary')[1] == binary
+    # A new run, the metadata comes from disk
+    proxy.cache = ProxyCache(directory)
+    response, body = fetch('/binary')
+    assert response.status == 200
+    assert response.getheader('content-type') == 'image/png'
+    assert body == binary
+    assert UpstreamHandler.requests == [('/binary', None)]
+    assert proxy.cache.stats()['hits'] == 1
+test_binary_response_is_served_after_a_restart.setup = setup
+
+def test_revalidation():
+    for i in range(2):
+        response, body = fetch('/etag')
+        assert response.status == 200
+        assert body == 'body of /etag'
+    assert UpstreamHandler.requests == [('/etag', None), ('/etag', '"v1"')]
+    assert proxy.cache.stats()['revalidated'] == 1
+test_revalidation.setup = setup
+
+def test_changed_response_replaces_the_stored_one():
+    fetch('/etag')
+    UpstreamHandler.version = 2
+    response, body = fetch('/etag')
+    assert response.status == 200
+    assert response.getheader('etag') == '"v2"'
+    assert body == 'body of /etag v2'
+    # The new version is fresh for an hour
+    assert fetch('/etag')[1] == 'body of /etag v2'
+    assert UpstreamHandler.requests == [('/etag', None), ('/etag', '"v1"')]
+    stats = proxy.cache.stats()
+    assert stats['stored'] == 2 and stats['hits'] == 1
+test_changed_response_replaces_the_stored_one.setup = setup
+
+def test_vary():
+    assert fetch('/vary', {'Accept-Language': 'fr'})[1] == 'body of /vary in fr'
+    assert fetch('/vary', {'Accept-Language': 'de'})[1] == 'body of /vary in de'
+    assert fetch('/vary', {'Accept-Language': 'fr'})[1] == 'body of /vary in fr'
+    assert len(UpstreamHandler.requests) == 2
+test_vary.setup = setup
+
+def test_not_stored():
+    fetch('/cookie')
+    fetch('/cookie')
+    # Requests asking for something else than the stored response bypass it
+    fetch('/fresh', {'Range': 'bytes=0-3'})
+    assert len(UpstreamHandler.requests) == 3
+    stats = proxy.cache.stats()
+    assert stats['stored'] == 0 and stats['bypassed'] == 1
+test_not_stored.setup = setup
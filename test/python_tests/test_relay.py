@@ -0,0 +1,66 @@
+import socket
+import httplib
+
+from windmill.server.proxy import StreamingResponse
+
+
+def socket_pair():
+    # Connected TCP sockets, like the ones httplib reads responses from
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server = listener.accept()[0]
+    listener.close()
+    return server, client
+
+def upstream(raw, close=True):
+    server, client = socket_pair()
+    server.sendall(raw)
+    if close:
+        server.close()
+    response = httplib.HTTPResponse(client)
+    response.begin()
+    return response, server
+
+def test_content_length():
+    response, server = upstream('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n'
+                                '0123456789', close=False)
+    relay = StreamingResponse(response, buffer_size=4)
+    assert list(relay) == ['0123', '4567', '89']
+    assert response.isclosed()
+    server.close()
+
+def test_chunked_with_trailers():
+    response, server = upstream('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                '5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\n'
+                                'X-Trailer: 1\r\n\r\n')
+    assert ''.join(StreamingResponse(response, buffer_size=3)) == 'hello, world'
+    assert response.isclosed()
+
+def test_ended_by_close():
+    response, server = upstream('HTTP/1.0 200 OK\r\n\r\n' + 'x' * 100000)
+    data = list(StreamingResponse(response, buffer_size=65536))
+    assert ''.join(data) == 'x' * 100000
+    assert max([len(d) for d in data]) <= 65536
+
+def test_truncated_body():
+    response, server = upstream('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n012')
+    try:
+        list(StreamingResponse(response))
+    except httplib.IncompleteRead:
+        pass
+    else:
+        assert False, 'truncated body relayed as complete'
+
+def test_partial_chunks_are_handed_out():
+    response, server = upstream('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                '6\r\nevent\n\r\n', close=False)
+    relay = StreamingResponse(response)
+    body = iter(relay)
+    assert body.next() == 'event\n'
+    # The next event isn't there yet, the handler should flush
+    assert not relay.data_ready()
+    server.sendall('0\r\n\r\n')
+    assert list(body) == []
+    server.close()
@@ -0,0 +1,115 @@
+import socket
+import threading
+import time
+import httplib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.resolver import Resolver
+
+
+class SlowLookup(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = []
+        # Lookups last until this returns True, or for a second at most
+        self.until = None
+        self.running = self.most_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, host, port, family, socktype):
+        self.lock.acquire()
+        self.calls.append(host)
+        self.running += 1
+        self.most_running = max(self.running, self.most_running)
+        self.lock.release()
+        time.sleep(self.delay)
+        give_up = time.time() + 1
+        while self.until is not None and not self.until() and \
+                time.time() < give_up:
+            time.sleep(.01)
+        self.lock.acquire()
+        self.running -= 1
+        self.lock.release()
+        if host.endswith('.invalid'):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+
+def resolve_at_once(resolver, hosts):
+    threads = [threading.Thread(target=resolver.getaddrinfo, args=(host, 80))
+               for host in hosts]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+def test_cold_hosts_resolve_concurrently():
+    resolver = Resolver(ttl=60)
+    resolver.lookup = SlowLookup(.1)
+    # Hold the lookups until every thread has asked, however slowly the
+    # threads start
+    resolver.lookup.until = lambda: \
+        resolver.counters['misses'] + resolver.counters['waits'] == 8
+    # One lookup per host, each host looked up alongside the others
+    resolve_at_once(resolver, ['a.example.com', 'b.example.com'] * 4)
+    assert resolver.lookup.most_running == 2
+    resolver.lookup.calls.sort()
+    assert resolver.lookup.calls == ['a.example.com', 'b.example.com']
+
+    resolver.getaddrinfo('a.example.com', 80)
+    resolver.getaddrinfo('127.0.0.1', 80)
+    stats = resolver.stats()
+    assert stats['misses'] == 2 and stats['waits'] == 6 and stats['hits'] == 1
+    assert stats['entries'] == 2
+
+def test_failures_and_expiry():
+    resolver = Resolver(ttl=.05, failure_ttl=60)
+    resolver.lookup = SlowLookup(0)
+    for i in range(2):
+        try:
+            resolver.getaddrinfo('nowhere.invalid', 80)
+        except socket.gaierror:
+            pass
+        else:
+            assert False, 'resolved an invalid host'
+    assert resolver.lookup.calls == ['nowhere.invalid']
+    assert resolver.stats()['failures'] == 1
+
+    resolver.getaddrinfo('a.example.com', 80)
+    time.sleep(.05)
+    resolver.getaddrinfo('a.example.com', 80)
+    assert resolver.lookup.calls.count('a.example.com') == 2
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+def test_proxy_reuses_lookups():
+    upstream = HTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    resolver = admin_lib.shell_objects_dict['httpd'].proxy.resolver
+    before = resolver.stats()
+    try:
+        for i in range(3):
+            connection = httplib.HTTPConnection('localhost',
+                                                windmill.settings['SERVER_HTTP_PORT'])
+            # HTTP/1.0, each request needs a new upstream connection
+            connection.request('GET', 'http://localhost:%d/' % upstream.server_port)
+            assert connection.getresponse().read() == 'ok'
+            connection.close()
+        after = resolver.stats()
+        assert after['misses'] - before['misses'] == 1
+        assert after['hits'] - before['hits'] == 2
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
@@ -0,0 +1,55 @@
+import httplib
+from time import sleep
+
+import windmill
+from windmill.bin import admin_lib
+
+
+def chunked_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '200')])
+    for i in range(20):
+        yield '0123456789'
+
+def big_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['x' * 40000, 'y' * 40000]
+
+def setup_module(module):
+    module.httpd = admin_lib.shell_objects_dict['httpd']
+    httpd.add_namespace('windmill-test-writes', chunked_app)
+    httpd.add_namespace('windmill-test-bigwrites', big_app)
+
+def teardown_module(module):
+    del httpd.namespaces['windmill-test-writes']
+    del httpd.namespaces['windmill-test-bigwrites']
+
+def fetch(path):
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return body
+
+def stats_after(before):
+    # The server counts a response just after sending it
+    for i in range(100):
+        after = httpd.write_stats()
+        if after['responses'] > before['responses']:
+            return after
+        sleep(.01)
+    return after
+
+def test_small_chunks_go_out_with_headers():
+    before = httpd.write_stats()
+    assert fetch('/windmill-test-writes/') == '0123456789' * 20
+    after = stats_after(before)
+    assert after['responses'] - before['responses'] == 1
+    assert after['writes'] - before['writes'] == 1
+
+def test_large_chunks_are_not_held_back():
+    before = httpd.write_stats()
+    assert fetch('/windmill-test-bigwrites/') == 'x' * 40000 + 'y' * 40000
+    after = stats_after(before)
+    assert after['writes'] - before['writes'] == 2
@@ -0,0 +1,104 @@
+import time
+import httplib
+import threading
+import SocketServer
+from urlparse import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server.proxy import first_success
+from windmill.server.forwardmanager import ForwardManager
+
+
+def test_first_success_runs_probes_at_once():
+    discarded = []
+    lock = threading.Lock()
+
+    def probe(name, delay, result):
+        time.sleep(delay)
+        return result
+
+    def discard(result):
+        lock.acquire()
+        discarded.append(result)
+        lock.release()
+
+    candidates = [('slow', .3, 'slow answer'), ('broken', .05, None),
+                  ('fast', .1, 'fast answer'), ('slower', .2, 'late answer')]
+    start = time.time()
+    assert first_success(probe, candidates, 4, discard) == 'fast answer'
+    assert time.time() - start < .25
+    # The ones that succeeded too late are let go
+    time.sleep(.3)
+    discarded.sort()
+    assert discarded == ['late answer', 'slow answer']
+
+def test_first_success_in_order():
+    calls = []
+
+    def probe(name, result):
+        calls.append(name)
+        return result
+
+    candidates = [('a', None), ('b', 'b answer'), ('c', 'c answer')]
+    assert first_success(probe, candidates, 1, None) == 'b answer'
+    assert calls == ['a', 'b']
+    assert first_success(probe, [('d', None)] * 3, 2, None) is None
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class BrokenHandler(EchoHandler):
+    def do_POST(self):
+        self.send_response(500)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class UpstreamServer(SocketServer.ThreadingMixIn, HTTPServer):
+    # A request waiting for a body that never comes doesn't hold up shutdown
+    daemon_threads = True
+
+def start_upstream(handler):
+    upstream = UpstreamServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return upstream
+
+def test_body_survives_a_failed_learned_host():
+    echo = start_upstream(EchoHandler)
+    broken = start_upstream(BrokenHandler)
+    proxy = admin_lib.shell_objects_dict['httpd'].proxy
+    test_url = windmill.settings['FORWARDING_TEST_URL']
+    fmgr = proxy.fmgr
+    url = 'http://127.0.0.1:%d/form/post' % echo.server_port
+    try:
+        windmill.settings['FORWARDING_TEST_URL'] = url
+        proxy.fmgr = ForwardManager(url)
+        # The path was found on the broken host before
+        proxy.fmgr.learn_host(urlparse(url), urlparse(
+                            'http://127.0.0.1:%d/' % broken.server_port))
+        connection = httplib.HTTPConnection('localhost',
+                        windmill.settings['SERVER_HTTP_PORT'], timeout=5)
+        connection.request('POST', url, 'a=1&b=2',
+                    {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.read() == 'a=1&b=2'
+        connection.close()
+        assert proxy.fmgr.learned_host(urlparse(url)) is None
+    finally:
+        windmill.settings['FORWARDING_TEST_URL'] = test_url
+        proxy.fmgr = fmgr
+        for upstream in echo, broken:
+            upstream.shutdown()
+            upstream.server_close()
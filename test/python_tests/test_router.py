@@ -0,0 +1,36 @@
+from windmill.server.router import NamespaceRouter
+
+
+class App(object):
+    def __init__(self, ns):
+        self.ns = ns
+
+def test_match_anywhere_in_path():
+    serv = App('windmill-serv')
+    router = NamespaceRouter([serv, App('windmill-jsonrpc')])
+    assert router.match('/windmill-serv/start.html') == ('windmill-serv', serv)
+    assert router.match('http://example.com/windmill-serv/js/a.js') == \
+           ('windmill-serv', serv)
+    assert router.match('/windmill-serv') == (None, None)
+    assert router.match('/static/windmill-servx/a.js') == (None, None)
+    assert router.match('windmill-serv/a.js') == (None, None)
+
+def test_multi_segment_namespace():
+    app = App('windmill-extra/api')
+    router = NamespaceRouter([app])
+    assert router.match('/windmill-extra/api/call') == ('windmill-extra/api', app)
+    assert router.match('/windmill-extra/api') == (None, None)
+    assert router.match('/windmill-extra/other/') == (None, None)
+
+def test_runtime_updates_and_hits():
+    router = NamespaceRouter()
+    assert router.match('/windmill-jstest/a.js') == (None, None)
+    app = App('windmill-jstest')
+    router['windmill-jstest'] = app
+    assert router.match('/windmill-jstest/a.js') == ('windmill-jstest', app)
+    router.match('/windmill-jstest/b.js')
+    stats = router.stats()
+    assert stats['hits'] == {'windmill-jstest': 2}
+    assert stats['unmatched'] == 1
+    del router['windmill-jstest']
+    assert router.match('/windmill-jstest/a.js') == (None, None)
@@ -0,0 +1,79 @@
+import httplib
+import socket
+import threading
+import time
+from time import sleep
+
+from windmill.server import wsgi
+
+
+class SlowApp(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __call__(self, environ, start_response):
+        sleep(self.delay)
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', '4')])
+        return ['done']
+
+def start_server():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    add_namespace = wsgi.add_namespace
+    httpd = wsgi.make_windmill_server(http_port=port)
+    wsgi.add_namespace = add_namespace
+    thread = threading.Thread(target=httpd.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not httpd.ready:
+        sleep(.05)
+    return httpd, port
+
+def slow_request(port, results):
+    connection = httplib.HTTPConnection('localhost', port)
+    try:
+        connection.request('GET', '/windmill-slow/')
+        response = connection.getresponse()
+        results.append(response.read())
+    except (socket.error, httplib.HTTPException), e:
+        results.append(e)
+
+def test_stop_drains_requests_in_flight():
+    httpd, port = start_server()
+    httpd.add_namespace('windmill-slow', SlowApp(.3))
+    idle = httplib.HTTPConnection('localhost', port)
+    idle.request('GET', '/windmill-serv/start.html')
+    idle.getresponse().read()
+
+    results = []
+    request = threading.Thread(target=slow_request, args=(port, results))
+    request.start()
+    sleep(.1)
+    start = time.time()
+    cut_off = httpd.stop(timeout=5)
+    request.join()
+
+    assert cut_off == []
+    assert results == ['done']
+    assert time.time() - start < 2
+    # The idle keep-alive connection was closed by the server
+    assert idle.sock.recv(1) == ''
+    idle.close()
+
+def test_stop_reports_requests_cut_off():
+    httpd, port = start_server()
+    httpd.add_namespace('windmill-slow', SlowApp(2))
+    results = []
+    request = threading.Thread(target=slow_request, args=(port, results))
+    request.start()
+    sleep(.1)
+    start = time.time()
+    cut_off = httpd.stop(timeout=.2)
+
+    assert cut_off == ['GET /windmill-slow/ HTTP/1.1']
+    assert time.time() - start < 1
+    request.join()
+    assert results != ['done']
@@ -0,0 +1,64 @@
+import threading
+from time import sleep
+
+from windmill.server.threadpool import WorkerPool
+
+
+def wait_for(condition, timeout=5):
+    waited = 0
+    while not condition() and waited < timeout:
+        sleep(.05)
+        waited += .05
+    return condition()
+
+
+class TestWorkerPool(object):
+
+    def teardown(self):
+        if hasattr(self, 'pool'):
+            self.pool.stop()
+
+    def test_runs_submitted_jobs(self):
+        self.pool = WorkerPool(max_workers=4, min_workers=1)
+        results = []
+        for i in range(20):
+            self.pool.submit(results.append, i)
+
+        assert wait_for(lambda: len(results) == 20)
+        assert sorted(results) == range(20)
+
+    def test_never_exceeds_max_workers(self):
+        self.pool = WorkerPool(max_workers=3, min_workers=0, backlog=0)
+        release = threading.Event()
+        for i in range(10):
+            self.pool.submit(release.wait)
+
+        assert wait_for(lambda: self.pool.stats()['busy'] == 3)
+        stats = self.pool.stats()
+        assert stats['workers'] == 3
+        assert stats['queue_depth'] == 7
+        release.set()
+        assert wait_for(lambda: self.pool.stats()['completed'] == 10)
+        assert self.pool.stats()['peak_workers'] == 3
+
+    def test_full_backlog_rejects_without_blocking(self):
+        self.pool = WorkerPool(max_workers=1, min_workers=1, backlog=1)
+        release = threading.Event()
+        self.pool.submit(release.wait)
+        assert wait_for(lambda: self.pool.stats()['busy'] == 1)
+        assert self.pool.submit(release.wait, block=False)
+        assert not self.pool.submit(release.wait, block=False)
+        assert self.pool.stats()['rejected'] == 1
+        release.set()
+
+    def test_idle_workers_are_reaped(self):
+        self.pool = WorkerPool(max_workers=4, min_workers=1, backlog=0,
+                               idle_timeout=.1)
+        release = threading.Event()
+        for i in range(4):
+            self.pool.submit(release.wait)
+        assert wait_for(lambda: self.pool.stats()['workers'] == 4)
+        release.set()
+
+        assert wait_for(lambda: self.pool.stats()['workers'] == 1)
+        assert self.pool.stats()['reaped'] == 3
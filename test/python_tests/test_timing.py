@@ -0,0 +1,82 @@
+import httplib
+import threading
+from time import sleep
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import windmill
+from windmill.bin import admin_lib
+from windmill.server import timing
+
+try:
+    import json as simplejson
+except ImportError:
+    import simplejson
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+def setup_module(module):
+    module.httpd = admin_lib.shell_objects_dict['httpd']
+    module.upstream = HTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def teardown_module(module):
+    upstream.shutdown()
+    upstream.server_close()
+
+def fetch(path):
+    connection = httplib.HTTPConnection('localhost', windmill.settings['SERVER_HTTP_PORT'])
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return body
+
+def latency_of(group, key):
+    # The handler records a request just after sending its response
+    for i in range(100):
+        stats = httpd.latency_stats()[group].get(key)
+        if stats is not None:
+            return stats
+        sleep(.01)
+
+def test_histogram():
+    histogram = timing.Histogram()
+    for ms in (0.5, 3, 3, 40, 20000):
+        histogram.add(ms / 1000.0)
+    summary = histogram.summary()
+    assert summary['count'] == 5
+    assert summary['buckets'] == {'<=1': 1, '<=5': 2, '<=50': 1, '>10000': 1}
+    assert summary['p50_ms'] == 5
+    assert summary['max_ms'] == 20000
+
+def test_namespace_and_upstream_phases():
+    httpd.latency.reset()
+    fetch('/windmill-serv/start.html')
+    stats = latency_of('namespaces', 'windmill-serv')
+    for phase in ('parse', 'dispatch', 'app', 'send', 'total'):
+        assert stats[phase]['count'] == 1
+
+    host = '127.0.0.1:%d' % upstream.server_port
+    assert fetch('http://%s/page' % host) == 'ok'
+    stats = latency_of('upstreams', host)
+    for phase in ('connect', 'request', 'first_byte', 'relay', 'total'):
+        assert stats[phase]['count'] == 1
+    assert latency_of('namespaces', 'proxy')['app']['count'] == 1
+
+def test_stats_endpoint():
+    fetch('/windmill-serv/start.html')
+    latency_of('namespaces', 'windmill-serv')
+    stats = simplejson.loads(fetch('/windmill-stats/'))
+    assert 'windmill-serv' in stats['latency']['namespaces']
+    assert 'workers' in stats and 'routes' in stats
@@ -0,0 +1,77 @@
+import ssl
+import socket
+import httplib
+import threading
+from time import sleep
+
+import windmill
+from windmill.server import wsgi
+
+
+def setup_module(module):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    module.port = s.getsockname()[1]
+    s.close()
+    module.has_ssl = windmill.has_ssl
+    windmill.has_ssl = True
+    add_namespace = wsgi.add_namespace
+    module.httpd = wsgi.make_windmill_server(http_port=module.port,
+                                             compression_enabled=False)
+    wsgi.add_namespace = add_namespace
+    thread = threading.Thread(target=module.httpd.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not module.httpd.ready:
+        sleep(.05)
+
+def teardown_module(module):
+    module.httpd.stop(timeout=1)
+    windmill.has_ssl = module.has_ssl
+
+def open_tunnel(host):
+    """An HTTPConnection to host going through a CONNECT tunnel"""
+    sock = socket.create_connection(('127.0.0.1', port), 5)
+    sock.sendall('CONNECT %s:443 HTTP/1.1\r\nHost: %s:443\r\n\r\n' %
+                 (host, host))
+    answer = ''
+    while not answer.endswith('\r\n\r\n'):
+        data = sock.recv(1)
+        assert data
+        answer += data
+    assert answer.startswith('HTTP/1.1 200 ')
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_NONE
+    connection = httplib.HTTPConnection(host)
+    connection.sock = context.wrap_socket(sock, server_hostname=host)
+    return connection
+
+def test_requests_share_a_tunnel():
+    if not hasattr(ssl, 'SSLContext'):
+        return
+    connection = open_tunnel('tunnel.example.com')
+    sock = connection.sock
+    for i in range(2):
+        connection.request('GET', '/windmill-serv/start.html')
+        response = connection.getresponse()
+        assert response.status == 200
+        assert len(response.read()) == int(response.getheader('content-length'))
+        assert connection.sock is sock
+    connection.close()
+
+def test_tunnels_to_a_host_share_its_context():
+    if not hasattr(ssl, 'SSLContext'):
+        return
+    contexts = []
+    for i in range(2):
+        connection = open_tunnel('context.example.com')
+        connection.request('GET', '/windmill-serv/start.html')
+        assert connection.getresponse().read()
+        connection.close()
+        contexts.append(httpd.ssl_contexts['context.example.com'])
+    assert contexts[0] is contexts[1]
+    connection = open_tunnel('other.example.com')
+    connection.request('GET', '/windmill-serv/start.html')
+    assert connection.getresponse().read()
+    connection.close()
+    assert httpd.ssl_contexts['other.example.com'] is not contexts[0]
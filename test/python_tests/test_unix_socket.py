@@ -0,0 +1,67 @@
+import os
+import socket
+import tempfile
+
+from windmill.bin import admin_lib
+from windmill.server.https import bind_unix_socket
+from windmill.tools import server_tools
+
+
+def test_rpc_clients_use_the_socket():
+    path = server_tools.rpc_socket_path()
+    connection = server_tools.connect_unix_socket(path)
+    assert connection is not None
+    connection.close()
+
+    clients = admin_lib.shell_objects_dict
+    # Requests are logged once served, the first one finds another
+    clients['jsonrpc_client'].recent_requests(1)
+    assert clients['jsonrpc_client'].recent_requests(1)['result']
+    assert clients['xmlrpc_client'].recent_requests(1)
+    transport = clients['xmlrpc_client']._ServerProxy__transport
+    assert transport.local
+
+def test_stale_socket_is_replaced():
+    path = tempfile.mktemp(suffix='.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    assert server_tools.connect_unix_socket(path) is None
+
+    sock = bind_unix_socket(path, 5)
+    try:
+        assert server_tools.connect_unix_socket(path) is not None
+        try:
+            bind_unix_socket(path, 5)
+        except socket.error:
+            pass
+        else:
+            assert False, 'bound a socket another server listens on'
+    finally:
+        sock.close()
+        os.unlink(path)
+
+def test_socket_is_private():
+    directory = tempfile.mktemp()
+    path = os.path.join(directory, 'windmill.sock')
+    sock = bind_unix_socket(path, 5)
+    try:
+        assert os.stat(directory).st_mode & 0777 == 0700
+        assert os.stat(path).st_mode & 0777 == 0600
+    finally:
+        sock.close()
+        os.unlink(path)
+        os.rmdir(directory)
+
+def test_socket_of_another_user_is_not_used():
+    if os.getuid() != 0:
+        # Only root can give a socket away
+        return
+    path = tempfile.mktemp(suffix='.sock')
+    sock = bind_unix_socket(path, 5)
+    try:
+        os.chown(path, 65534, -1)
+        assert server_tools.connect_unix_socket(path) is None
+    finally:
+        sock.close()
+        os.unlink(path)
@@ -197,6 +197,20 @@ class Port(object):
     def __call__(self, value):
         windmill.settings['SERVER_HTTP_PORT'] = int(value)
         
+class Engine(object):
+    """Server engine, threaded or evented."""
+    option_names = (None, 'engine')
+    setting = 'SERVER_ENGINE'
+    def __call__(self, value):
+        windmill.settings[self.setting] = value
+        
+class Processes(object):
+    """Number of server processes sharing the port. Default is 1."""
+    option_names = (None, 'processes')
+    setting = 'SERVER_PROCESSES'
+    def __call__(self, value):
+        windmill.settings[self.setting] = int(value)
+        
 def process_module(module):
     """Process this modules option list"""
     options_dict = {}
@@ -143,8 +143,9 @@ def run_js_tests(js_dir, test_filter=None, phase=None):
     import windmill
     windmill.js_framework_active = True
     js_dir = os.path.abspath(os.path.expanduser(js_dir))
-    from wsgi_fileserver import WSGIFileServerApplication
-    application = WSGIFileServerApplication(root_path=os.path.abspath(js_dir), mount_point='/windmill-jstest/')
+    from windmill.server.fileserver import FileServerApplication, shared_cache
+    application = FileServerApplication(root_path=os.path.abspath(js_dir), mount_point='/windmill-jstest/',
+                                        cache=shared_cache())
     from windmill.server import wsgi
     wsgi.add_namespace('windmill-jstest', application)
     # Build list of files and send to IDE
@@ -170,8 +171,9 @@ def run_js_tests(js_dir, test_filter=None, phase=None):
 def load_extensions_dir(dirname):
    """Mount the directory and send all javascript file links to the IDE in order to execute those test urls under the jsUnit framework"""
    # Mount the fileserver application for tests
-   from wsgi_fileserver import WSGIFileServerApplication
-   application = WSGIFileServerApplication(root_path=os.path.abspath(dirname), mount_point='/windmill-extentions/')
+   from windmill.server.fileserver import FileServerApplication, shared_cache
+   application = FileServerApplication(root_path=os.path.abspath(dirname), mount_point='/windmill-extentions/',
+                                       cache=shared_cache())
    from windmill.server import wsgi
    wsgi.add_namespace('windmill-extentions', application)
    # Build list of files and send to IDE
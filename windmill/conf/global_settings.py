@@ -33,6 +33,132 @@ RUN_TEST = None
 LOAD_TEST = None
 
 SERVER_HTTP_PORT = 4444
+
+# 'threaded' serves each connection on a worker thread, 'evented' waits on
+# all connections from a single event loop and only uses workers to run
+# requests.
+SERVER_ENGINE = 'threaded'
+
+# Values above 1 fork that many server processes in total, sharing the port
+# through SO_REUSEPORT. Every process proxies; the first one keeps the test
+# state, the others forward windmill RPC requests to it and share the
+# proxy's forwarding state of a test run through it.
+SERVER_PROCESSES = 1
+
+# Worker threads handling requests in the HTTP server. The pool grows on
+# demand up to SERVER_MAX_WORKERS; connections beyond that wait in a backlog
+# of SERVER_WORKER_BACKLOG entries. Idle workers exit after
+# SERVER_WORKER_IDLE_TIMEOUT seconds down to SERVER_MIN_WORKERS.
+SERVER_MAX_WORKERS         = 128
+SERVER_MIN_WORKERS         = 4
+SERVER_WORKER_BACKLOG      = 256
+SERVER_WORKER_IDLE_TIMEOUT = 30
+
+# Persistent (keep-alive) connections between the browser and windmill.
+# A connection that stays idle for SERVER_KEEPALIVE_TIMEOUT seconds is closed,
+# and so is an idle one whose worker is needed by connections waiting for one.
+SERVER_KEEPALIVE         = True
+SERVER_KEEPALIVE_TIMEOUT = 15
+
+# Response headers and small body chunks are joined in to socket writes of up
+# to SERVER_WRITE_BUFFER_SIZE bytes.
+SERVER_WRITE_BUFFER_SIZE = 16384
+
+# gzip windmill's own responses for browsers that accept it. Static files
+# and the IDE bundle are compressed once, RPC responses when they are at
+# least SERVER_GZIP_MIN_SIZE bytes.
+SERVER_GZIP          = True
+SERVER_GZIP_MIN_SIZE = 1024
+
+# Bytes of small static files served by windmill's own mounts that are kept
+# in memory. 0 disables the cache.
+SERVER_STATIC_CACHE_SIZE = 32 * 1024 * 1024
+
+# Seconds the server waits for requests in flight to finish when it is
+# stopped before their connections are cut off.
+SERVER_SHUTDOWN_TIMEOUT = 5
+
+# Proxied requests sent upstream at once. Further requests wait in a queue
+# that takes turns between browsers (told apart by their address and
+# User-Agent), up to SERVER_PROXY_QUEUE_SIZE of them
+# for SERVER_PROXY_QUEUE_TIMEOUT seconds, after which they get a 503 with a
+# Retry-After of SERVER_PROXY_RETRY_AFTER seconds. Proxied requests never
+# take the last SERVER_RPC_RESERVED_WORKERS worker threads, which stay
+# free for the windmill namespaces. 0 turns the limit off.
+SERVER_PROXY_CONCURRENCY = 48
+SERVER_PROXY_QUEUE_SIZE = 64
+SERVER_PROXY_QUEUE_TIMEOUT = 10
+SERVER_PROXY_RETRY_AFTER = 2
+SERVER_RPC_RESERVED_WORKERS = 16
+
+# Number of recent requests the access log keeps in memory, queryable with
+# the recent_requests RPC method. 0 turns the access log off.
+SERVER_ACCESS_LOG_SIZE = 1000
+
+# Unix socket the server also listens on, which the RPC clients made by
+# windmill.tools use instead of TCP when it is there. True puts it in a
+# directory of the user's in the temp directory, named after
+# SERVER_HTTP_PORT. False turns it off.
+SERVER_RPC_SOCKET = True
+
+# Proxied request bodies larger than this many bytes are spooled to a
+# temporary file instead of being held in memory.
+PROXY_BODY_SPOOL_SIZE = 1024 * 1024
+
+# Proxied response bodies are relayed to the browser in blocks of at most
+# this many bytes, as they arrive from the server.
+PROXY_RELAY_BUFFER_SIZE = 65536
+
+# Connections to the servers behind the proxy are kept open and reused.
+# At most PROXY_POOL_MAX_PER_HOST are in use per host, a request waits up
+# to PROXY_POOL_WAIT_TIMEOUT seconds for one before opening another anyway.
+# Idle connections are closed after PROXY_POOL_IDLE_TIMEOUT seconds.
+PROXY_POOL_MAX_PER_HOST = 16
+PROXY_POOL_WAIT_TIMEOUT = 5
+PROXY_POOL_IDLE_TIMEOUT = 30
+
+# Seconds the proxy waits to connect to a server behind it, None waits as
+# long as the OS does. Once connecting or talking to a server failed
+# PROXY_BREAKER_THRESHOLD times in a row, proxied requests to it fail right
+# away with a 502 for PROXY_BREAKER_COOLDOWN seconds, then a single request
+# checks if it's back. A threshold of 0 turns this off.
+PROXY_CONNECT_TIMEOUT = 10
+PROXY_BREAKER_THRESHOLD = 2
+PROXY_BREAKER_COOLDOWN = 10
+
+# Upstream host names are looked up once every PROXY_DNS_TTL seconds, and
+# ones that didn't resolve once every PROXY_DNS_FAILURE_TTL seconds. A TTL
+# of 0 looks them up for every new connection.
+PROXY_DNS_TTL = 60
+PROXY_DNS_FAILURE_TTL = 5
+
+# A proxied request that fails is retried on every host the test has been
+# forwarded to, this many at once. The first to succeed answers it, and
+# requests for the same path go straight to that host from then on.
+PROXY_RETRY_CONCURRENCY = 8
+
+# Cacheable GET responses from the servers behind the proxy are kept in this
+# directory across runs, served while fresh and revalidated with the server
+# once stale. The browser is still told not to cache anything. True puts it
+# in the temp directory, None turns the cache off. Responses larger than
+# PROXY_CACHE_MAX_ENTRY_SIZE bytes aren't cached.
+PROXY_CACHE_DIR = None
+PROXY_CACHE_MAX_ENTRY_SIZE = 10 * 1024 * 1024
+
+# 'record' saves every response the proxy relays from the servers behind it
+# to PROXY_ARCHIVE_DIR, 'replay' answers proxied requests from there without
+# touching the network. None turns both off, and None as the directory puts
+# the archive in the temp directory. Requests are matched on method, URL,
+# query string and body. PROXY_ARCHIVE_MATCH_QUERY and
+# PROXY_ARCHIVE_MATCH_BODY turn off matching the last two, and the
+# parameters in PROXY_ARCHIVE_IGNORE_PARAMS (cache busters, timestamps) are
+# left out of both.
+PROXY_ARCHIVE_MODE = None
+PROXY_ARCHIVE_DIR = None
+PROXY_ARCHIVE_MATCH_QUERY = True
+PROXY_ARCHIVE_MATCH_BODY = True
+PROXY_ARCHIVE_IGNORE_PARAMS = []
+
 PLATFORM         = sys.platform
 WINDMILL_PATH    = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
 JS_PATH          = os.path.join(WINDMILL_PATH, 'html')
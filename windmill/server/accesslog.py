@@ -0,0 +1,107 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Access log.
+
+    Request threads hand a tuple of ACCESS_FIELDS, with the status as the
+    status line, to AccessLog.record(), which only queues it. A writer
+    thread turns the tuples in to dicts, keeps the last size of them in a
+    ring buffer and writes a line for each to the windmill.server.access
+    logger when that logs debug messages. Nothing is formatted on the
+    request thread.
+"""
+
+import time
+import Queue
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('windmill.server.access')
+
+# Order of the values in a recorded tuple
+ACCESS_FIELDS = ('time', 'client', 'method', 'url', 'namespace', 'status',
+                 'bytes', 'duration_ms', 'upstream')
+
+_stop = object()
+
+class AccessLog(object):
+    """Ring buffer of the last size requests, filled by a writer thread"""
+
+    def __init__(self, size=1000, backlog=10000):
+        self.size = size
+        self.entries = deque()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(backlog)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_entries,
+                                       name='windmill access log')
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def record(self, entry):
+        """Queue an ACCESS_FIELDS tuple, dropping it if the writer is too
+        far behind rather than blocking the request"""
+        try:
+            self.queue.put_nowait(entry)
+        except Queue.Full:
+            self.dropped += 1
+
+    def write_entries(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _stop:
+                return
+            entry = dict(zip(ACCESS_FIELDS, entry))
+            # Handed over as the status line, 0 if no response went out
+            try:
+                entry['status'] = int(entry['status'].split(' ', 1)[0])
+            except ValueError:
+                entry['status'] = 0
+            self.lock.acquire()
+            try:
+                self.entries.append(entry)
+                if len(self.entries) > self.size:
+                    self.entries.popleft()
+            finally:
+                self.lock.release()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('%s "%s %s" %s %d %.1fms %s',
+                             entry['client'], entry['method'], entry['url'],
+                             entry['status'], entry['bytes'],
+                             entry['duration_ms'], entry['namespace'])
+
+    def recent(self, count=100):
+        """Return up to count of the latest entries, oldest first"""
+        self.lock.acquire()
+        try:
+            entries = list(self.entries)
+        finally:
+            self.lock.release()
+        if count < len(entries):
+            entries = entries[len(entries) - count:]
+        return entries
+
+    def flush(self, timeout=5):
+        """Wait until the writer caught up with the queue"""
+        deadline = time.time() + timeout
+        while self.queue.qsize() and time.time() < deadline:
+            time.sleep(.001)
+
+    def stop(self, timeout=5):
+        """Write out what is queued and stop the writer"""
+        try:
+            self.queue.put(_stop, True, timeout)
+        except Queue.Full:
+            return
+        self.writer.join(timeout)
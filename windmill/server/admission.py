@@ -0,0 +1,133 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Admission control for proxied requests.
+
+At most limit requests go through the gate at once. Requests beyond that
+wait in per client queues that are served round robin, so a page fanning
+out to a hundred assets doesn't make every other browser wait behind it.
+Clients are told apart by client_key().
+"""
+
+import threading
+
+def client_key(address, environ):
+    """Identify the browser a request comes from.
+
+    The browsers windmill drives usually run on the same machine as the
+    server, so they all connect from one address. The User-Agent tells
+    them apart as long as they are different browsers. Two copies of the
+    same browser on one machine still share a queue.
+    """
+    return address, environ.get('HTTP_USER_AGENT', '')
+
+class AdmissionGate(object):
+    """Concurrency limit with a fair, bounded wait queue"""
+
+    def __init__(self, limit=48, queue_size=64, timeout=10):
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        # client -> waiting Events, and the clients in the order they
+        # get their next turn
+        self.queues = {}
+        self.turns = []
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_active = 0
+        self.peak_waiting = 0
+
+    def enter(self, client):
+        """Wait for a slot for a request from client.
+
+        Returns True once admitted, the caller must call leave() when done.
+        Returns False straight away if the wait queue is full, or when no
+        slot freed up within timeout seconds.
+        """
+        self.lock.acquire()
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            if self.active > self.peak_active:
+                self.peak_active = self.active
+            self.lock.release()
+            return True
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            self.lock.release()
+            return False
+        waiter = threading.Event()
+        if client in self.queues:
+            self.queues[client].append(waiter)
+        else:
+            self.queues[client] = [waiter]
+            self.turns.append(client)
+        self.waiting += 1
+        if self.waiting > self.peak_waiting:
+            self.peak_waiting = self.waiting
+        self.lock.release()
+
+        waiter.wait(self.timeout)
+
+        self.lock.acquire()
+        try:
+            if waiter.isSet():
+                # leave() handed its slot over to us
+                return True
+            queue = self.queues[client]
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[client]
+                self.turns.remove(client)
+            self.waiting -= 1
+            self.timed_out += 1
+            return False
+        finally:
+            self.lock.release()
+
+    def leave(self):
+        """Free a slot, handing it to the next waiting client if any"""
+        self.lock.acquire()
+        try:
+            if not self.turns:
+                self.active -= 1
+                return
+            client = self.turns.pop(0)
+            queue = self.queues[client]
+            waiter = queue.pop(0)
+            if queue:
+                self.turns.append(client)
+            else:
+                del self.queues[client]
+            self.waiting -= 1
+            self.admitted += 1
+            waiter.set()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return active and waiting requests and admission counters"""
+        self.lock.acquire()
+        try:
+            return {'active': self.active, 'waiting': self.waiting,
+                    'limit': self.limit, 'queue_size': self.queue_size,
+                    'waiting_clients': len(self.turns),
+                    'admitted': self.admitted, 'rejected': self.rejected,
+                    'timed_out': self.timed_out,
+                    'peak_active': self.peak_active,
+                    'peak_waiting': self.peak_waiting}
+        finally:
+            self.lock.release()
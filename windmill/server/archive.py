@@ -0,0 +1,201 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Record the proxy's exchanges with the servers behind it, and replay them.
+
+    In record mode every response the proxy relays is saved to a directory
+    along with the request it answered. In replay mode the proxy answers
+    from that directory and never touches the network, so a suite can run
+    against a frozen backend, at the speed of the local disk.
+"""
+
+import os
+import glob
+import threading
+import logging
+try:
+    from hashlib import sha1
+except ImportError:
+    # python 2.4
+    from sha import new as sha1
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    # python 2.5
+    from cgi import parse_qsl
+import urllib
+
+from proxycache import CachingResponse, replace, to_json, from_json
+
+logger = logging.getLogger(__name__)
+
+modes = ('record', 'replay')
+
+class ProxyArchive(object):
+    """Recorded exchanges in directory, in the given mode.
+
+    Requests are matched on their method, URL, query string and body.
+    match_query and match_body turn the last two off, and the parameters
+    in ignore_params are left out of both, for cache busters and
+    timestamps that change with every run. A request recorded several
+    times is replayed in the recorded order, the last response repeating
+    once they have all been used.
+    """
+
+    def __init__(self, directory, mode, match_query=True, match_body=True,
+                 ignore_params=()):
+        if mode not in modes:
+            raise ValueError('Proxy archive mode must be one of %s, not %r' %
+                             (', '.join(modes), mode))
+        self.directory = directory
+        self.mode = mode
+        self.match_query = match_query
+        self.match_body = match_body
+        self.ignore_params = dict.fromkeys(ignore_params)
+        # Recordings aren't limited in size
+        self.max_entry_size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        # key -> number of exchanges recorded or replayed in this run
+        self.sequence = {}
+        self.counters = {'recorded': 0, 'replayed': 0, 'missed': 0}
+
+    def params(self, query):
+        pairs = [pair for pair in parse_qsl(query, True)
+                 if pair[0] not in self.ignore_params]
+        pairs.sort()
+        return urllib.urlencode(pairs)
+
+    def key(self, method, url, content_type=None, body=None):
+        """The request a recorded exchange is matched on, as a string"""
+        url = url.split('#', 1)[0]
+        parts = url.split('?', 1)
+        url = parts[0]
+        if self.match_query and len(parts) == 2:
+            url += '?' + self.params(parts[1])
+        key = '%s %s' % (method, url)
+        if self.match_body and body is not None:
+            if hasattr(body, 'read'):
+                data = body.read()
+                body.seek(0)
+            else:
+                data = body
+            if (content_type or '').startswith('application/x-www-form-urlencoded'):
+                key += ' ' + self.params(data)
+            else:
+                key += ' ' + sha1(data).hexdigest()
+        return key
+
+    def path(self, key, number, extension):
+        return os.path.join(self.directory, '%s-%d%s' %
+                            (sha1(key).hexdigest(), number, extension))
+
+    def record(self, key, status_line, headers, body):
+        """Relay body, recorded as the answer to key once it has been read
+        to the end"""
+        exchange = {'key': key, 'status': status_line, 'headers': headers}
+        return CachingResponse(self, key, exchange, body)
+
+    def add(self, key, exchange, temp):
+        """Save a recorded exchange, its body being in the file temp"""
+        self.lock.acquire()
+        try:
+            number = self.sequence.get(key, 0)
+            if not number:
+                # Recording again replaces what an earlier run recorded
+                prefix = os.path.join(self.directory, sha1(key).hexdigest())
+                for name in glob.glob(prefix + '-*'):
+                    os.remove(name)
+            replace(temp, self.path(key, number, '.body'))
+            f = open(self.path(key, number, '.json'), 'wb')
+            try:
+                f.write(to_json(exchange))
+            finally:
+                f.close()
+            self.sequence[key] = number + 1
+            self.counters['recorded'] += 1
+        finally:
+            self.lock.release()
+
+    def replay(self, key):
+        """Status line, headers and open body file recorded for key, None if
+        it was never recorded"""
+        self.lock.acquire()
+        try:
+            number = self.sequence.get(key, 0)
+            exchange = self.load(key, number)
+            if exchange is None and number:
+                # Out of recordings, keep answering with the last one
+                number -= 1
+                exchange = self.load(key, number)
+            if exchange is None:
+                self.counters['missed'] += 1
+                return None
+            self.sequence[key] = number + 1
+            self.counters['replayed'] += 1
+        finally:
+            self.lock.release()
+        status_line, headers, body = exchange
+        length = os.fstat(body.fileno()).st_size
+        headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+        headers.append(('content-length', str(length)))
+        return status_line, headers, body
+
+    def load(self, key, number):
+        # Called with self.lock held
+        try:
+            f = open(self.path(key, number, '.json'), 'rb')
+            try:
+                exchange = from_json(f.read())
+            finally:
+                f.close()
+            body = open(self.path(key, number, '.body'), 'rb')
+        except (IOError, ValueError, UnicodeError):
+            return None
+        return exchange['status'], exchange['headers'], body
+
+    def rewind(self):
+        """Replay from the first recorded exchanges again"""
+        self.lock.acquire()
+        try:
+            self.sequence = {}
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the mode and recorded, replayed and missed counters"""
+        self.lock.acquire()
+        try:
+            stats = self.counters.copy()
+        finally:
+            self.lock.release()
+        stats['mode'] = self.mode
+        return stats
+
+shared_archives = {}
+shared_lock = threading.Lock()
+
+def shared_archive(directory, mode, match_query=True, match_body=True,
+                   ignore_params=()):
+    """The ProxyArchive for directory, one per directory so proxies using
+    the same one number their recordings together"""
+    directory = os.path.abspath(directory)
+    shared_lock.acquire()
+    try:
+        if directory not in shared_archives:
+            shared_archives[directory] = ProxyArchive(directory, mode,
+                            match_query, match_body, ignore_params)
+        return shared_archives[directory]
+    finally:
+        shared_lock.release()
@@ -0,0 +1,106 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Stop sending requests to upstream hosts that are down.
+
+    A request to a host that is down or drops packets waits for the
+    connect timeout, and the proxy's retries wait for it again on every
+    known host. HostBreaker counts the failures of each host, and once a
+    host has failed often enough, requests to it fail right away until a
+    single request finds it back up.
+"""
+
+import time
+import threading
+
+class HostBreaker(object):
+    """Failure tracking for upstream hosts, by (scheme, netloc).
+
+    After threshold failures in a row a host is open: allow() is False for
+    it for cooldown seconds. Then a single request is let through to probe
+    it, its success closes the host again and its failure reopens it for
+    another cooldown. A threshold of 0 never opens any host.
+    """
+
+    def __init__(self, threshold=2, cooldown=10):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        # key -> [failures in a row, open until, probe sent at]
+        self.hosts = {}
+        self.counters = {'failures': 0, 'opened': 0, 'short_circuited': 0}
+
+    def allow(self, key):
+        """True if a request to key may be sent"""
+        self.lock.acquire()
+        try:
+            host = self.hosts.get(key)
+            if host is None or not host[1]:
+                return True
+            now = time.time()
+            if now < host[1]:
+                self.counters['short_circuited'] += 1
+                return False
+            if host[2] is not None and now < host[2] + self.cooldown:
+                # Another request is finding out if it's back
+                self.counters['short_circuited'] += 1
+                return False
+            host[2] = now
+            return True
+        finally:
+            self.lock.release()
+
+    def retry_after(self, key):
+        """Seconds until requests to key are let through again"""
+        self.lock.acquire()
+        try:
+            host = self.hosts.get(key)
+            if host is None:
+                return 0
+            return max(host[1] - time.time(), 0)
+        finally:
+            self.lock.release()
+
+    def success(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.hosts:
+                del self.hosts[key]
+        finally:
+            self.lock.release()
+
+    def failure(self, key):
+        self.lock.acquire()
+        try:
+            self.counters['failures'] += 1
+            host = self.hosts.setdefault(key, [0, 0, None])
+            host[0] += 1
+            if self.threshold and (host[0] >= self.threshold or host[2] is not None):
+                if not host[1]:
+                    self.counters['opened'] += 1
+                host[1] = time.time() + self.cooldown
+                host[2] = None
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return failure counters and the hosts requests aren't sent to"""
+        self.lock.acquire()
+        try:
+            stats = self.counters.copy()
+            stats['open'] = ['%s://%s' % key for key, host
+                             in self.hosts.items() if host[1]]
+        finally:
+            self.lock.release()
+        stats['open'].sort()
+        return stats
@@ -52,7 +52,7 @@ class SSLCertificateForHost(object):
 class CertificateCreator(object):
 
     default_filetype = crypto.FILETYPE_PEM
-    default_digest = "md5"
+    default_digest = "sha256"
 
     default_key_bits = 1024
     default_key_type = crypto.TYPE_RSA
@@ -0,0 +1,167 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    gzip content encoding for the windmill namespaces.
+"""
+
+import gzip
+import zlib
+from cStringIO import StringIO
+
+_compressible_types = ('text/', 'application/x-javascript', 'application/javascript',
+                       'application/json', 'application/xml')
+
+def accepts_gzip(environ):
+    """True if the Accept-Encoding header allows gzip"""
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.strip().split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, value = (param.split('=', 1) + [''])[:2]
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def gzip_string(data, level=6):
+    """Return data compressed in gzip format"""
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=level)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def is_compressible(headers):
+    """True if a response with headers is worth compressing"""
+    content_type = ''
+    for name, value in headers:
+        name = name.lower()
+        if name == 'content-encoding':
+            return False
+        if name == 'content-type':
+            content_type = value.lower()
+    for prefix in _compressible_types:
+        if content_type.startswith(prefix):
+            return True
+    return False
+
+def vary_on_encoding(headers):
+    """Return headers with Accept-Encoding added to their Vary header"""
+    fields = []
+    result = []
+    for name, value in headers:
+        if name.lower() == 'vary':
+            fields.extend([field.strip() for field in value.split(',')
+                           if field.strip()])
+        else:
+            result.append((name, value))
+    if 'accept-encoding' not in [field.lower() for field in fields]:
+        fields.append('Accept-Encoding')
+    result.append(('Vary', ', '.join(fields)))
+    return result
+
+def gzip_etag(name, value):
+    if name.lower() == 'etag' and value.endswith('"'):
+        return name, value[:-1] + '-gzip"'
+    return name, value
+
+class GzipApplication(object):
+    """Compress the responses of application for browsers accepting gzip.
+
+    Bodies smaller than min_size are sent as they are. Both variants of a
+    compressible response carry Vary: Accept-Encoding so caches between
+    the server and the browser keep them apart. With cache_size set,
+    the compressed bodies of up to that many paths are kept and reused as
+    long as the uncompressed body doesn't change, which suits static files.
+    """
+
+    def __init__(self, application, min_size=1024, cache_size=0, level=6):
+        self.application = application
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.level = level
+        self.cache = {}
+
+    def __call__(self, environ, start_response):
+        if not accepts_gzip(environ):
+            def vary_start_response(status, headers, exc_info=None):
+                if status[:3] in ('200', '304') and is_compressible(headers):
+                    headers = vary_on_encoding(headers)
+                return start_response(status, headers, exc_info)
+            return self.application(environ, vary_start_response)
+        revalidating_gzip = '-gzip"' in environ.get('HTTP_IF_NONE_MATCH', '')
+        if revalidating_gzip:
+            # Let the application compare the ETags it handed out
+            environ['HTTP_IF_NONE_MATCH'] = \
+                environ['HTTP_IF_NONE_MATCH'].replace('-gzip"', '"')
+
+        response = []
+        body = []
+        def capture_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return body.append
+
+        result = self.application(environ, capture_response)
+        if response and not body and (response[0][:3] != '200' or
+                                      not is_compressible(response[1])):
+            # Pass images and other files through untouched, which lets
+            # the server still use sendfile for them
+            status, headers = response
+            if status[:3] == '304' and revalidating_gzip:
+                headers = [gzip_etag(name, value) for name, value in headers]
+            if status[:3] == '304' and is_compressible(headers):
+                headers = vary_on_encoding(headers)
+            start_response(status, headers)
+            return result
+        try:
+            for data in result:
+                body.append(data)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = response
+        data = ''.join(body)
+
+        if status[:3] != '200' or not is_compressible(headers):
+            start_response(status, headers)
+            return [data]
+        headers = vary_on_encoding(headers)
+        if len(data) < self.min_size:
+            start_response(status, headers)
+            return [data]
+
+        data = self.compress(environ['PATH_INFO'], data)
+        # The compressed body is a different entity with its own ETag
+        headers = [gzip_etag(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(data))))
+        start_response(status, headers)
+        return [data]
+
+    def compress(self, path, data):
+        if not self.cache_size:
+            return gzip_string(data, self.level)
+        checksum = (len(data), zlib.crc32(data))
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == checksum:
+            return cached[1]
+        compressed = gzip_string(data, self.level)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[path] = (checksum, compressed)
+        return compressed
@@ -0,0 +1,179 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Keep-alive connections to the servers windmill proxies for.
+
+    ConnectionPool hands out httplib connections by (scheme, netloc) key.
+    A connection goes back to the pool once its response has been read to
+    the end, and the next request to that host reuses it instead of paying
+    for a new TCP connection and TLS handshake.
+"""
+
+import time
+import select
+import socket
+import threading
+
+class ConnectionPool(object):
+    """Idle upstream connections by (scheme, netloc).
+
+    At most max_per_host connections to a host are checked out at once,
+    further checkouts wait up to wait_timeout seconds for one to come back
+    and then go ahead with an extra connection. Idle connections are closed
+    after idle_timeout seconds, and ones the server closed or sent data on
+    are dropped when checked out.
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=30, wait_timeout=5):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.returned = threading.Condition(self.lock)
+        # key -> [(time it was checked in, connection)], newest last
+        self.idle = {}
+        # key -> number of connections checked out
+        self.busy = {}
+        self.last_eviction = time.time()
+        self.closed = False
+        self.counters = {'checkouts': 0, 'reused': 0, 'created': 0,
+                         'waits': 0, 'wait_time': 0.0, 'overflow': 0,
+                         'stale': 0, 'evicted': 0}
+
+    def checkout(self, key, create):
+        """Return an idle connection for key, or a new one from create().
+
+        The connection's reused attribute tells which it is. It must be
+        given back with checkin().
+        """
+        self.lock.acquire()
+        try:
+            self.counters['checkouts'] += 1
+            waited = False
+            started = time.time()
+            while True:
+                connection = self.take_idle(key)
+                if connection is not None:
+                    self.busy[key] = self.busy.get(key, 0) + 1
+                    self.counters['reused'] += 1
+                    connection.reused = True
+                    return connection
+                if self.busy.get(key, 0) < self.max_per_host or self.closed:
+                    break
+                remaining = started + self.wait_timeout - time.time()
+                if remaining <= 0:
+                    self.counters['overflow'] += 1
+                    break
+                if not waited:
+                    self.counters['waits'] += 1
+                    waited = True
+                self.returned.wait(remaining)
+            if waited:
+                self.counters['wait_time'] += time.time() - started
+            self.busy[key] = self.busy.get(key, 0) + 1
+            self.counters['created'] += 1
+        finally:
+            self.lock.release()
+        try:
+            connection = create()
+        except:
+            self.checkin(key, None)
+            raise
+        connection.reused = False
+        return connection
+
+    def take_idle(self, key):
+        # Called with self.lock held
+        idle = self.idle.get(key)
+        deadline = time.time() - self.idle_timeout
+        while idle:
+            checked_in, connection = idle.pop()
+            if checked_in > deadline and is_healthy(connection):
+                return connection
+            self.counters['stale'] += 1
+            connection.close()
+        return None
+
+    def checkin(self, key, connection, reusable=True):
+        """Give back a checked out connection. It is kept for reuse if
+        reusable is true and the connection is still open."""
+        self.lock.acquire()
+        try:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+            if connection is not None:
+                if reusable and not self.closed and \
+                        getattr(connection, 'sock', None) is not None:
+                    self.idle.setdefault(key, []).append((time.time(), connection))
+                else:
+                    connection.close()
+            if time.time() - self.last_eviction > 1:
+                self.evict_idle()
+            self.returned.notifyAll()
+        finally:
+            self.lock.release()
+
+    def evict_idle(self):
+        # Called with self.lock held
+        deadline = time.time() - self.idle_timeout
+        for key, idle in self.idle.items():
+            while idle and idle[0][0] <= deadline:
+                idle.pop(0)[1].close()
+                self.counters['evicted'] += 1
+            if not idle:
+                del self.idle[key]
+        self.last_eviction = time.time()
+
+    def close(self):
+        """Close the idle connections and stop keeping new ones"""
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for idle in self.idle.values():
+                for checked_in, connection in idle:
+                    connection.close()
+            self.idle = {}
+            self.returned.notifyAll()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return checkout counters, reuse ratio and pool sizes"""
+        self.lock.acquire()
+        try:
+            stats = self.counters.copy()
+            stats['idle'] = sum([len(idle) for idle in self.idle.values()])
+            stats['busy'] = sum(self.busy.values())
+            stats['hosts'] = len(dict.fromkeys(self.idle.keys() + self.busy.keys()))
+        finally:
+            self.lock.release()
+        if stats['checkouts']:
+            stats['reuse_ratio'] = float(stats['reused']) / stats['checkouts']
+        else:
+            stats['reuse_ratio'] = 0.0
+        return stats
+
+def is_healthy(connection):
+    """False if an idle connection was closed by the server, or has data
+    waiting that no request asked for"""
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        return False
+    if not hasattr(sock, 'fileno'):
+        return True
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
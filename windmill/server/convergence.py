@@ -186,6 +186,8 @@ class RPCMethods(object):
         self._logger = logging.getLogger('jsonrpc_methods_instance')
         self._test_resolution_suite = test_resolution_suite
         self._command_resolution_suite = command_resolution_suite
+        # The WindmillHTTPServer, set by make_windmill_server
+        self._httpd = None
         
     def start_suite(self, suite_name):
         self._test_resolution_suite.start_suite(suite_name)
@@ -269,6 +271,22 @@ class RPCMethods(object):
                 self.add_command(test)
         return 200
 
+    def server_stats(self):
+        """Worker, write, admission and routing counters and latency
+        histograms of the windmill HTTP server"""
+        return self._httpd.server_stats()
+
+    def latency_stats(self, reset=False):
+        """Phase latency histograms per namespace and upstream host"""
+        stats = self._httpd.latency_stats()
+        if reset:
+            self._httpd.latency.reset()
+        return stats
+
+    def recent_requests(self, count=100):
+        """Access log entries of the last count requests, oldest first"""
+        return self._httpd.recent_requests(count)
+
     def clear_queue(self):
         """Clear the server queue"""
         self._queue.queue = []
@@ -321,6 +339,8 @@ class JSONRPCMethods(RPCMethods):
     def set_test_url(self, url):
         windmill.settings['FORWARDING_TEST_URL'] = url
         windmill.server.proxy.clearForwardingRegistry()
+        if self._httpd is not None and self._httpd.workers is not None:
+            self._httpd.workers.set_test_url(url)
         return 200
         
     def restart_test_run(self, tests):
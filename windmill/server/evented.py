@@ -0,0 +1,319 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Event loop server engine.
+
+    A single thread accepts connections and waits on all of them with poll()
+    (select() where poll isn't available). Bytes are read without blocking
+    until a whole request is buffered, then the connection is handed to the
+    worker pool, where the regular WindmillHTTPRequestHandler dispatches it to
+    the namespace applications or the proxy. Once the response is written the
+    connection goes back to the loop, so idle keep-alive connections and
+    browsers between polls don't hold a thread.
+
+    CONNECT tunnels need blocking TLS and stay on their worker until closed.
+"""
+
+import socket
+import select
+import errno
+import time
+import Queue
+import logging
+
+from https import WindmillHTTPServer, WindmillHTTPRequestHandler
+import timing
+
+logger = logging.getLogger(__name__)
+
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class EventedRequestHandler(WindmillHTTPRequestHandler):
+    """Handle one request already buffered by the event loop"""
+
+    def __init__(self, request, client_address, server, data='', queued_at=None):
+        self.data = data
+        self.leftover = ''
+        self.keep_connection = False
+        WindmillHTTPRequestHandler.__init__(self, request, client_address,
+                                            server, queued_at)
+
+    def setup(self):
+        WindmillHTTPRequestHandler.setup(self)
+        # Serve what the loop already read before touching the socket
+        self.rfile._rbuf.write(self.data)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while self.tunnel is not None and not self.close_connection:
+            self.handle_one_request()
+        self.keep_connection = not self.close_connection and \
+                               self.tunnel is None
+
+    def finish(self):
+        if self.keep_connection:
+            # Pipelined requests the handler read ahead go back to the loop
+            self.leftover = self.rfile._rbuf.getvalue()
+        WindmillHTTPRequestHandler.finish(self)
+
+class EventedConnection(object):
+    """A client connection waiting in the event loop"""
+
+    max_head = 65536
+
+    def __init__(self, sock, client_address, data=''):
+        self.sock = sock
+        self.client_address = client_address
+        self.buffer = data
+        self.last_active = time.time()
+        # When the buffered request started waiting for a worker
+        self.queued_at = None
+
+    def request_ready(self, max_body):
+        """True once a request head, and its body if it is small, is buffered.
+
+        Large, chunked or malformed requests are handed off as soon as the
+        head is in, the handler reads the rest from the socket.
+        """
+        end = self.buffer.find('\r\n\r\n')
+        if end == -1:
+            return len(self.buffer) > self.max_head
+        length = 0
+        for line in self.buffer[:end].split('\r\n')[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    return True
+            elif name == 'transfer-encoding':
+                return True
+        if length > max_body:
+            return True
+        return len(self.buffer) >= end + 4 + length
+
+class _Poller(object):
+    """Readability polling with poll() or, failing that, select()"""
+
+    def __init__(self):
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        else:
+            self._poll = None
+        self.fds = set()
+
+    def register(self, fd):
+        self.fds.add(fd)
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+        if self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            if self._poll is not None:
+                return [fd for fd, event in self._poll.poll(timeout * 1000)]
+            return select.select(list(self.fds), [], [], timeout)[0]
+        except (select.error, IOError), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+def _wakeup_pair():
+    """Return a connected pair of sockets used to interrupt poll()"""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    writer.connect(listener.getsockname())
+    reader = listener.accept()[0]
+    listener.close()
+    return reader, writer
+
+class WindmillEventedHTTPServer(WindmillHTTPServer):
+    """WindmillHTTPServer that waits on connections from a single event loop
+    and uses the worker pool only to run requests"""
+
+    # Request bodies up to this size are buffered by the loop
+    max_buffered_body = 65536
+    poll_interval = 1
+
+    def __init__(self, *args, **kwargs):
+        WindmillHTTPServer.__init__(self, *args, **kwargs)
+        self.connections = {}
+        self.pending = []
+        self.returned = Queue.Queue()
+        self.poller = _Poller()
+        # Listening sockets by descriptor, the server's own and add_listener's
+        self.listening = {}
+        self._wake_reader, self._wake_writer = _wakeup_pair()
+        self._wake_reader.setblocking(0)
+
+    def start(self):
+        self.ready = True
+        self._listen(self.socket)
+        wake_fd = self._wake_reader.fileno()
+        self.poller.register(wake_fd)
+        while self.ready:
+            for fd in self.poller.poll(self.poll_interval):
+                if fd in self.listening:
+                    self._accept(self.listening[fd])
+                elif fd == wake_fd:
+                    self._drain_wakeups()
+                elif fd in self.connections:
+                    self._read(self.connections[fd])
+            self._resume_returned()
+            self._dispatch_pending()
+            self._close_idle()
+        for conn in self.connections.values() + self.pending:
+            self._close(conn)
+        self.server_close()
+
+    def add_listener(self, sock):
+        """Also serve connections accepted on sock, a listening socket"""
+        self.listeners.append(sock)
+        self._listen(sock)
+        self.wake()
+
+    def _listen(self, sock):
+        sock.setblocking(0)
+        fd = sock.fileno()
+        self.listening[fd] = sock
+        self.poller.register(fd)
+
+    def stop_accepting(self):
+        self.wake()
+
+    def wake(self):
+        """Interrupt poll() from another thread"""
+        try:
+            self._wake_writer.send('x')
+        except socket.error:
+            pass
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, client_address = listener.accept()
+            except socket.error, e:
+                if e.args[0] not in _would_block:
+                    logger.debug('accept failed: %s' % (e,))
+                return
+            if not client_address:
+                # Unix sockets have no peer address, the client is local
+                client_address = ('127.0.0.1', 0)
+            if not self.verify_request(sock, client_address):
+                self.shutdown_request(sock)
+                continue
+            self._watch(EventedConnection(sock, client_address))
+
+    def _watch(self, conn):
+        conn.sock.setblocking(0)
+        conn.last_active = time.time()
+        fd = conn.sock.fileno()
+        self.connections[fd] = conn
+        self.poller.register(fd)
+
+    def _unwatch(self, conn):
+        fd = conn.sock.fileno()
+        if fd in self.connections:
+            del self.connections[fd]
+            self.poller.unregister(fd)
+
+    def _close(self, conn):
+        self._unwatch(conn)
+        self.shutdown_request(conn.sock)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in _would_block:
+                return
+            data = ''
+        if not data:
+            self._close(conn)
+            return
+        conn.buffer += data
+        conn.last_active = time.time()
+        if conn.request_ready(self.max_buffered_body):
+            self._unwatch(conn)
+            conn.queued_at = timing.now()
+            self.pending.append(conn)
+
+    def _dispatch_pending(self):
+        while self.pending:
+            conn = self.pending[0]
+            if not self.pool.submit(self.serve_connection, conn, block=False):
+                # Every worker is busy and the backlog is full, try again
+                # on the next loop iteration
+                return
+            self.pending.pop(0)
+
+    def _resume_returned(self):
+        while True:
+            try:
+                conn = self.returned.get_nowait()
+            except Queue.Empty:
+                return
+            if conn.request_ready(self.max_buffered_body):
+                conn.queued_at = timing.now()
+                self.pending.append(conn)
+            else:
+                self._watch(conn)
+
+    def _close_idle(self):
+        if not self.keepalive_timeout:
+            return
+        deadline = time.time() - self.keepalive_timeout
+        for conn in self.connections.values():
+            if conn.last_active < deadline:
+                self._close(conn)
+
+    def serve_connection(self, conn):
+        """Run the buffered request on a worker, then give the connection
+        back to the loop if it can be kept alive."""
+        try:
+            handler = self.RequestHandlerClass(conn.sock, conn.client_address,
+                                               self, conn.buffer, conn.queued_at)
+        except:
+            self.handle_error(conn.sock, conn.client_address)
+            self.shutdown_request(conn.sock)
+            return
+        if not handler.keep_connection or not self.ready:
+            self.shutdown_request(conn.sock)
+            return
+        self.returned.put(EventedConnection(conn.sock, conn.client_address,
+                                            handler.leftover))
+        self.wake()
+
+    def connection_stats(self):
+        """Return the number of connections held by the loop"""
+        return {'idle': len(self.connections), 'pending': len(self.pending),
+                'returning': self.returned.qsize()}
@@ -0,0 +1,258 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    File serving for the directories windmill mounts.
+
+    FileServerApplication hands the open file to the server through
+    wsgi.file_wrapper. The request handler then sends it with sendfile()
+    when it can, instead of reading the file in to Python strings.
+
+    Small files can be kept in a StaticCache shared by the mounts. Every
+    file gets an ETag so browsers revalidating with If-None-Match get a
+    304 without the file being read at all.
+"""
+
+import os
+import stat
+import logging
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    # python 2.4
+    from md5 import new as md5
+
+import windmill
+
+from wsgi_fileserver import WSGIFileServerApplication, FileResponse
+
+logger = logging.getLogger(__name__)
+
+# os.sendfile is python 3.3+, the pysendfile package provides the same
+# call for older pythons (the sendfile extra in setup.py)
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+missing_sendfile_logged = False
+
+def missing_sendfile():
+    """Log, the first time a file is served only, that files are copied
+    through Python for want of sendfile"""
+    global missing_sendfile_logged
+    if not missing_sendfile_logged:
+        missing_sendfile_logged = True
+        logger.info('sendfile() is not available, files are read in to '
+                    'Python to be served. Install pysendfile to avoid it.')
+
+class FileWrapper(object):
+    """wsgi.file_wrapper, iterates filelike in blocks of blksize bytes"""
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        read = self.filelike.read
+        blksize = self.blksize
+        data = read(blksize)
+        while data:
+            yield data
+            data = read(blksize)
+
+    def fileno(self):
+        """File descriptor of the wrapped file, None if it has none"""
+        if hasattr(self.filelike, 'fileno'):
+            try:
+                return self.filelike.fileno()
+            except (IOError, ValueError):
+                pass
+        return None
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+def etag_matches(if_none_match, etag):
+    """True if the If-None-Match header value lists etag"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+class CacheEntry(object):
+    def __init__(self, mtime, size, data):
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.etag = '"%s"' % md5(data).hexdigest()
+        self.used = 0
+
+class StaticCache(object):
+    """In memory copies of small static files.
+
+    Entries are checked against the file's mtime and size on every lookup.
+    Once the cached files add up to more than budget bytes the least
+    recently used ones are dropped. Files over max_file_size aren't cached.
+    """
+
+    def __init__(self, budget=32*1024*1024, max_file_size=1024*1024):
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.entries = {}
+        self.size = 0
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, st):
+        """Return the entry for path if it matches stat result st"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(path)
+            if entry is None or entry.mtime != st.st_mtime or \
+                    entry.size != st.st_size:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tick += 1
+            entry.used = self.tick
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, path, st, data):
+        """Cache data read from path, st is the stat taken before reading"""
+        entry = CacheEntry(st.st_mtime, st.st_size, data)
+        if len(data) != st.st_size or len(data) > self.max_file_size:
+            # Changed while we read it, or too big to keep
+            return entry
+        self.lock.acquire()
+        try:
+            old = self.entries.get(path)
+            if old is not None:
+                self.size -= old.size
+            self.tick += 1
+            entry.used = self.tick
+            self.entries[path] = entry
+            self.size += entry.size
+            if self.size > self.budget:
+                self.evict()
+        finally:
+            self.lock.release()
+        return entry
+
+    def evict(self):
+        # Called with self.lock held
+        entries = [(entry.used, path) for path, entry in self.entries.items()]
+        entries.sort()
+        for used, path in entries:
+            if self.size <= self.budget:
+                break
+            self.size -= self.entries.pop(path).size
+            self.evictions += 1
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'files': len(self.entries), 'bytes': self.size,
+                    'budget': self.budget, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+        finally:
+            self.lock.release()
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def shared_cache():
+    """The StaticCache used by windmill's own mounts, sized by the
+    SERVER_STATIC_CACHE_SIZE setting. None when that is 0."""
+    global _shared_cache
+    _shared_cache_lock.acquire()
+    try:
+        if _shared_cache is None and windmill.settings['SERVER_STATIC_CACHE_SIZE']:
+            _shared_cache = StaticCache(windmill.settings['SERVER_STATIC_CACHE_SIZE'])
+        return _shared_cache
+    finally:
+        _shared_cache_lock.release()
+
+class FileServerApplication(WSGIFileServerApplication):
+    """WSGIFileServerApplication returning files through wsgi.file_wrapper,
+    with ETags and an optional StaticCache"""
+
+    blksize = 65536
+
+    def __init__(self, root_path, mount_point=None, cache=None):
+        WSGIFileServerApplication.__init__(self, root_path, mount_point)
+        self.cache = cache
+
+    def handler(self, environ, start_response):
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            filename = self.file_path(environ['PATH_INFO'])
+            try:
+                st = os.stat(filename)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                return self.serve_file(environ, start_response, filename, st)
+        result = WSGIFileServerApplication.handler(self, environ, start_response)
+        if isinstance(result, FileResponse) and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](result.f, self.blksize)
+        return result
+
+    def file_path(self, path):
+        if self.mount_point is not None:
+            path = path.split(self.mount_point, 1)[-1]
+        return os.path.join(self.path, path.lstrip('/'))
+
+    def serve_file(self, environ, start_response, filename, st):
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(filename, st)
+            if entry is None and st.st_size <= self.cache.max_file_size:
+                f = open(filename, 'rb')
+                try:
+                    entry = self.cache.put(filename, st, f.read())
+                finally:
+                    f.close()
+        if entry is not None:
+            etag = entry.etag
+        else:
+            etag = '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+
+        headers = [('Cache-Control','no-cache'), ('Pragma','no-cache'),
+                   ('ETag', etag)]
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            start_response('304 Not Modified', headers)
+            return []
+        headers.append(('Content-Type', self.guess_content_type(environ['PATH_INFO'])))
+        if entry is not None:
+            headers.append(('Content-Length', str(len(entry.data))))
+            start_response('200 OK', headers)
+            return [entry.data]
+
+        f = open(filename, 'rb')
+        headers.append(('Content-Length', str(st.st_size)))
+        start_response('200 OK', headers)
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](f, self.blksize)
+        return FileWrapper(f, self.blksize)
@@ -45,6 +45,11 @@ class ForwardManager(object):
     def __init__(self, base_url):
         self.forwarded = {} # Maps str->tuple(str,str) forwarded URL-> original scheme, netloc
         self.static = {} # Maps str->tuple(str,str)
+        self.learned = {} # Maps tuple(scheme,netloc,path prefix)->ParseResult of the host that answered
+        self.set_base_url(base_url)
+
+    def set_base_url(self, base_url):
+        """ Forward to base_url's domain from now on """
         parsed_url = urlparse(base_url)
         self.base_url = "%s://%s" % (parsed_url.scheme, parsed_url.netloc)
         self.cookies = {parsed_url.netloc: {}}
@@ -129,6 +134,38 @@ class ForwardManager(object):
                       if not host in exclude)
         return result
 
+    def path_prefixes(self, url):
+        """ Path prefixes of url to learn hosts by, longest first. A file
+            at the root says nothing about the rest of the site, so only
+            its own path is used. """
+        scheme, netloc = normalize(url.scheme, url.netloc)
+        path = url.path or '/'
+        prefixes = [path]
+        while path.rfind('/') > 0:
+            path = path[:path.rfind('/')]
+            prefixes.append(path + '/')
+        return [(scheme, netloc, prefix) for prefix in prefixes]
+
+    def learned_host(self, url):
+        """ Return the known host that last answered for the longest path
+            prefix of url, or None """
+        for prefix in self.path_prefixes(url):
+            host = self.learned.get(prefix)
+            if host is not None:
+                return host
+        return None
+
+    def learn_host(self, url, host):
+        """ Remember that host answered for url's directory """
+        prefixes = self.path_prefixes(url)
+        self.learned[prefixes[min(len(prefixes) - 1, 1)]] = host
+
+    def forget_host(self, url):
+        """ Forget the host learned for url """
+        for prefix in self.path_prefixes(url):
+            if self.learned.pop(prefix, None) is not None:
+                return
+
     def forward_to(self, url, host):
         forwarded_url = "%s://%s%s" % (host.scheme, host.netloc, url.path)
         if url.query:
@@ -198,8 +235,11 @@ class ForwardManager(object):
         if len(environ['HTTP_COOKIE']) == 0:
             del environ['HTTP_COOKIE']
 
-    def clear(self):
+    def clear(self, base_url=None):
         self.forwarded = {}
+        self.learned = {}
+        if base_url is not None:
+            self.set_base_url(base_url)
         
 
 if __name__ == '__main__':
@@ -395,6 +435,21 @@ if __name__ == '__main__':
             mgr = ForwardManager('http://testurl/path/')
             self.assertTrue(len(mgr.known_hosts()) == 0)
 
+        def testLearnedHosts(self):
+            mgr = ForwardManager('http://testurl/')
+            mgr.learn_host(urlparse('http://testurl/static/js/app.js'), self.aUrl)
+            self.assertEquals(self.aUrl, mgr.learned_host(urlparse('http://testurl:80/static/js/lib.js')))
+            self.assertEquals(self.aUrl, mgr.learned_host(urlparse('http://testurl/static/js/lib/x.js')))
+            self.assertEquals(None, mgr.learned_host(urlparse('http://testurl/static/app.css')))
+            self.assertEquals(None, mgr.learned_host(urlparse('https://testurl/static/js/app.js')))
+            mgr.learn_host(urlparse('http://testurl/favicon.ico'), self.cUrl)
+            self.assertEquals(self.cUrl, mgr.learned_host(urlparse('http://testurl/favicon.ico')))
+            self.assertEquals(None, mgr.learned_host(urlparse('http://testurl/index.html')))
+            mgr.forget_host(urlparse('http://testurl/static/js/lib.js'))
+            self.assertEquals(None, mgr.learned_host(urlparse('http://testurl/static/js/app.js')))
+            mgr.clear()
+            self.assertEquals(None, mgr.learned_host(urlparse('http://testurl/favicon.ico')))
+
         def testParseCookies(self):
             headers = [('server', ' '), ('cache-control', ' no-cache'),
                        ('content-encoding', ' gzip'),
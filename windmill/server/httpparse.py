@@ -0,0 +1,253 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Single pass HTTP request parser.
+
+    Replaces the mimetools.Message based header parsing done by
+    BaseHTTPRequestHandler. Header lines are read once and the CGI style
+    keys for the WSGI environ are built while reading, so the handler
+    doesn't need to split and upper-case every header a second time.
+"""
+
+import tempfile
+from cStringIO import StringIO
+
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+class RequestError(Exception):
+    """Malformed request, code is the HTTP status to answer with"""
+    def __init__(self, code, message=None):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+def parse_request_line(requestline):
+    """Split a request line in to (command, path, version, version_number)"""
+    words = requestline.split()
+    if len(words) == 3:
+        command, path, version = words
+        if version[:5] != 'HTTP/':
+            raise RequestError(400, "Bad request version (%r)" % version)
+        try:
+            major, minor = version[5:].split('.')
+            version_number = int(major), int(minor)
+        except ValueError:
+            raise RequestError(400, "Bad request version (%r)" % version)
+        if version_number >= (2, 0):
+            raise RequestError(505, "Invalid HTTP Version (%s)" % version[5:])
+        return command, path, version, version_number
+    elif len(words) == 2:
+        command, path = words
+        if command != 'GET':
+            raise RequestError(400, "Bad HTTP/0.9 request type (%r)" % command)
+        return command, path, 'HTTP/0.9', (0, 9)
+    elif not words:
+        raise RequestError(400, "Empty request line")
+    raise RequestError(400, "Bad request syntax (%r)" % requestline)
+
+# Headers that get CGI names without the HTTP_ prefix
+_cgi_names = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}
+
+class Headers(object):
+    """Request headers read by read_headers.
+
+    Supports the parts of the mimetools.Message interface the handler uses.
+    Lookups are case insensitive, repeated headers are joined with commas.
+    environ holds the same headers under their WSGI environ keys.
+    """
+
+    def __init__(self):
+        self.dict = {}
+        self.environ = {}
+
+    def add(self, name, value):
+        key = name.lower()
+        if key in self.dict:
+            self.dict[key] += ',' + value
+        else:
+            self.dict[key] = value
+        cgi_name = _cgi_names.get(key)
+        if cgi_name is not None:
+            self.environ[cgi_name] = value
+            return
+        cgi_name = 'HTTP_' + name.upper().replace('-', '_')
+        if cgi_name in self.environ:
+            self.environ[cgi_name] += ',' + value
+        else:
+            self.environ[cgi_name] = value
+
+    def extend(self, name, value):
+        """Append a continuation line to the last value of header name"""
+        key = name.lower()
+        self.dict[key] += ' ' + value
+        cgi_name = _cgi_names.get(key, 'HTTP_' + name.upper().replace('-', '_'))
+        self.environ[cgi_name] += ' ' + value
+
+    def get(self, name, default=None):
+        return self.dict.get(name.lower(), default)
+
+    getheader = get
+
+    def __getitem__(self, name):
+        return self.dict[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self.dict
+
+    has_key = __contains__
+
+    def keys(self):
+        return self.dict.keys()
+
+    def items(self):
+        return self.dict.items()
+
+    def typeheader(self):
+        return self.dict.get('content-type')
+    typeheader = property(typeheader)
+
+def read_headers(rfile):
+    """Read header lines from rfile up to and including the blank line"""
+    headers = Headers()
+    lookup = headers.dict
+    environ = headers.environ
+    readline = rfile.readline
+    name = None
+    count = 0
+    while True:
+        line = readline(MAX_LINE + 1)
+        if len(line) > MAX_LINE:
+            raise RequestError(400, "Header line too long")
+        if line in ('\r\n', '\n', ''):
+            break
+        if line[0] in ' \t':
+            # Continuation of the previous header
+            if name is not None:
+                headers.extend(name, line.strip())
+            continue
+        count += 1
+        if count > MAX_HEADERS:
+            raise RequestError(400, "Too many headers")
+        sep = line.find(':')
+        if sep == -1:
+            name = None
+            continue
+        name = line[:sep].strip()
+        value = line[sep+1:].strip()
+        key = name.lower()
+        if key in lookup or key in _cgi_names:
+            headers.add(name, value)
+        else:
+            # Common case, first occurrence of an ordinary header
+            lookup[key] = value
+            environ['HTTP_' + key.upper().replace('-', '_')] = value
+    return headers
+
+class BoundedInput(object):
+    """wsgi.input reading at most length bytes of the request body from
+    rfile, so applications can't read in to the next request and the
+    body doesn't have to be buffered up front."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readlines(self, hint=None):
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            line = self.readline()
+        return lines
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def drain(self, limit):
+        """Discard the unread part of the body if it's no bigger than limit.
+        Returns False when the rest was too big to bother reading."""
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(min(self.remaining, 65536)):
+                break
+        return True
+
+def read_chunked(rfile, spool_size, blocksize=65536):
+    """Decode a chunked request body from rfile, trailers included.
+
+    Returns the body as a rewound file and its length. Bodies larger than
+    spool_size bytes are written to a temporary file instead of memory.
+    """
+    body = StringIO()
+    spooled = False
+    length = 0
+    while True:
+        line = rfile.readline(MAX_LINE + 1)
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestError(400, "Bad chunk size")
+        if size < 0:
+            raise RequestError(400, "Bad chunk size")
+        if not size:
+            break
+        while size > 0:
+            data = rfile.read(min(size, blocksize))
+            if not data:
+                raise RequestError(400, "Incomplete chunked body")
+            if not spooled and length + len(data) > spool_size:
+                spool = tempfile.TemporaryFile()
+                spool.write(body.getvalue())
+                body = spool
+                spooled = True
+            body.write(data)
+            size -= len(data)
+            length += len(data)
+        if rfile.readline(MAX_LINE + 1) not in ('\r\n', '\n'):
+            raise RequestError(400, "Bad chunk end")
+    # Trailers, up to the empty line ending the body
+    while True:
+        line = rfile.readline(MAX_LINE + 1)
+        if line in ('\r\n', '\n'):
+            break
+        if not line:
+            raise RequestError(400, "Incomplete chunked body")
+    body.seek(0)
+    return body, length
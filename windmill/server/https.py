@@ -21,14 +21,24 @@
     and WindmillProxyApplication that are drop-in replacements for the standard
     non-ssl-enabled ones.
 """
+import os
 import time
+import errno
 import socket
 import select
 import urllib
+import threading
 import SocketServer
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from StringIO import StringIO
-from proxy import WindmillProxyApplication
+from proxy import WindmillProxyApplication, UpstreamConnection
+from threadpool import WorkerPool
+from router import NamespaceRouter
+from admission import AdmissionGate, client_key
+import httpparse
+import fileserver
+import timing
+import accesslog
 from httplib import HTTPConnection, HTTPException
 import traceback
 import sys
@@ -47,6 +57,30 @@ try:
     import ssl # python 2.6
     _ssl_wrap_socket = ssl.wrap_socket
     _socket_create_connection = socket.create_connection
+
+    if hasattr(ssl, 'SSLContext'):
+        # python 2.7.9, sessions are cached per context
+        def _ssl_server_context(certfile):
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            try:
+                # Tunnel certificates carry the 1024 bit key of
+                # sslcerts/master.key, which OpenSSL 1.1 and later refuse
+                # at their default security level
+                context.set_ciphers('DEFAULT:@SECLEVEL=1')
+            except ssl.SSLError:
+                # No security levels in this OpenSSL
+                pass
+            context.load_cert_chain(certfile)
+            return context
+
+        def _ssl_wrap_server_socket(sock, context):
+            return context.wrap_socket(sock, server_side=True)
+    else:
+        def _ssl_server_context(certfile):
+            return certfile
+
+        def _ssl_wrap_server_socket(sock, certfile):
+            return _ssl_wrap_socket(sock, server_side=True, certfile=certfile)
 except ImportError:
     # python 2.5
     if windmill.has_ssl:
@@ -108,6 +142,24 @@ except ImportError:
             ssl_sock.set_connect_state()
         return BetterFakeSocket(sock, ssl_sock)
 
+    def _ssl_server_context(certfile):
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.use_privatekey_file(certfile)
+        try:
+            ctx.use_certificate_file(certfile)
+        except: pass
+        ctx.set_verify(SSL.VERIFY_NONE, _ssl_verify_peer)
+        # Let browsers resume sessions on new connections
+        ctx.set_session_id('windmill')
+        if hasattr(ctx, 'set_session_cache_mode'):
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        return ctx
+
+    def _ssl_wrap_server_socket(sock, ctx):
+        ssl_sock = SSL.Connection(ctx, sock)
+        ssl_sock.set_accept_state()
+        return BetterFakeSocket(sock, ssl_sock)
+
     def _socket_create_connection(address, timeout=None):
         if timeout is None:
             timeout = socket.getdefaulttimeout()
@@ -120,13 +172,108 @@ except ImportError:
 
 
 class WindmillHTTPRequestHandler(SocketServer.ThreadingMixIn, BaseHTTPRequestHandler):
-    def __init__(self, request, client_address, server):
+    protocol_version = 'HTTP/1.1'
+    # Seconds between looks at the worker pool while a kept-alive
+    # connection waits for its next request
+    keepalive_poll_interval = .25
+
+    def __init__(self, request, client_address, server, queued_at=None):
+        # When the connection was handed to the worker pool
+        self.queued_at = queued_at
+        self.parse_started = self.parsed_at = None
         self.headers_set = []
         self.headers_sent = []
-        self.header_buffer = ''
+        self.header_buffer = []
+        self.reset_output()
+        self.tunnel = None
+        # Request line of the request being served, None between requests
+        self.in_request = None
+        # Idle connections are dropped once a read blocks this long
+        self.timeout = server.keepalive_timeout
         BaseHTTPRequestHandler.__init__(self, request, client_address,
                                              server)
 
+    def handle_one_request(self):
+        # Forget the previous response on this connection first, or
+        # end_headers would hold back send_error's status line and headers
+        self.headers_set = []
+        self.headers_sent = []
+        self.header_buffer = []
+        self.reset_output()
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def handle(self):
+        """Serve requests until the connection is closed or stays idle"""
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait for the next request on a kept-alive connection.
+
+        Returns False if none came within the keep-alive timeout, or as
+        soon as other connections are queued for a worker: an idle
+        connection gives its worker up rather than keep them waiting.
+        """
+        if self.rfile._rbuf.tell():
+            return True
+        pending = getattr(self.connection, 'pending', None)
+        if pending is not None and pending():
+            return True
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            if self.server.pool.saturated():
+                return False
+            wait = self.keepalive_poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            try:
+                if select.select([self.connection], [], [], wait)[0]:
+                    return True
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    return False
+
+    def parse_request(self):
+        """Parse the request line and headers in a single pass and decide
+        if the connection can persist."""
+        self.parse_started = timing.now()
+        self.command = None  # set in case of error on the first line
+        self.request_version = self.default_request_version
+        self.close_connection = 1
+        self.requestline = self.raw_requestline.rstrip('\r\n')
+        try:
+            command, path, version, version_number = \
+                httpparse.parse_request_line(self.requestline)
+            self.request_version = version
+            self.headers = httpparse.read_headers(self.rfile)
+        except httpparse.RequestError, e:
+            if self.requestline:
+                self.send_error(e.code, e.message)
+            return False
+        self.command, self.path = command, path
+        self.parsed_at = timing.now()
+
+        if not self.server.keepalive:
+            return True
+        if version_number >= (1, 1):
+            self.close_connection = 0
+        conntype = self.headers.get('Connection')
+        if conntype is None:
+            # Browsers talking to a proxy send Proxy-Connection instead
+            conntype = self.headers.get('Proxy-Connection', '')
+        conntype = conntype.lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif conntype == 'keep-alive':
+            self.close_connection = 0
+        return True
+
     def _sock_connect_to(self, netloc, soc):
         """Parse netloc string and establish connection on socket."""
         host_port = netloc.split(':', 1)
@@ -143,82 +290,230 @@ class WindmillHTTPRequestHandler(SocketServer.ThreadingMixIn, BaseHTTPRequestHan
         return True
 
     def do_CONNECT(self):
-        """ Handle CONNECT commands.  Just set up SSL and restart. """
-        request = None
+        """ Handle CONNECT commands.  Set up SSL on the connection and keep
+            serving requests from the tunnel. """
+        self.close_connection = 1
         try:
+            self.log_request(200)
+            self.wfile.write(self.protocol_version +
+                             ' 200 Connection established\r\n')
+            self.wfile.write('Proxy-agent: %s\r\n' % self.version_string())
+            self.wfile.write('\r\n')
+            if not windmill.has_ssl:
+                return
+            connstream = _ssl_wrap_server_socket(self.connection,
+                                   self.server.get_ssl_context(self.path))
+        except socket.error, err:
+            logger.debug("%s while serving (%s) %s" % (err,
+                                              self.command, self.path))
+            return
+
+        # Requests inside the tunnel only carry a path
+        self.base_path = 'https://' + self.path
+        if self.base_path.endswith(':443'):
+            self.base_path = self.base_path[:-4]
+        self.tunnel = self.connection = connstream
+        self.rfile = socket._fileobject(self.connection, 'rb', self.rbufsize)
+        self.wfile = socket._fileobject(self.connection, 'wb', self.wbufsize)
+        # And here we go again! handle() keeps reading requests, now
+        # from the tunnel, for as long as the browser keeps it alive.
+        self.close_connection = 0
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.track_handler(self)
+
+    def finish(self):
+        self.server.untrack_handler(self)
+        BaseHTTPRequestHandler.finish(self)
+        if self.tunnel is not None:
             try:
-                self.log_request(200)
-                self.wfile.write(self.protocol_version +
-                                 ' 200 Connection established\r\n')
-                self.wfile.write('Proxy-agent: %s\r\n' % self.version_string())
-                self.wfile.write('\r\n')
-                if not windmill.has_ssl:
-                    return
-                request = self.connection
-                connstream = _ssl_wrap_socket(self.connection,
-                               server_side=True,
-                               certfile=self.server.cert_creator[self.path].certfile)
-
-                self.request = connstream
-                # And here we go again!
-                # setup...
-                self.base_path = 'https://' + self.path
-                if self.base_path.endswith(':443'):
-                    self.base_path = self.base_path[:-4]
-                self.connection = self.request
-                self.rfile = socket._fileobject(self.connection, 'rb', self.rbufsize)
-                self.wfile = socket._fileobject(self.connection, 'wb', self.wbufsize)
-                # handle...
-                try:
-                    self.handle()
-                    self.finish()
-                finally:
-                    sys.exc_traceback = None    # Help garbage collection
-                    #self.connection.close()
-            except socket.error, err:
-                logger.debug("%s while serving (%s) %s" % (err,
-                                                  self.command, self.path))
-        finally:
-            if request is not None:
-                request.close()
+                self.tunnel.close()
+            except socket.error:
+                pass
+            self.tunnel = None
 
     def handle_ALL(self):
-        namespaces = self.server.namespaces
-        proxy = self.server.proxy
-        found = None
-        path = self.path.split('?', 1)[0]
-        for key in namespaces:
-            if path.find('/'+key+'/') is not -1:
-                found = key
-                environ = self.get_environ()
-                result = namespaces[found](environ, self.start_response)
-                break
-        else:
-            found = None
+        self.in_request = self.requestline
+        try:
+            self.serve_request()
+        finally:
+            self.in_request = None
+        if self.server.draining:
+            self.close_connection = 1
+
+    def serve_request(self):
+        if self.server.draining:
+            # Tell the browser not to send anything else on this connection
+            self.close_connection = 1
+        found, application = self.server.namespaces.match(
+                                            self.path.split('?', 1)[0])
+        gate = None
+        if application is None:
+            application = self.server.proxy
+            gate = self.server.proxy_gate
+        try:
             environ = self.get_environ()
-            result = proxy(environ, self.start_response)
-        # == Old blocking code ==
-        # out = list(result)
-        # # send data back to browser
-        # try:
-        #     self.write(''.join(out))
-        # except socket.error, err:
-        #     logger.debug("%s while serving (%s) %s" % (err,
-        #                                       self.command, self.path))
-        
-        # == New non-blocking code ==
+        except httpparse.RequestError, e:
+            # Where the body ends is unknown, the connection can't be reused
+            self.close_connection = 1
+            self.send_error(e.code, e.message)
+            return
+        # The proxy adds its upstream timings to this
+        upstream = environ['windmill.timing'] = {}
+        if gate is not None and \
+                not gate.enter(client_key(self.client_address[0], environ)):
+            gate = None
+            application = self.server.overloaded
+
         try:
-            for out in result:
-                self.write(out)
-        except socket.error, err:
-            logger.debug("%s while serving (%s) %s" % (err,self.command, self.path))
-        
+            called_at = timing.now()
+            result = application(environ, self.start_response)
+            returned_at = timing.now()
+            try:
+                self.finish_response(result)
+            except socket.error, err:
+                logger.debug("%s while serving (%s) %s" % (err,self.command, self.path))
+                self.close_connection = 1
+            finished_at = timing.now()
+        finally:
+            if gate is not None:
+                gate.leave()
+
+        phases = {'parse': self.parsed_at - self.parse_started,
+                  'dispatch': called_at - self.parsed_at,
+                  'app': returned_at - called_at,
+                  'send': finished_at - returned_at,
+                  'total': finished_at - self.parse_started}
+        if self.queued_at is not None:
+            # Only the first request on a connection waited for a worker
+            phases['queue'] = self.parse_started - self.queued_at
+            self.queued_at = None
+        self.server.latency.record('namespaces', found or 'proxy', phases)
+        upstream_host = ''
+        if 'host' in upstream:
+            upstream_host = upstream.pop('host')
+            upstream['relay'] = finished_at - returned_at
+            upstream['total'] = finished_at - upstream.pop('started')
+            self.server.latency.record('upstreams', upstream_host, upstream)
+        if self.server.access_log is not None:
+            # Formatted later by the access log's writer thread
+            status = ''
+            if self.headers_sent:
+                status = self.headers_sent[0]
+            self.server.access_log.record((time.time(), self.client_address[0],
+                    self.command, environ['reconstructed_url'], found or 'proxy',
+                    status, self.output_bytes, phases['total'] * 1000,
+                    upstream_host))
+
         self.wfile.flush()
-        self.connection.close()
+        if not environ['wsgi.input'].drain(self.server.drain_limit):
+            # Reading the rest of a large unused body costs more than
+            # opening a new connection
+            self.close_connection = 1
 
     do_GET = handle_ALL
     do_POST = handle_ALL
 
+    def shutdown_connection(self):
+        """Shut the client socket down, which makes a handler waiting for
+        the next request, or writing a response, give up."""
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def finish_response(self, result):
+        """Send the application's response iterable to the browser."""
+        try:
+            if isinstance(result, (list, tuple)) and self.headers_set and \
+                    not self.headers_sent:
+                self.set_content_length(result)
+            if isinstance(result, fileserver.FileWrapper) and \
+                    self.send_file(result):
+                return
+            streaming = hasattr(result, 'data_ready')
+            for out in result:
+                self.write(out)
+                if streaming and not result.data_ready():
+                    # Don't sit on what we have while the application
+                    # waits for more, long polls need it now
+                    self.flush_output()
+            if not self.headers_sent:
+                # Empty response body, headers still need to go out
+                self.write('')
+            self.flush_output(last=True)
+            self.server.count_response(self.output_writes, self.output_bytes)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def send_file(self, wrapper):
+        """Send a wsgi.file_wrapper response with sendfile().
+
+        Returns False, having sent nothing, when sendfile can't be used:
+        no sendfile on this platform, TLS tunnels, files without a
+        descriptor or responses without a Content-Length.
+        """
+        if fileserver.sendfile is None:
+            fileserver.missing_sendfile()
+            return False
+        if self.tunnel is not None or self.headers_sent or \
+                not self.headers_set or self.command == 'HEAD':
+            return False
+        in_fd = wrapper.fileno()
+        if in_fd is None:
+            return False
+        length = None
+        for header in self.headers_set[1]:
+            if header[0].lower() == 'content-length':
+                length = int(header[1])
+        if length is None:
+            return False
+
+        self.write('')
+        self.flush_output()
+        self.wfile.flush()
+        out_fd = self.connection.fileno()
+        offset = wrapper.filelike.tell()
+        remaining = length
+        while remaining > 0:
+            try:
+                sent = fileserver.sendfile(out_fd, in_fd, offset, remaining)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise socket.error(*e.args)
+                # The socket has a timeout so its descriptor is non
+                # blocking, wait until it can take more
+                if not select.select([], [out_fd], [], self.timeout)[1]:
+                    raise socket.error(errno.ETIMEDOUT, 'sendfile timed out')
+                continue
+            if sent == 0:
+                # The file is shorter than its Content-Length said
+                self.close_connection = 1
+                break
+            offset += sent
+            remaining -= sent
+            self.output_writes += 1
+            self.output_bytes += sent
+        self.server.count_response(self.output_writes, self.output_bytes)
+        return True
+
+    def set_content_length(self, result):
+        """Add a Content-Length header for responses with a known length."""
+        status, response_headers = self.headers_set
+        if status[:3] in ('204', '304'):
+            return
+        for header in response_headers:
+            if header[0].lower() == 'content-length':
+                return
+        length = 0
+        for data in result:
+            length += len(data)
+        response_headers.append(('Content-Length', str(length)))
+
     def start_response(self, status, headers, exc_info=None):
         if exc_info:
             try:
@@ -230,160 +525,374 @@ class WindmillHTTPRequestHandler(SocketServer.ThreadingMixIn, BaseHTTPRequestHan
             raise AssertionError("Headers already set!")
 
         self.headers_set[:] = [status, headers]
+        return self.write
+
+    def send_stored_headers(self):
+        """Send the status and headers given to start_response."""
         status, response_headers = self.headers_sent[:] = self.headers_set
         code, message = status.split(' ', 1)
         self.send_response(int(code), message)
-        
-        self.send_headers(response_headers)
-        
-        return self.write
+        self.send_headers(self.frame_response(int(code), response_headers))
+
+    def frame_response(self, code, response_headers):
+        """Decide if the connection can stay open after this response and
+        add the matching Connection header."""
+        bodyless = (self.command == 'HEAD' or code < 200 or
+                    code in (204, 304))
+        has_length = False
+        for header in response_headers:
+            if header[0].lower() == 'content-length':
+                has_length = True
+        response_headers = [header for header in response_headers
+                            if header[0].lower() not in ('connection',
+                                                         'transfer-encoding')]
+        if not bodyless and not has_length:
+            if self.request_version == 'HTTP/1.1':
+                # Stream the body in chunks, the connection can stay open
+                self.chunked = True
+                response_headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # Without a length the browser can only find the end of
+                # the body by the connection closing
+                self.close_connection = 1
+        if self.close_connection:
+            response_headers.append(('Connection', 'close'))
+        elif self.request_version == 'HTTP/1.0':
+            response_headers.append(('Connection', 'keep-alive'))
+        return response_headers
         
     def send_headers(self, response_headers):
         for header in response_headers:
             self.send_header(header[0], header[1])
+        self.end_headers()
+
+    def end_headers(self):
+        """Queue the buffered status line and headers.
+
+        Headers of a WSGI response wait for the first body chunk so both
+        go out in one write, anything else (send_error) is sent right away.
+        """
+        self.header_buffer.append('\r\n')
+        self.output.append(''.join(self.header_buffer))
+        self.header_buffer = []
+        if self.headers_sent:
+            return
         try:
-            self.wfile.write(self.header_buffer+'\r\n')
+            self.flush_output()
         except socket.error, e:
             if len(e.args) is 2 and e.args[0] is 32:
                 logger.debug("Client severed connection prematurely.")
+                self.close_connection = 1
             else:
                 raise e
 
     def send_header(self, keyword, value):
         """Send a MIME header."""
         if self.request_version != 'HTTP/0.9':
-            self.header_buffer += "%s: %s\r\n" % (keyword, value)
+            self.header_buffer.append("%s: %s\r\n" % (keyword, value))
         if keyword.lower() == 'connection':
             if value.lower() == 'close':
                 self.close_connection = 1
             elif value.lower() == 'keep-alive':
                 self.close_connection = 0
 
+    def send_error(self, code, message=None):
+        BaseHTTPRequestHandler.send_error(self, code, message)
+        # Requests turned away before serve_request, or in it before the
+        # application ran, don't reach its access log record
+        if self.server.access_log is not None:
+            url = ''
+            duration = 0.0
+            if self.command:
+                url = self.path
+                duration = (timing.now() - self.parse_started) * 1000
+            self.server.access_log.record((time.time(), self.client_address[0],
+                    self.command or '', url, '', '%d' % code, 0, duration, ''))
+
     def send_response(self, code, message=None):
         """Send the response header and log the response code.
             Also send two standard headers with the server software
             version and the current date.
             """
-        self.log_request(code)
+        # Served requests are logged by the server's access log, errors
+        # by send_error
         if message is None:
             if code in self.responses:
                 message = self.responses[code][0]
             else:
                 message = ''
         if self.request_version != 'HTTP/0.9':
-            self.header_buffer += "%s %d %s\r\n" % (self.protocol_version, code, message)
+            self.header_buffer.append("%s %d %s\r\n" % (self.protocol_version, code, message))
             # print (self.protocol_version, code, message)
             
 
     def write(self, data):
         if not self.headers_set:
             raise AssertionError("write() before start_response()")
+        elif not self.headers_sent:
+            # Before the first output, send the stored headers
+            self.send_stored_headers()
 
-        
-        # elif not self.headers_sent:
-        #     # Before the first output, send the stored headers
-        #     status, response_headers = self.headers_sent[:] = self.headers_set
-        #     code, message = status.split(' ', 1)
-        #     self.send_response(int(code), message)
-        #     for header in response_headers:
-        #         self.send_header(header[0], header[1])
+        if data:
+            self.body.append(data)
+            self.output_size += len(data)
+            if self.output_size >= self.server.write_buffer_size:
+                self.flush_output()
+
+    def reset_output(self):
+        self.output = []
+        self.body = []
+        self.output_size = 0
+        self.output_writes = 0
+        self.output_bytes = 0
+        self.chunked = False
 
+    def flush_output(self, last=False):
+        """Send everything queued by write() and end_headers() in one go.
+
+        Chunked responses get the queued body as a single chunk, and the
+        last chunk too when last is True.
+        """
+        if self.body:
+            if self.chunked:
+                self.output.append('%x\r\n' % self.output_size)
+                self.output.extend(self.body)
+                self.output.append('\r\n')
+            else:
+                self.output.extend(self.body)
+            self.body = []
+        if last and self.chunked:
+            self.output.append('0\r\n\r\n')
+        if not self.output:
+            return
+        if len(self.output) == 1:
+            data = self.output[0]
+        else:
+            data = ''.join(self.output)
+        self.output = []
+        self.output_size = 0
         self.wfile.write(data)
-        # self.wfile.flush()
+        self.output_writes += 1
+        self.output_bytes += len(data)
 
     def get_environ(self):
         """ Put together a wsgi environment """
         if hasattr(self, 'base_path'):
             self.path = self.base_path + self.path
         env = self.server.base_environ.copy()
+        env.update(self.headers.environ)
         env['SERVER_PROTOCOL'] = self.request_version
         env['REQUEST_METHOD'] = self.command
         if '?' in self.path:
             path, query = self.path.split('?', 1)
         else:
             path, query = self.path,''
-        env['PATH_INFO'] = urllib.unquote(path)
+        if '%' in path:
+            path = urllib.unquote(path)
+        env['PATH_INFO'] = path
         env['QUERY_STRING'] = query
-
-        host = self.address_string()
-        if host != self.client_address[0]:
-            env['REMOTE_HOST'] = host
         env['REMOTE_ADDR'] = self.client_address[0]
 
-        if self.headers.typeheader is not None:
-            env['CONTENT_TYPE'] = self.headers.typeheader
-
-        length = self.headers.getheader('content-length')
-        if length:
-            env['CONTENT_LENGTH'] = length
-
-        for header in self.headers.headers:
-            key, value = header.split(':', 1)
-            key = key.replace('-', '_').upper()
-            value = value.strip()
-            if key in env:
-                continue  # skip content length, type,etc.
-            if 'HTTP_' + key in env:
-                env['HTTP_' + key] += ',' + value
-            else:
-                env['HTTP_' + key] = value
-        env['wsgi.url_scheme'] = urlparse(self.path).scheme
+        if self.path.startswith('/'):
+            env['wsgi.url_scheme'] = ''
+        else:
+            env['wsgi.url_scheme'] = urlparse(self.path).scheme
 
-        clen = self.headers.getheader('content-length')
-        if clen is not None and int(clen) > 0:
-            i = self.rfile.read(int(clen))
-            env['wsgi.input'] = StringIO(i)
+        clen = env['CONTENT_LENGTH']
+        try:
+            clen = int(clen)
+        except ValueError:
+            clen = 0
+        if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # Applications and the servers behind the proxy get the body
+            # with its length, like any other
+            body, clen = httpparse.read_chunked(self.rfile,
+                                                self.server.chunked_spool_size)
+            del env['HTTP_TRANSFER_ENCODING']
+            env['CONTENT_LENGTH'] = str(clen)
+            env['wsgi.input'] = httpparse.BoundedInput(body, clen)
         else:
-            env['wsgi.input'] = self.rfile
+            env['wsgi.input'] = httpparse.BoundedInput(self.rfile, max(clen, 0))
+        env['wsgi.file_wrapper'] = fileserver.FileWrapper
         self.reconstruct_url(env)
         return env
 
     def reconstruct_url(self, environ):
-        """ This can be done much faster and in a tidier way."""
-        url = environ['wsgi.url_scheme']+'://'
-        if environ.get('HTTP_HOST'):
-            url += environ['HTTP_HOST']
-        else:
-            url += environ['SERVER_NAME']
-            if environ['wsgi.url_scheme'] == 'https':
-                if environ['SERVER_PORT'] != '443':
-                    url += ':' + environ['SERVER_PORT']
-            else:
-                if environ['SERVER_PORT'] != '80':
-                    url += ':' + environ['SERVER_PORT']
-        url += environ.get('SCRIPT_NAME','')
+        """Proxy requests carry the full url, others only the path."""
         if '://' in self.path:
             url = self.path
         else:
-            url += self.path
+            scheme = environ['wsgi.url_scheme']
+            host = environ.get('HTTP_HOST')
+            if not host:
+                host = environ['SERVER_NAME']
+                port = environ['SERVER_PORT']
+                if (scheme == 'https' and port != '443') or \
+                   (scheme != 'https' and port != '80'):
+                    host += ':' + port
+            url = scheme + '://' + host + environ.get('SCRIPT_NAME','') + \
+                  self.path
         environ['reconstructed_url'] = url
         return url
 
     def log_message(self, format, *args):
-        logger.debug(format % args)
+        logger.debug(format, *args)
+
+def bind_unix_socket(path, backlog):
+    """Return a socket listening on the Unix socket path, only accessible
+    to this user. A missing directory is created only accessible to this
+    user too. A socket file nothing listens on any more is replaced."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   'Another server listens on %s' % path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Created 0600, other users never get a chance to connect
+        umask = os.umask(0177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
 
 class WindmillHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
-    def __init__(self, address, handler, cert_creator, apps, proxy):
+    # Worker pool defaults, overridden by the SERVER_* settings
+    max_workers = 128
+    min_workers = 4
+    worker_backlog = 256
+    worker_idle_timeout = 30
+    request_queue_size = 128
+    keepalive = True
+    keepalive_timeout = 15
+    # Largest unread request body discarded to keep a connection alive
+    drain_limit = 65536
+    # Chunked request bodies are decoded in memory up to this size, in a
+    # temporary file beyond
+    chunked_spool_size = 1024 * 1024
+    # Small response chunks are joined until this many bytes are queued
+    write_buffer_size = 16384
+    # Seconds stop() waits for requests in flight before cutting them off
+    shutdown_timeout = 5
+    # Bind with SO_REUSEPORT so worker processes can share the port
+    reuse_port = False
+    # WorkerProcesses forked to serve the same port, see processes.py
+    workers = None
+    # Requests kept in the access log's ring buffer, 0 turns it off
+    access_log_size = 1000
+    # Proxied requests allowed upstream at once, and how many more may
+    # wait for a turn. Waiting requests hold a worker, so the queue is
+    # capped to keep rpc_reserved_workers free for windmill's namespaces.
+    proxy_concurrency = 48
+    proxy_queue_size = 64
+    proxy_queue_timeout = 10
+    proxy_retry_after = 2
+    rpc_reserved_workers = 16
+
+    def __init__(self, address, handler, cert_creator, apps, proxy,
+                 max_workers=None, min_workers=None, worker_backlog=None,
+                 worker_idle_timeout=None, keepalive=None,
+                 keepalive_timeout=None, write_buffer_size=None,
+                 shutdown_timeout=None, reuse_port=None,
+                 proxy_concurrency=None, proxy_queue_size=None,
+                 proxy_queue_timeout=None, proxy_retry_after=None,
+                 rpc_reserved_workers=None, access_log_size=None):
         # all we want from this method is to register a pem file
         # $ openssl req -x509 -nodes -days 365 -newkey rsa:1024
         #                     -keyout mycert.pem -out mycert.pem
         self.cert_creator = cert_creator
-        self.namespaces = dict([ (arg.ns, arg) for arg in apps ])
+        self.namespaces = NamespaceRouter(apps)
         self.proxy = proxy
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if min_workers is not None:
+            self.min_workers = min_workers
+        if worker_backlog is not None:
+            self.worker_backlog = worker_backlog
+        if worker_idle_timeout is not None:
+            self.worker_idle_timeout = worker_idle_timeout
+        if keepalive is not None:
+            self.keepalive = keepalive
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if write_buffer_size is not None:
+            self.write_buffer_size = write_buffer_size
+        if shutdown_timeout is not None:
+            self.shutdown_timeout = shutdown_timeout
+        if reuse_port is not None:
+            self.reuse_port = reuse_port
+        if proxy_concurrency is not None:
+            self.proxy_concurrency = proxy_concurrency
+        if proxy_queue_size is not None:
+            self.proxy_queue_size = proxy_queue_size
+        if proxy_queue_timeout is not None:
+            self.proxy_queue_timeout = proxy_queue_timeout
+        if proxy_retry_after is not None:
+            self.proxy_retry_after = proxy_retry_after
+        if rpc_reserved_workers is not None:
+            self.rpc_reserved_workers = rpc_reserved_workers
+        if access_log_size is not None:
+            self.access_log_size = access_log_size
+        self.proxy_gate = None
+        if self.proxy_concurrency:
+            lane = max(1, self.max_workers - self.rpc_reserved_workers)
+            concurrency = min(self.proxy_concurrency, lane)
+            self.proxy_gate = AdmissionGate(concurrency,
+                                  min(self.proxy_queue_size, lane - concurrency),
+                                  self.proxy_queue_timeout)
+        self.listeners = []
+        self.handlers = {}
+        self.handlers_lock = threading.Lock()
+        self.draining = False
+        self.write_counters = {'responses': 0, 'writes': 0, 'bytes': 0}
+        self.write_counters_lock = threading.Lock()
+        self.latency = timing.LatencyStats()
+        self.access_log = None
+        if self.access_log_size:
+            self.access_log = accesslog.AccessLog(self.access_log_size)
 
         # the rest is the same
         HTTPServer.__init__(self, address, handler)
         self.setup_environ()
-        self.threads = []
+        self.ssl_contexts = {}
+        self.ssl_contexts_lock = threading.Lock()
+        self.pool = WorkerPool(max_workers=self.max_workers,
+                               min_workers=self.min_workers,
+                               backlog=self.worker_backlog,
+                               idle_timeout=self.worker_idle_timeout)
         
     daemon_threads = True
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
     def setup_environ(self):
         # Set up base environment
         env = self.base_environ = {}
         env['SERVER_NAME'] = self.server_name
         env['GATEWAY_INTERFACE'] = 'CGI/1.1'
-        env['SERVER_PORT'] = self.server_port
+        env['SERVER_PORT'] = str(self.server_port)
         env['REMOTE_HOST'] = ''
         env['CONTENT_LENGTH'] = ''
         env['SCRIPT_NAME'] = ''
@@ -391,7 +900,7 @@ class WindmillHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
     ready = False
 
     def start(self):
-        WindmillHTTPServer.ready = True
+        self.ready = True
         #self.current_request = 0
         while self.ready:
             #self.current_request += 1
@@ -399,42 +908,284 @@ class WindmillHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
         # print "Attempting to shut down..."
         self.server_close()
 
+    def get_ssl_context(self, host):
+        """Return the SSL context used for tunnels to host.
+
+        The context is shared by every tunnel to the same host so the
+        browser can resume its TLS session instead of doing a full handshake
+        on each new connection.
+        """
+        host = host.split(':')[0]
+        self.ssl_contexts_lock.acquire()
+        try:
+            if host not in self.ssl_contexts:
+                certfile = self.cert_creator[host].certfile
+                self.ssl_contexts[host] = _ssl_server_context(certfile)
+            return self.ssl_contexts[host]
+        finally:
+            self.ssl_contexts_lock.release()
+
     def server_close(self):
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
         except socket.error, e:
-            if len(e.args) is 2 and e.args[0] is 57:
+            if len(e.args) is 2 and e.args[0] in (57, errno.ENOTCONN):
                 logger.debug("Server was killed, socket didn't shutdown perfectly.")
             else:
                 raise e
+        self.socket.close()
+
+    def add_listener(self, sock):
+        """Also serve connections accepted on sock, a listening socket"""
+        self.listeners.append(sock)
+        thread = threading.Thread(target=self.serve_listener, args=(sock,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def serve_listener(self, sock):
+        while not self.draining:
+            try:
+                request, client_address = sock.accept()
+            except socket.error, e:
+                if self.draining:
+                    break
+                if e.args[0] == errno.EINTR:
+                    continue
+                logger.debug('accept failed: %s' % (e,))
+                break
+            if not client_address:
+                # Unix sockets have no peer address, the client is local
+                client_address = ('127.0.0.1', 0)
+            self.process_request(request, client_address)
 
     def add_namespace(self, name, application):
         """Add an application to a specific url namespace in windmill"""
         self.namespaces[name] = application
+        if self.workers is not None:
+            self.workers.add_namespace(name)
+
+    def stop(self, timeout=None):
+        """Stop the server, letting requests in flight finish.
 
-    def stop(self):
-        self.xmlrpc_methods_instance.stop_runserver()
-        WindmillHTTPServer.ready = False
+        Stops accepting connections, closes keep-alive connections waiting
+        for their next request and waits up to timeout seconds
+        (shutdown_timeout by default) for the other requests to complete.
+        Connections of requests still running after that are shut down.
+        Returns the request lines of the requests that were cut off.
+        """
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        deadline = time.time() + timeout
+        if getattr(self, 'xmlrpc_methods_instance', None) is not None:
+            self.xmlrpc_methods_instance.stop_runserver()
+        self.draining = True
+        self.ready = False
+        if self.workers is not None:
+            # Worker processes drain their own connections meanwhile
+            self.workers.stop()
+        self.stop_accepting()
+        for sock in self.listeners:
+            path = None
+            if getattr(socket, 'AF_UNIX', None) == sock.family:
+                path = sock.getsockname()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+            if path:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        busy = self.close_idle_handlers()
+        while busy and time.time() < deadline:
+            time.sleep(.01)
+            busy = self.close_idle_handlers()
+        cut_off = []
+        for handler in busy:
+            cut_off.append(handler.in_request)
+            handler.shutdown_connection()
+        if cut_off:
+            logger.warning('Cut off %d requests at shutdown: %s' %
+                           (len(cut_off), ', '.join(cut_off)))
+
+        self.pool.stop()
+        self.pool.join(max(deadline - time.time(), 0))
+        if self.workers is not None:
+            self.workers.join(max(deadline - time.time(), 0) + 1)
+        if self.access_log is not None:
+            self.access_log.stop(max(deadline - time.time(), 0) + 1)
+        if getattr(self.proxy, 'pool', None) is not None:
+            self.proxy.pool.close()
+        return cut_off
+
+    def stop_accepting(self):
+        """Wake the accept loop up so it sees ready is False"""
+        if self.reuse_port:
+            # A connection to the port could go to another process
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            return
         try:
             s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
             s.connect(self.server_address)
             s.send("\n")
+            s.close()
         except socket.error:
             pass
-            
-        for t in [t for t in self.threads if t.isAlive()]:
-            t.terminate()
-        
+
+    def track_handler(self, handler):
+        self.handlers_lock.acquire()
+        self.handlers[handler] = None
+        self.handlers_lock.release()
+
+    def untrack_handler(self, handler):
+        self.handlers_lock.acquire()
+        self.handlers.pop(handler, None)
+        self.handlers_lock.release()
+
+    def close_idle_handlers(self):
+        """Shut down connections waiting for a request, return the
+        handlers still serving one"""
+        busy = []
+        self.handlers_lock.acquire()
+        try:
+            for handler in self.handlers:
+                if handler.in_request is None:
+                    handler.shutdown_connection()
+                else:
+                    busy.append(handler)
+        finally:
+            self.handlers_lock.release()
+        return busy
+
     def process_request(self, request, client_address):
-        """Start a new thread to process the request."""
-        import thread2
-        t = thread2.Thread(target = self.process_request_thread,
-                           args = (request, client_address))
-        if self.daemon_threads:
-            t.setDaemon (1)
-        t.start()
-        self.threads.append(t)    
+        """Hand the request to the worker pool, waiting for a free slot
+        in the backlog if every worker is busy."""
+        if not self.pool.submit(self.process_request_thread, request,
+                                client_address, timing.now()):
+            # The pool has been stopped
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address, queued_at=None):
+        try:
+            self.finish_request(request, client_address, queued_at)
+            self.shutdown_request(request)
+        except:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address, queued_at=None):
+        self.RequestHandlerClass(request, client_address, self,
+                                 queued_at=queued_at)
+
+    def recent_requests(self, count=100):
+        """Return the access log entries of the last count requests"""
+        if self.access_log is None:
+            return []
+        return self.access_log.recent(count)
+
+    def latency_stats(self):
+        """Return phase latency histograms for each namespace ('proxy'
+        for proxied requests) and each upstream host"""
+        return self.latency.stats()
+
+    def server_stats(self):
+        """Return all the server's counters and latency histograms"""
+        return {'latency': self.latency_stats(),
+                'routes': self.route_stats(),
+                'workers': self.worker_stats(),
+                'writes': self.write_stats(),
+                'admission': self.admission_stats(),
+                'upstream_pool': self.upstream_pool_stats(),
+                'upstream_hosts': self.upstream_host_stats(),
+                'dns': self.dns_stats(),
+                'proxy_cache': self.proxy_cache_stats(),
+                'proxy_archive': self.proxy_archive_stats()}
+
+    def route_stats(self):
+        """Return hit counters for each namespace and for proxied requests"""
+        return self.namespaces.stats()
+
+    def upstream_pool_stats(self):
+        """Return reuse and wait counters for the proxy's upstream
+        connection pool"""
+        if getattr(self.proxy, 'pool', None) is None:
+            return {}
+        return self.proxy.pool.stats()
+
+    def upstream_host_stats(self):
+        """Return failure counters and the upstream hosts proxied requests
+        fail right away for"""
+        if getattr(self.proxy, 'breaker', None) is None:
+            return {}
+        return self.proxy.breaker.stats()
+
+    def dns_stats(self):
+        """Return hit and miss counters for the proxy's DNS cache"""
+        if getattr(self.proxy, 'resolver', None) is None:
+            return {}
+        return self.proxy.resolver.stats()
+
+    def proxy_cache_stats(self):
+        """Return hit, revalidation and miss counters for the proxy's
+        cache"""
+        if getattr(self.proxy, 'cache', None) is None:
+            return {}
+        return self.proxy.cache.stats()
+
+    def proxy_archive_stats(self):
+        """Return the mode and recorded, replayed and missed counters of
+        the proxy's archive"""
+        if getattr(self.proxy, 'archive', None) is None:
+            return {}
+        return self.proxy.archive.stats()
+
+    def admission_stats(self):
+        """Return active, waiting and shed counters for proxied requests"""
+        if self.proxy_gate is None:
+            return {}
+        return self.proxy_gate.stats()
+
+    def overloaded(self, environ, start_response):
+        """Answer a proxied request that couldn't get a turn upstream"""
+        body = '<H1>Windmill proxy overloaded, retry shortly</H1>'
+        start_response('503 Service Unavailable',
+                       [('Content-Type', 'text/html'),
+                        ('Content-Length', str(len(body))),
+                        ('Retry-After', str(self.proxy_retry_after))])
+        return [body]
+
+    def worker_stats(self):
+        """Return pool size and queue depth counters for the worker pool"""
+        return self.pool.stats()
+
+    def count_response(self, writes, nbytes):
+        self.write_counters_lock.acquire()
+        try:
+            self.write_counters['responses'] += 1
+            self.write_counters['writes'] += writes
+            self.write_counters['bytes'] += nbytes
+        finally:
+            self.write_counters_lock.release()
+
+    def write_stats(self):
+        """Return response, socket write and byte counts for sent responses"""
+        self.write_counters_lock.acquire()
+        try:
+            stats = self.write_counters.copy()
+        finally:
+            self.write_counters_lock.release()
+        if stats['responses']:
+            stats['writes_per_response'] = \
+                float(stats['writes']) / stats['responses']
+        else:
+            stats['writes_per_response'] = 0.0
+        return stats
 
     def handle_error(self, request, client_address):
         try:
@@ -452,7 +1203,7 @@ class WindmillHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
             print "Traceback cannot be printed, probably do to a thread safety issue."
         print '-' * 40
 
-class WindmillConnection(HTTPConnection):
+class WindmillConnection(UpstreamConnection):
     """ Decide on the run if we should do HTTP or HTTPS """
     def __init__(self, scheme, host, port=None, strict=None):
         self.scheme = scheme
@@ -468,14 +1219,18 @@ class WindmillConnection(HTTPConnection):
     def connect(self):
         "Connect to a host on a given (SSL) port."
         if self.scheme == 'http':
-            HTTPConnection.connect(self)
+            UpstreamConnection.connect(self)
             return
 
-        sock = _socket_create_connection((self.host, self.port), self.timeout)
+        if self.resolver is None:
+            sock = _socket_create_connection((self.host, self.port), self.timeout)
+        else:
+            sock = self.resolver.create_connection((self.host, self.port),
+                                                   self.timeout)
         self.sock = _ssl_wrap_socket(sock, self.key_file, self.cert_file)
        
 class WindmillHTTPSProxyApplication(WindmillProxyApplication):
     ConnectionClass = WindmillConnection
 
-    def get_connection(self, url):
+    def new_connection(self, url):
         return self.ConnectionClass(url.scheme, url.netloc)
@@ -0,0 +1,397 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Multi-process server mode.
+
+    Worker processes forked by make_windmill_server bind the same port as
+    the parent with SO_REUSEPORT, so the kernel spreads browser connections
+    over all of them. Workers serve proxy traffic and the static
+    /windmill-serv/ files themselves. Every other namespace is forwarded to
+    the parent over a loopback listener, which keeps the controller queue
+    and the resolution suites in a single process.
+
+    Each worker reads the names of namespaces added later in the parent,
+    changes of the test url and changes to the proxy's forwarding state
+    from a pipe. A process changing the forwarding state of a test run
+    (a url forwarded to the test domain, the form of a forwarded POST, the
+    host learned for a path) hands the change to the parent, which writes
+    it to every worker's pipe before the browser is answered. Workers read
+    their pipe before proxying a request, so whichever process the
+    browser's next request lands on knows of the change. When the parent
+    closes the pipe, or dies, the worker drains its connections and exits.
+
+    Every worker also listens on a loopback port of its own, where the
+    parent collects the worker's counters for windmill-stats.
+"""
+
+import os
+import time
+import errno
+import select
+import signal
+import socket
+import httplib
+import threading
+import logging
+
+try:
+    import json as simplejson
+except ImportError:
+    import simplejson
+
+import windmill
+from proxy import is_hop_by_hop, clearForwardingRegistry, \
+     apply_forwarding_change, release_connection, StreamingResponse
+from proxycache import to_json, from_json
+from connpool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+def can_fork_workers():
+    """True if this platform has fork() and SO_REUSEPORT"""
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+def loopback_listener(backlog=16):
+    """A socket listening on a free loopback port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(backlog)
+    return sock
+
+class ForwardingApplication(object):
+    """Send requests for a namespace owned by the parent process to it"""
+
+    def __init__(self, ns, parent):
+        self.ns = ns
+        self.parent = parent
+
+    def __call__(self, environ, start_response):
+        headers = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+                if not is_hop_by_hop(name):
+                    headers[name] = value
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        body = None
+        if environ.get('CONTENT_LENGTH'):
+            headers['Content-Length'] = environ['CONTENT_LENGTH']
+            body = environ['wsgi.input']
+
+        try:
+            response = self.parent.request(environ['REQUEST_METHOD'],
+                                           environ['reconstructed_url'],
+                                           body, headers)
+        except (socket.error, httplib.HTTPException), e:
+            logger.exception('Could not forward %s to the parent process' %
+                             environ['reconstructed_url'])
+            start_response('502 Bad Gateway', [('Content-Type', 'text/html')])
+            return ['<H1>Windmill server process unavailable:</H1><pre>%s</pre>' % (e,)]
+
+        response_headers = [(name.title(), value) for name, value
+                            in response.getheaders() if not is_hop_by_hop(name)]
+        start_response('%d %s' % (response.status, response.reason),
+                       response_headers)
+        # Relayed as it comes, long polls and streamed responses included
+        return StreamingResponse(response,
+                                 windmill.settings['PROXY_RELAY_BUFFER_SIZE'])
+
+class ForwardingStateApplication(object):
+    """Take a change to the forwarding state from a worker process, make it
+    in this process and pass it on to every worker"""
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def __call__(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        try:
+            change = from_json(body)
+        except (ValueError, UnicodeError):
+            start_response('400 Bad Request', [('Content-Length', '0')])
+            return ['']
+        self.workers.publish(change)
+        start_response('204 No Content', [])
+        return ['']
+
+def write_all(fd, data):
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[written:]
+
+class WorkerProcesses(object):
+    """Worker processes forked from the server process"""
+
+    # Path of the namespace serving a single process's counters
+    stats_path = '/windmill-process-stats/'
+    # Path of the namespace workers send forwarding state changes to
+    state_path = '/windmill-process-state/'
+
+    def __init__(self, count):
+        self.count = count
+        self.pids = []
+        self.pipes = []
+        # Changes reach every worker in the same order
+        self.lock = threading.Lock()
+        # Loopback address of each worker's own listener
+        self.addresses = []
+
+    def start(self, serve):
+        """Fork the workers. Each calls serve(index, pipe, listener) with
+        its index, counting from 1, the read end of its pipe and a loopback
+        socket only it listens on."""
+        for index in range(1, self.count + 1):
+            read_fd, write_fd = os.pipe()
+            listener = loopback_listener()
+            pid = os.fork()
+            if pid == 0:
+                os.close(write_fd)
+                for fd in self.pipes:
+                    os.close(fd)
+                # Ctrl-C goes to the whole process group, the parent
+                # decides when workers stop
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                status = 0
+                try:
+                    serve(index, read_fd, listener)
+                except:
+                    logger.exception('Worker process %d failed' % index)
+                    status = 1
+                os._exit(status)
+            os.close(read_fd)
+            self.addresses.append(listener.getsockname())
+            listener.close()
+            self.pids.append(pid)
+            self.pipes.append(write_fd)
+
+    def send(self, kind, value):
+        self.lock.acquire()
+        try:
+            for fd in self.pipes:
+                try:
+                    write_all(fd, '%s %s\n' % (kind, value))
+                except OSError:
+                    # That worker is gone
+                    pass
+        finally:
+            self.lock.release()
+
+    def add_namespace(self, name):
+        """Have the workers forward name to the parent"""
+        self.send('namespace', name)
+
+    def set_test_url(self, url):
+        """Tell the workers FORWARDING_TEST_URL changed"""
+        if url is None:
+            url = ''
+        self.send('test_url', url)
+
+    def update(self):
+        """The forwarding state of this process is the reference, there is
+        nothing to catch up with"""
+
+    def publish(self, change):
+        """Make a change to the forwarding state in this process and in the
+        workers. Returns once it is in every worker's pipe."""
+        apply_forwarding_change(change)
+        self.send('state', to_json(list(change)))
+
+    def stats(self, reset=False):
+        """Return the server counters of each worker by pid, resetting
+        their latency histograms first if reset is True"""
+        stats = {}
+        for pid, address in zip(self.pids, self.addresses):
+            connection = httplib.HTTPConnection(*address)
+            try:
+                try:
+                    if reset:
+                        connection.request('POST', self.stats_path + 'reset')
+                    else:
+                        connection.request('GET', self.stats_path)
+                    response = connection.getresponse()
+                    stats[str(pid)] = simplejson.loads(response.read())
+                except (socket.error, httplib.HTTPException, ValueError), e:
+                    stats[str(pid)] = {'error': str(e)}
+            finally:
+                connection.close()
+        return stats
+
+    def stop(self):
+        """Close the pipes, which tells the workers to drain and exit"""
+        self.lock.acquire()
+        try:
+            for fd in self.pipes:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.pipes = []
+        finally:
+            self.lock.release()
+
+    def join(self, timeout):
+        """Wait up to timeout seconds for the workers to exit, kill the
+        ones that don't. Returns the pids that had to be killed."""
+        deadline = time.time() + timeout
+        running = list(self.pids)
+        while running and time.time() < deadline:
+            for pid in list(running):
+                try:
+                    done = os.waitpid(pid, os.WNOHANG)[0]
+                except OSError:
+                    done = pid
+                if done:
+                    running.remove(pid)
+            if running:
+                time.sleep(.01)
+        for pid in running:
+            logger.warning('Killing worker process %d' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+        return running
+
+class ParentProcess(object):
+    """The server process a worker was forked from: the pipe it sends
+    namespaces, the test url and forwarding state changes down, and pooled
+    connections to its loopback listener"""
+
+    def __init__(self, pipe, address):
+        self.pipe = pipe
+        self.address = address
+        self.httpd = None
+        self.lock = threading.Lock()
+        self.buffered = ''
+        self.closed = False
+        # The parent closes idle connections after the keep-alive timeout
+        self.pool = ConnectionPool(windmill.settings['SERVER_MAX_WORKERS'],
+                                   windmill.settings['SERVER_KEEPALIVE_TIMEOUT'] / 2.0)
+
+    def connect(self):
+        return httplib.HTTPConnection(*self.address)
+
+    def request(self, method, url, body=None, headers={}):
+        """Send a request to the parent over a pooled connection. The
+        connection goes back to the pool with release_connection() once
+        the response has been read."""
+        while True:
+            connection = self.pool.checkout('parent', self.connect)
+            connection.pool = self.pool
+            connection.pool_key = 'parent'
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException):
+                self.pool.checkin('parent', connection, False)
+                if connection.reused and not hasattr(body, 'read'):
+                    # The parent closed the idle connection as we sent
+                    # on it, try again on a new one
+                    continue
+                raise
+            response.upstream_connection = connection
+            return response
+
+    def publish(self, change):
+        """Have the parent pass a change to the forwarding state on to
+        every process. Returns once they all can see it."""
+        try:
+            response = self.request('POST', WorkerProcesses.state_path,
+                                    to_json(list(change)),
+                                    {'Content-Type': 'application/json'})
+            response.read()
+            release_connection(response)
+        except (socket.error, httplib.HTTPException), e:
+            logger.warning('Could not share a forwarding change with the '
+                           'other processes: %s' % (e,))
+
+    def update(self):
+        """Handle the messages waiting in the pipe. Returns False once the
+        parent closed it."""
+        self.lock.acquire()
+        try:
+            while not self.closed:
+                try:
+                    if not select.select([self.pipe], [], [], 0)[0]:
+                        break
+                    data = os.read(self.pipe, 65536)
+                except (select.error, OSError), e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    data = ''
+                if not data:
+                    self.closed = True
+                    os.close(self.pipe)
+                    break
+                self.buffered += data
+                while '\n' in self.buffered:
+                    line, self.buffered = self.buffered.split('\n', 1)
+                    kind, value = line.split(' ', 1)
+                    try:
+                        self.handle(kind, value)
+                    except:
+                        logger.exception('Could not handle %s from the parent '
+                                         'process' % kind)
+            return not self.closed
+        finally:
+            self.lock.release()
+
+    def handle(self, kind, value):
+        if kind == 'namespace':
+            self.httpd.add_namespace(value, ForwardingApplication(value, self))
+        elif kind == 'test_url':
+            windmill.settings['FORWARDING_TEST_URL'] = value or None
+            clearForwardingRegistry()
+        elif kind == 'state':
+            # Changes this process made come back too, making them again
+            # does nothing
+            apply_forwarding_change(from_json(value))
+
+    def follow(self):
+        """Handle messages as they come until the parent closes the pipe"""
+        while self.update():
+            try:
+                select.select([self.pipe], [], [])
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+def run_worker(httpd, parent):
+    """Serve httpd in a worker process until the parent closes its pipe"""
+    parent.httpd = httpd
+    # Proxied requests catch up with the forwarding state of the other
+    # processes first, and share the changes they make
+    httpd.proxy.shared_state = parent
+
+    def follow_parent():
+        parent.follow()
+        while not httpd.ready:
+            time.sleep(.01)
+        httpd.stop()
+        parent.pool.close()
+
+    follower = threading.Thread(target=follow_parent)
+    follower.setDaemon(True)
+    follower.start()
+    httpd.start()
+    # stop() drains the connections on the follower thread
+    follower.join()
@@ -17,13 +17,29 @@
 
 import windmill
 
-from httplib import HTTPConnection
+from httplib import HTTPConnection, HTTPException, IncompleteRead
+from cStringIO import StringIO
 import copy
 import sys
+import socket
+import select
+import errno
 import logging
+import os
 import urllib
+import cgi
+import tempfile
+import threading
+import Queue
 logger = logging.getLogger(__name__)
 from forwardmanager import ForwardManager
+import timing
+from connpool import ConnectionPool
+import proxycache
+import archive
+from breaker import HostBreaker
+from resolver import Resolver
+import fileserver
 if not sys.version.startswith('2.4'):
     from urlparse import urlparse
 else:
@@ -59,28 +75,233 @@ def is_hop_by_hop(header):
     """check if the given header is hop_by_hop"""
     return _hoppish.has_key(header.lower())
 
-class IterativeResponse(object):
-    def __init__(self, response_instance):
-        self.response_instance = response_instance
-        self.read_size = response_instance.length / 100
-                
+def release_connection(response, reusable=None):
+    """Give the connection response came on back to its pool. It is kept
+    for reuse if reusable is true, by default if the response was read
+    to the end."""
+    connection = getattr(response, 'upstream_connection', None)
+    if connection is None:
+        return
+    response.upstream_connection = None
+    if reusable is None:
+        reusable = response.isclosed()
+    connection.pool.checkin(connection.pool_key, connection, reusable)
+
+class UpstreamConnection(HTTPConnection):
+    """HTTPConnection looking its host up with resolver, the proxy's DNS
+    cache, when it has one"""
+
+    resolver = None
+
+    def connect(self):
+        if self.resolver is None:
+            HTTPConnection.connect(self)
+            return
+        self.sock = self.resolver.create_connection((self.host, self.port),
+                                                    self.timeout)
+
+class StreamingResponse(object):
+    """Relay the body of an upstream response as it arrives.
+
+    Bodies delimited by Content-Length, chunked encoding or the server
+    closing the connection are read in blocks of at most buffer_size bytes,
+    each yielded as soon as some data is there. The request handler writes
+    a block to the browser before the next one is read, so a slow browser
+    slows down reading from the server instead of filling memory, and it
+    flushes whenever data_ready() says the next block isn't in yet.
+    """
+
+    def __init__(self, response, buffer_size=65536):
+        self.response = response
+        self.buffer_size = buffer_size
+        self.fp = response.fp
+        # Reading from the socket directly returns partial blocks right
+        # away, anything else falls back to blocking reads of whole blocks
+        self.sock = getattr(self.fp, '_sock', None)
+        if not hasattr(self.fp, '_rbuf'):
+            self.sock = None
+
     def __iter__(self):
-        yield self.response_instance.read(self.read_size)
-        while self.response_instance.chunk_left is not None:
-            if self.response_instance.chunk_left < self.read_size:
-                yield self.response_instance.read()
-                self.response_instance.chunk_left = None
-            else:
-                yield self.response_instance.read(self.read_size)
-
-def get_wsgi_response(response):
-        
-    if type(response) is str:
-        return [response]
-    if response.length > 512000:
-        return IterativeResponse(response)
-    else:
-        return [response.read()]
+        response = self.response
+        if self.fp is None or response.length == 0:
+            response.close()
+            return
+        if not self.data_ready():
+            # Let the headers go out while the server takes its time
+            yield ''
+        if response.chunked:
+            body = self.read_chunked()
+        else:
+            body = self.read_length(response.length)
+        for data in body:
+            yield data
+        # Read to the end, the connection can be reused
+        response.close()
+
+    def read_some(self, size):
+        """Read up to size bytes, only waiting if none are available"""
+        if self.sock is None:
+            return self.fp.read(size)
+        buffered = self.fp._rbuf.getvalue()
+        if buffered:
+            self.fp._rbuf = StringIO()
+            self.fp._rbuf.write(buffered[size:])
+            return buffered[:size]
+        while True:
+            try:
+                return self.sock.recv(size)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def data_ready(self):
+        """True if more of the body can be read without waiting"""
+        if self.sock is None:
+            return True
+        if self.fp._rbuf.tell() or \
+                (hasattr(self.sock, 'pending') and self.sock.pending()):
+            return True
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+    def read_length(self, length):
+        # length is None for bodies ended by closing the connection
+        while length is None or length > 0:
+            size = self.buffer_size
+            if length is not None and length < size:
+                size = length
+            data = self.read_some(size)
+            if not data:
+                if length is not None:
+                    raise IncompleteRead('')
+                return
+            if length is not None:
+                length -= len(data)
+            yield data
+
+    def read_chunked(self):
+        while True:
+            line = self.fp.readline()
+            try:
+                size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                raise IncompleteRead('')
+            if not size:
+                break
+            while size > 0:
+                data = self.read_some(min(size, self.buffer_size))
+                if not data:
+                    raise IncompleteRead('')
+                size -= len(data)
+                if not size:
+                    # Read the CRLF ending the chunk before handing out its
+                    # end, so data_ready() sees if the next one is there
+                    self.fp.readline()
+                yield data
+        # Trailers, up to the empty line ending the body
+        while True:
+            line = self.fp.readline()
+            if line in ('\r\n', '\n', ''):
+                break
+
+    def close(self):
+        release_connection(self.response)
+
+def read_request_body(environ, spool_size, blocksize=65536):
+    """Read the request body from wsgi.input.
+
+    Bodies up to spool_size bytes are returned as a string, larger ones are
+    copied in blocks to a temporary file which is returned rewound so
+    httplib can stream it to the remote server.
+    """
+    length = int(environ['CONTENT_LENGTH'])
+    if length <= spool_size:
+        return environ['wsgi.input'].read(length)
+    spool = tempfile.TemporaryFile()
+    while length > 0:
+        block = environ['wsgi.input'].read(min(length, blocksize))
+        if not block:
+            break
+        spool.write(block)
+        length -= len(block)
+    spool.seek(0)
+    return spool
+
+def request_body(environ):
+    """The request body, read once and kept in environ['body'] for
+    retries. None if the request has none."""
+    if not environ.has_key('body') and environ.get('CONTENT_LENGTH'):
+        environ['body'] = read_request_body(environ,
+                                windmill.settings['PROXY_BODY_SPOOL_SIZE'])
+    body = environ.get('body')
+    if hasattr(body, 'seek'):
+        # Spooled body already read or sent to another host
+        body.seek(0)
+    return body
+
+def first_success(probe, candidates, concurrency, discard):
+    """Call probe(*candidate) for each of candidates, up to concurrency at
+    once, and return the first result that isn't None. Other results that
+    come in are passed to discard.
+    """
+    if concurrency <= 1 or len(candidates) <= 1:
+        for candidate in candidates:
+            result = probe(*candidate)
+            if result is not None:
+                return result
+        return None
+    pending = Queue.Queue()
+    for candidate in candidates:
+        pending.put(candidate)
+    results = Queue.Queue()
+    lock = threading.Lock()
+    # Set once the caller stopped waiting for results
+    done = []
+
+    def work():
+        while not done:
+            try:
+                candidate = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = probe(*candidate)
+            except:
+                logger.exception('Error probing %s', candidate[0])
+                result = None
+            lock.acquire()
+            try:
+                if not done:
+                    results.put(result)
+                    result = None
+            finally:
+                lock.release()
+            if result is not None:
+                discard(result)
+
+    for i in range(min(concurrency, len(candidates))):
+        worker = threading.Thread(target=work)
+        worker.setDaemon(True)
+        worker.start()
+    winner = None
+    for i in range(len(candidates)):
+        winner = results.get()
+        if winner is not None:
+            break
+    lock.acquire()
+    try:
+        done.append(True)
+        late = []
+        while not results.empty():
+            late.append(results.get_nowait())
+    finally:
+        lock.release()
+    for result in late:
+        if result is not None:
+            discard(result)
+    return winner
 
 def conditions_pass(e):
     for c in windmill.server.forwarding_conditions:
@@ -112,19 +333,50 @@ class WindmillProxyApplication(object):
 
     def __init__(self):
         self.fmgr = None
+        # In a multi-process server, shares the forwarding state of the
+        # test run with the other processes (see processes.py)
+        self.shared_state = None
+        self.pool = ConnectionPool(windmill.settings['PROXY_POOL_MAX_PER_HOST'],
+                                   windmill.settings['PROXY_POOL_IDLE_TIMEOUT'],
+                                   windmill.settings['PROXY_POOL_WAIT_TIMEOUT'])
+        self.resolver = Resolver(windmill.settings['PROXY_DNS_TTL'],
+                                 windmill.settings['PROXY_DNS_FAILURE_TTL'])
+        self.breaker = HostBreaker(windmill.settings['PROXY_BREAKER_THRESHOLD'],
+                                   windmill.settings['PROXY_BREAKER_COOLDOWN'])
+        self.cache = None
+        directory = windmill.settings['PROXY_CACHE_DIR']
+        if directory is True:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     'windmill-proxy-cache')
+        if directory:
+            self.cache = proxycache.shared_cache(directory,
+                            windmill.settings['PROXY_CACHE_MAX_ENTRY_SIZE'])
+        self.archive = None
+        mode = windmill.settings['PROXY_ARCHIVE_MODE']
+        if mode:
+            directory = windmill.settings['PROXY_ARCHIVE_DIR']
+            if directory is None:
+                directory = os.path.join(tempfile.gettempdir(),
+                                         'windmill-proxy-archive')
+            self.archive = archive.shared_archive(directory, mode,
+                            windmill.settings['PROXY_ARCHIVE_MATCH_QUERY'],
+                            windmill.settings['PROXY_ARCHIVE_MATCH_BODY'],
+                            windmill.settings['PROXY_ARCHIVE_IGNORE_PARAMS'])
         proxyInstances.append(self)
 
-    ConnectionClass = HTTPConnection
+    ConnectionClass = UpstreamConnection
 
     def handler(self, environ, start_response):
         """Proxy for requests to the actual http server"""
+        # Upstream phase timings for the request handler to record
+        upstream_timing = environ.get('windmill.timing', {})
         url = urlparse(environ['reconstructed_url'])
         referer = environ.get('HTTP_REFERER', None)
+        if self.shared_state is not None:
+            # Changes other processes made, the test url included
+            self.shared_state.update()
         test_url = windmill.settings['FORWARDING_TEST_URL']
-        if self.fmgr is None and windmill.settings['FORWARDING_TEST_URL'] is not None:
-            # Be lazy at creating the forward manager to give
-            # FORWARDING_TEST_URL a chance to be set
-            self.fmgr = ForwardManager(test_url)
+        self.forward_manager()
         # Once FORWARDING_TEST_URL is set we should check for cross-domain
         # forward but we must disable for localhost as redirects to localhost
         # will cause the browser to error.
@@ -139,19 +391,22 @@ class WindmillProxyApplication(object):
 
             if (self.fmgr.is_static_forwarded(url)):
                 environ = self.fmgr.forward(url, environ)
+                self.changed('forward', url.geturl())
                 url = self.fmgr.forward_map(url)
             
             elif ( url.scheme+"://"+url.netloc != test_target.scheme+"://"+test_target.netloc ):
                 # if the url's network address is not the test URL that has
                 # been set we need to return a forward
                 environ = self.fmgr.forward(url, environ)
+                self.changed('forward', url.geturl())
                 redirect_url = self.fmgr.forward_map(url).geturl()
                 if environ['REQUEST_METHOD'] == 'POST':
                     form = proxy_post_redirect_form(environ, redirect_url)
                     forward_forms[redirect_url] = form
+                    self.changed('form', redirect_url, form)
                 start_response("302 Found", [('Location', redirect_url), 
                                              ]+cache_additions)
-                logger.debug('Domain change, forwarded to ' + redirect_url)
+                logger.debug('Domain change, forwarded to %s', redirect_url)
                 return ['']
             elif url.geturl() in forward_forms:
                 response = forward_forms[url.geturl()]
@@ -159,7 +414,8 @@ class WindmillProxyApplication(object):
                 start_response("200 Ok", [('Content-Type', 'text/html',), 
                                           ('Content-Length', length,),
                                          ]+cache_additions)
-                del forward_forms[url.geturl()]
+                forward_forms.pop(url.geturl(), None)
+                self.changed('form_used', url.geturl())
                 return [response]
             elif (self.fmgr.is_forward_mapped(url)):
                 orig_url = self.fmgr.forward_unmap(url)
@@ -176,7 +432,23 @@ class WindmillProxyApplication(object):
                 environ = self.fmgr.change_environ_domain(url, orig_url, environ)
                 url = orig_url
                 self.fmgr.forward(orig_url, {}) # Take note of the forwarding
+                self.changed('forward', orig_url.geturl())
         def make_remote_connection(url, environ):
+            # Read in request body if it exists, even for a host that is
+            # down: retries on other hosts need it
+            body = request_body(environ)
+
+            if not self.breaker.allow((url.scheme, url.netloc)):
+                # Failed too often lately, don't wait on it again
+                retry_after = int(self.breaker.retry_after(
+                                        (url.scheme, url.netloc))) + 1
+                logger.debug('%s is down, not sending %s', url.netloc,
+                             url.geturl())
+                return [("502 Bad Gateway", [('Content-Type', 'text/html'),
+                                             ('Retry-After', str(retry_after))],),
+                        '<H1>%s is down:</H1><pre>Requests to it fail right '
+                        'away for another %d seconds</pre>' %
+                        (cgi.escape(url.netloc), retry_after)]
             # Create connection object
             try:
                 connection = self.get_connection(url)
@@ -186,19 +458,11 @@ class WindmillProxyApplication(object):
                 logger.exception('Could not Connect')
                 return [("501 Gateway error", [('Content-Type', 'text/html')],),
                         '<H1>Could not connect:</H1><pre>%s</pre>' % (str(e),)]
-
-            # Read in request body if it exists    
-            body = None
-            if environ.has_key('body'):
-                body = environ['body']
-            elif environ.get('CONTENT_LENGTH'):
-                length = int(environ['CONTENT_LENGTH'])
-                body = environ['wsgi.input'].read(length)
-                environ['body'] = body
+            connection.url = url
 
             # Build headers
             headers = {}
-            logger.debug('Environ ; %s' % str(environ))
+            logger.debug('Environ ; %s', environ)
             for key in environ.keys():
                 # Keys that start with HTTP_ are all headers
                 if key.startswith('HTTP_'):
@@ -216,6 +480,8 @@ class WindmillProxyApplication(object):
             # Handler headers that aren't HTTP_ in environ
             if environ.get('CONTENT_TYPE'):
                 headers['content-type'] = environ['CONTENT_TYPE']
+            if body is not None:
+                headers['content-length'] = environ['CONTENT_LENGTH']
 
             # Add our host if one isn't defined
             if not headers.has_key('host'):
@@ -224,47 +490,168 @@ class WindmillProxyApplication(object):
             # Make the remote request
             try:
                 
-                logger.debug('%s %s %s' % (environ['REQUEST_METHOD'], path,
-                                           str(headers)))
+                logger.debug('%s %s %s', environ['REQUEST_METHOD'], path,
+                             headers)
+                started_at = timing.now()
+                if connection.sock is None:
+                    connect_timeout = windmill.settings['PROXY_CONNECT_TIMEOUT']
+                    if connect_timeout is not None:
+                        connection.timeout = connect_timeout
+                    connection.connect()
+                    if connect_timeout is not None and \
+                            hasattr(connection.sock, 'settimeout'):
+                        # Only connecting is limited, responses take their time
+                        connection.sock.settimeout(socket.getdefaulttimeout())
+                connected_at = timing.now()
                 connection.request(environ['REQUEST_METHOD'], path, body=body,
                                    headers=headers)
-                connection.url = url
+                connection.sent_at = timing.now()
+                connection.timing = {'host': url.netloc, 'started': started_at,
+                                     'connect': connected_at - started_at,
+                                     'request': connection.sent_at - connected_at}
                 return connection
             except Exception, e:
+                self.pool.checkin(connection.pool_key, connection, False)
+                if connection.reused:
+                    # The server closed the idle connection as we sent
+                    # on it, try again on a new one
+                    return make_remote_connection(url, environ)
+                self.breaker.failure(connection.pool_key)
                 # We need extra exception handling in the case the server
                 # fails in mid connection, it's an edge case but I've seen it
                 return [("501 Gateway error", [('Content-Type', 'text/html')],),
                     '<H1>Could not make request:</H1><pre>%s</pre>' % (str(e),)]
 
+        def get_response(connection, environ):
+            try:
+                response = connection.getresponse()
+            except (HTTPException, socket.error):
+                self.pool.checkin(connection.pool_key, connection, False)
+                if not connection.reused:
+                    self.breaker.failure(connection.pool_key)
+                    raise
+                # Closed by the server before it read the request
+                connection = make_remote_connection(connection.url, environ)
+                if not isinstance(connection, HTTPConnection):
+                    raise
+                return get_response(connection, environ)
+            except:
+                self.pool.checkin(connection.pool_key, connection, False)
+                raise
+            self.breaker.success(connection.pool_key)
+            response.url = connection.url
+            response.upstream_connection = connection
+            connection.timing['first_byte'] = timing.now() - connection.sent_at
+            response.timing = connection.timing
+            return response
+
+        def on_host(url, host, environ):
+            # url and environ changed to make the request to host
+            orig_url = self.fmgr.forward_to(url, host)
+            new_environ = self.fmgr.change_environ_domain(
+                                    self.fmgr.forward_map(orig_url),
+                                    orig_url, environ)
+            return orig_url, new_environ
+
+        def probe(url, environ):
+            # The response from url if it succeeded, None otherwise
+            connection = make_remote_connection(url, environ)
+            if not isinstance(connection, HTTPConnection):
+                return None
+            try:
+                response = get_response(connection, environ)
+            except Exception, e:
+                logger.debug('Retry to %s failed: %s', url.geturl(), e)
+                return None
+            if response.status > 199 and response.status < 399:
+                return response
+            release_connection(response, False)
+            return None
+
         def retry_known_hosts(url, environ):
             # retry the given request against all the hosts the current session
-            # has run against
+            # has run against, at once, and take the first that succeeds
             if self.fmgr is None:
                 return
-            for host in self.fmgr.known_hosts():
-                orig_url = self.fmgr.forward_to(url, host)
-                new_environ = self.fmgr.change_environ_domain(
-                                        self.fmgr.forward_map(orig_url),
-                                        orig_url, environ)
-                connection = make_remote_connection(orig_url, new_environ)
-                if isinstance(connection, HTTPConnection):
-                    try:
-                        new_response = connection.getresponse()
-                    except:
-                        return
-                    if new_response.status > 199 and new_response.status < 399:
-                        logger.info('Retry success, ' + url.geturl() + ' to ' +
-                                    host.geturl())
-                        new_response.url = connection.url
-                        return new_response
-        connection = make_remote_connection(url, environ)
+            candidates = [on_host(url, host, environ)
+                          for host in self.fmgr.known_hosts()]
+            concurrency = windmill.settings['PROXY_RETRY_CONCURRENCY']
+            if hasattr(environ.get('body'), 'seek'):
+                # Requests can't share a spooled body
+                concurrency = 1
+            new_response = first_success(probe, candidates, concurrency,
+                                         release_connection)
+            if new_response is not None:
+                host = urlparse('%s://%s/' % (new_response.url.scheme,
+                                              new_response.url.netloc))
+                logger.info('Retry success, ' + url.geturl() + ' to ' +
+                            host.geturl())
+                # Requests for this path go straight there from now on
+                self.fmgr.learn_host(url, host)
+                self.changed('learn', url.geturl(), host.geturl())
+            return new_response
+        archive = self.archive
+        if archive is not None:
+            archive_key = archive.key(environ['REQUEST_METHOD'], url.geturl(),
+                                      environ.get('CONTENT_TYPE'),
+                                      request_body(environ))
+            if archive.mode == 'replay':
+                return self.serve_replayed(archive_key, start_response)
+
+        cache = self.cache
+        if archive is not None:
+            # Every exchange goes to the server to be recorded
+            cache = None
+        cached = None
+        # The client's request, without the validators added below
+        client_environ = environ
+        if cache is not None and not cache.usable(environ):
+            cache.count('bypassed')
+            cache = None
+        if cache is not None:
+            cached = cache.lookup(url.geturl(), environ)
+            if cached is not None:
+                cached_body = cache.open(cached)
+                if cached_body is None:
+                    cached = None
+            if cached is not None and cache.is_fresh(cached):
+                cache.count('hits')
+                return self.serve_cached(cached, cached_body, start_response)
+            if cached is not None:
+                # Ask the server if the stored response is still current
+                environ = environ.copy()
+                environ.update(cache.validators(cached))
+
+        # Read the body before on_host copies environ for other hosts, so
+        # every copy and this environ share it instead of racing for
+        # wsgi.input
+        request_body(environ)
+        response = None
+        learned = None
+        if self.fmgr is not None:
+            learned = self.fmgr.learned_host(url)
+        if learned is not None:
+            # A retry found this path on another host before
+            response = probe(*on_host(url, learned, environ))
+            if response is None:
+                self.fmgr.forget_host(url)
+                self.changed('forget', url.geturl())
+        if response is not None:
+            connection = response.upstream_connection
+        else:
+            connection = make_remote_connection(url, environ)
         # This following code is ugly.  It should be refactored in to some
         # elegant way to decide when to retry, and which URLs to retry.
         # Maybe hand that responsability to the ForwardManager?
-        if isinstance(connection, HTTPConnection):
-            response = connection.getresponse()
-            response.url = connection.url
-            
+        if response is None and isinstance(connection, HTTPConnection):
+            try:
+                response = get_response(connection, environ)
+            except (HTTPException, socket.error), e:
+                # Answered like a failed connection, retries included
+                connection = [("502 Bad Gateway",
+                               [('Content-Type', 'text/html')],),
+                    '<H1>No response:</H1><pre>%s</pre>' % (cgi.escape(str(e)),)]
+
         if environ['REQUEST_METHOD'] == 'POST':
             threshold = 399
         else:
@@ -276,33 +663,81 @@ class WindmillProxyApplication(object):
             # so we should retry
             new_response = retry_known_hosts(url, environ)
             if new_response is not None: 
+                if isinstance(connection, HTTPConnection):
+                    release_connection(response, False)
                 response = new_response
             elif not isinstance(connection, HTTPConnection):
+                if cached is not None:
+                    cached_body.close()
                 status = connection[0][0]
                 headers = connection[0][1]
                 body = connection[1]
                 for header in copy.copy(headers):
-                    if header[0].lower() == 'content-length':
-                        body.length = int(header[1].strip())
                     if header[0].lower() in cache_removal:
                         headers.remove(header)
                 start_response(status, headers+cache_additions)
-                return get_wsgi_response(body)
+                return [body]
 
         # Remove hop by hop headers
         headers = self.parse_headers(response)
         if response.status == 404:
             logger.info('Could not fullfill proxy request to ' + url.geturl())
 
+        upstream_timing.update(response.timing)
+        if cached is not None:
+            if response.status == 304:
+                response.read()
+                release_connection(response)
+                cache.refresh(url.geturl(), cached, headers)
+                cache.count('revalidated')
+                return self.serve_cached(cached, cached_body, start_response)
+            cached_body.close()
+        if cache is not None:
+            cache.count('misses')
+        stored_headers = list(headers)
+
         for header in copy.copy(headers):
-            if header[0].lower() == 'content-length':
-                response.length = int(header[1].strip())
             if header[0].lower() in cache_removal:
                 headers.remove(header)
 
-        start_response(response.status.__str__()+' '+response.reason, 
-                       headers+cache_additions)
-        return get_wsgi_response(response)
+        status = response.status.__str__()+' '+response.reason
+        start_response(status, headers+cache_additions)
+        body = StreamingResponse(response,
+                                 windmill.settings['PROXY_RELAY_BUFFER_SIZE'])
+        if archive is not None:
+            return archive.record(archive_key, status, stored_headers, body)
+        if cache is not None and \
+                cache.storable(client_environ, response.status,
+                               stored_headers):
+            return cache.store(url.geturl(), client_environ, status,
+                               stored_headers, body)
+        return body
+
+    def serve_cached(self, variant, body, start_response):
+        """Answer with a response from the cache"""
+        headers = [header for header in self.cache.headers(variant, body)
+                   if header[0].lower() not in cache_removal]
+        start_response(variant['status'], headers+cache_additions)
+        return fileserver.FileWrapper(body,
+                                      windmill.settings['PROXY_RELAY_BUFFER_SIZE'])
+
+    def serve_replayed(self, key, start_response):
+        """Answer with the response recorded for key"""
+        replayed = self.archive.replay(key)
+        if replayed is None:
+            logger.warning('Not in the proxy archive: %s', key)
+            body = '<H1>Not in the proxy archive:</H1><pre>%s</pre>' % \
+                   cgi.escape(key)
+            start_response('404 Not Found', [('Content-Type', 'text/html'),
+                                             ('Content-Length', str(len(body))),
+                                             ]+cache_additions)
+            return [body]
+        status, headers, body = replayed
+        headers = [header for header in headers
+                   if header[0].lower() not in cache_removal]
+        start_response(status, headers+cache_additions)
+        return fileserver.FileWrapper(body,
+                                      windmill.settings['PROXY_RELAY_BUFFER_SIZE'])
 
     def parse_headers(self, response):
         headers = [(x.lower(), y) for x, y in [z.split(':', 1) for z in
@@ -325,13 +760,49 @@ class WindmillProxyApplication(object):
         return headers
 
     def get_connection(self, url):
+        """Check a connection to url's host out of the pool. It goes back
+        with release_connection() once its response has been read."""
+        key = (url.scheme, url.netloc)
+        connection = self.pool.checkout(key, lambda: self.new_connection(url))
+        connection.pool = self.pool
+        connection.pool_key = key
+        connection.resolver = self.resolver
+        return connection
+
+    def new_connection(self, url):
         """ Factory method for connections """
         connection = self.ConnectionClass(url.netloc)
         return connection
 
     def clearForwardingRegistry(self):
         if self.fmgr is not None:
-            self.fmgr.clear()
+            # Forward to the test url set now, not the one it was made for
+            self.fmgr.clear(windmill.settings['FORWARDING_TEST_URL'])
+
+    def forward_manager(self):
+        """The ForwardManager of the test run, None until there is one"""
+        if self.fmgr is None and windmill.settings['FORWARDING_TEST_URL'] is not None:
+            # Be lazy at creating the forward manager to give
+            # FORWARDING_TEST_URL a chance to be set
+            self.fmgr = ForwardManager(windmill.settings['FORWARDING_TEST_URL'])
+        return self.fmgr
+
+    def changed(self, *change):
+        """Share a change to the forwarding state with the other processes"""
+        if self.shared_state is not None:
+            self.shared_state.publish(change)
+
+    def apply_change(self, kind, args):
+        """Make a change to the forwarding state made in another process"""
+        fmgr = self.forward_manager()
+        if fmgr is None:
+            return
+        if kind == 'forward':
+            fmgr.forward(urlparse(args[0]), {})
+        elif kind == 'learn':
+            fmgr.learn_host(urlparse(args[0]), urlparse(args[1]))
+        elif kind == 'forget':
+            fmgr.forget_host(urlparse(args[0]))
 
     def __call__(self, environ, start_response):
         return self.handler(environ, start_response)
@@ -340,3 +811,15 @@ proxyInstances = []
 def clearForwardingRegistry():
     for p in proxyInstances:
         p.clearForwardingRegistry()
+
+def apply_forwarding_change(change):
+    """Make a change to the forwarding state, as passed to
+    WindmillProxyApplication.changed in another process"""
+    kind, args = change[0], change[1:]
+    if kind == 'form':
+        forward_forms[args[0]] = args[1]
+    elif kind == 'form_used':
+        forward_forms.pop(args[0], None)
+    else:
+        for p in proxyInstances:
+            p.apply_change(kind, args)
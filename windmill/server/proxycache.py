@@ -0,0 +1,434 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    On disk cache of the responses windmill proxies.
+
+    The proxy tells the browser not to cache anything, so every page load
+    in a test fetches every script, stylesheet and image again. ProxyCache
+    keeps cacheable GET responses in a directory that outlives the run,
+    serves them while they are fresh and revalidates them with their ETag
+    or Last-Modified once they aren't, so an unchanged asset costs a 304
+    instead of its body.
+"""
+
+import os
+import time
+import tempfile
+import threading
+import logging
+from email.Utils import parsedate_tz, mktime_tz
+try:
+    from hashlib import sha1
+except ImportError:
+    # python 2.4
+    from sha import new as sha1
+
+try:
+    import json as simplejson
+except ImportError:
+    import simplejson
+
+logger = logging.getLogger(__name__)
+
+# Requests the cache stays out of, they ask the server for something else
+# than the full stored response
+bypass_headers = ['HTTP_AUTHORIZATION', 'HTTP_RANGE', 'HTTP_IF_NONE_MATCH',
+                  'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_MATCH',
+                  'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_IF_RANGE']
+
+# Headers of a 304 that must not replace the stored ones
+body_headers = ['content-length', 'content-encoding', 'content-range']
+
+def to_json(value):
+    """value as JSON, byte strings decoded as latin-1 so any bytes fit"""
+    return simplejson.dumps(value, encoding='latin-1')
+
+def from_json(data):
+    """The value to_json() saved, strings back to byte strings"""
+    return native(simplejson.loads(data))
+
+def native(value):
+    # The JSON module hands strings back as unicode, which the handler
+    # can't join with a binary body
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [native(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(native(k), native(v)) for k, v in value.items()])
+    return value
+
+def header(headers, name):
+    """Value of the first header called name in a list of pairs, or None"""
+    for key, value in headers:
+        if key.lower() == name:
+            return value.strip()
+    return None
+
+def cache_control(value):
+    """Cache-Control directives as a dict, None for ones without a value"""
+    directives = {}
+    for directive in (value or '').split(','):
+        parts = directive.split('=', 1)
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        if len(parts) == 2:
+            directives[name] = parts[1].strip().strip('"')
+        else:
+            directives[name] = None
+    return directives
+
+def parse_date(value):
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (ValueError, OverflowError):
+        return None
+
+def fresh_until(headers, now):
+    """Time until which a response can be served without asking the server.
+
+    Only explicit lifetimes count, a response without one is revalidated
+    every time: the AUT's assets change while its tests are written.
+    """
+    directives = cache_control(header(headers, 'cache-control'))
+    if 'no-cache' in directives or \
+            'no-cache' in (header(headers, 'pragma') or '').lower():
+        return now
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return now + max(int(directives[name]), 0)
+            except (TypeError, ValueError):
+                return now
+    expires = header(headers, 'expires')
+    if expires is not None:
+        expires = parse_date(expires)
+        if expires is None:
+            return now
+        # Relative to the server's clock, not ours
+        date = parse_date(header(headers, 'date'))
+        if date is None:
+            date = now
+        return now + max(expires - date, 0)
+    return now
+
+def vary_key(url, vary):
+    pairs = vary.items()
+    pairs.sort()
+    return sha1(repr((url, pairs))).hexdigest()
+
+class ProxyCache(object):
+    """Cacheable GET responses in directory, by URL and Vary headers.
+
+    Each URL has a .meta file listing its stored variants and each variant
+    a .body file. The metadata is loaded from disk the first time a URL is
+    looked up, so a cache left by an earlier run is used without scanning
+    it. Responses larger than max_entry_size bytes aren't stored.
+    """
+
+    def __init__(self, directory, max_entry_size=10 * 1024 * 1024):
+        self.directory = directory
+        self.max_entry_size = max_entry_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        # url -> [variant], a variant being the dict kept in the .meta file
+        self.index = {}
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0,
+                         'stored': 0, 'bypassed': 0, 'bytes_served': 0}
+
+    def count(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] += value
+        finally:
+            self.lock.release()
+
+    def usable(self, environ):
+        """True if the cache may answer this request"""
+        if environ['REQUEST_METHOD'] != 'GET':
+            return False
+        for key in bypass_headers:
+            if environ.get(key):
+                return False
+        return True
+
+    def path(self, name, extension):
+        return os.path.join(self.directory, name + extension)
+
+    def variants(self, url):
+        # Called with self.lock held
+        if url not in self.index:
+            variants = []
+            try:
+                f = open(self.path(sha1(url).hexdigest(), '.meta'), 'rb')
+                try:
+                    meta = from_json(f.read())
+                finally:
+                    f.close()
+                if meta['url'] == url:
+                    variants = meta['variants']
+            except (IOError, ValueError, KeyError, TypeError,
+                    UnicodeError):
+                pass
+            self.index[url] = variants
+        return self.index[url]
+
+    def save_variants(self, url):
+        # Called with self.lock held
+        meta = to_json({'url': url, 'variants': self.index[url]})
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(meta)
+        finally:
+            f.close()
+        replace(temp, self.path(sha1(url).hexdigest(), '.meta'))
+
+    def lookup(self, url, environ):
+        """The stored variant of url matching the request, or None"""
+        self.lock.acquire()
+        try:
+            for variant in self.variants(url):
+                for name, value in variant['vary'].items():
+                    if environ.get('HTTP_' + name.upper().replace('-', '_')) != value:
+                        break
+                else:
+                    return variant
+        finally:
+            self.lock.release()
+        return None
+
+    def is_fresh(self, variant):
+        return time.time() < variant['fresh_until']
+
+    def validators(self, variant):
+        """environ keys asking the server if variant is still current"""
+        validators = {}
+        if variant['etag'] is not None:
+            validators['HTTP_IF_NONE_MATCH'] = variant['etag']
+        if variant['last_modified'] is not None:
+            validators['HTTP_IF_MODIFIED_SINCE'] = variant['last_modified']
+        return validators
+
+    def open(self, variant):
+        """The stored body of variant as an open file, None if it's gone"""
+        try:
+            return open(self.path(variant['id'], '.body'), 'rb')
+        except IOError:
+            return None
+
+    def headers(self, variant, body):
+        """Headers to send with variant's body, opened with open()"""
+        length = os.fstat(body.fileno()).st_size
+        self.count('bytes_served', length)
+        headers = [(k, v) for k, v in variant['headers']
+                   if k.lower() != 'content-length']
+        headers.append(('content-length', str(length)))
+        return headers
+
+    def refresh(self, url, variant, headers):
+        """Update variant with the headers of a 304 revalidating it"""
+        self.lock.acquire()
+        try:
+            stored = [(k, v) for k, v in variant['headers']]
+            for name, value in headers:
+                if name.lower() in body_headers:
+                    continue
+                stored = [(k, v) for k, v in stored if k.lower() != name.lower()]
+            stored.extend([(k, v) for k, v in headers
+                           if k.lower() not in body_headers])
+            variant['headers'] = stored
+            describe(variant, stored)
+            try:
+                self.save_variants(url)
+            except (IOError, OSError, ValueError), e:
+                logger.warning('Could not update the proxy cache: %s', e)
+        finally:
+            self.lock.release()
+
+    def storable(self, environ, status, headers):
+        """True if a response with this status and headers may be stored"""
+        if status != 200 or not self.usable(environ):
+            return False
+        directives = cache_control(header(headers, 'cache-control'))
+        if 'no-store' in directives or 'private' in directives:
+            return False
+        if header(headers, 'set-cookie') is not None or \
+                header(headers, 'vary') == '*' or \
+                header(headers, 'content-range') is not None:
+            return False
+        length = header(headers, 'content-length')
+        if length is not None:
+            try:
+                if int(length) > self.max_entry_size:
+                    return False
+            except ValueError:
+                return False
+        # Worth keeping only if it can be served or revalidated later
+        return header(headers, 'etag') is not None or \
+               header(headers, 'last-modified') is not None or \
+               fresh_until(headers, time.time()) > time.time()
+
+    def store(self, url, environ, status_line, headers, body):
+        """Relay body, stored for url once it has been read to the end"""
+        vary = {}
+        for name in (header(headers, 'vary') or '').split(','):
+            name = name.strip().lower()
+            if name:
+                vary[name] = environ.get('HTTP_' + name.upper().replace('-', '_'))
+        variant = {'id': vary_key(url, vary), 'vary': vary,
+                   'status': status_line, 'headers': headers}
+        describe(variant, headers)
+        return CachingResponse(self, url, variant, body)
+
+    def add(self, url, variant, temp):
+        """Move the stored body temp in place and list variant for url"""
+        self.lock.acquire()
+        try:
+            replace(temp, self.path(variant['id'], '.body'))
+            variants = [v for v in self.variants(url) if v['id'] != variant['id']]
+            variants.append(variant)
+            self.index[url] = variants
+            self.save_variants(url)
+            self.counters['stored'] += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Remove everything stored"""
+        self.lock.acquire()
+        try:
+            self.index = {}
+            for name in os.listdir(self.directory):
+                if os.path.splitext(name)[1] in ('.meta', '.body', '.tmp'):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return hit, revalidation and miss counters and the hit ratio"""
+        self.lock.acquire()
+        try:
+            stats = self.counters.copy()
+            stats['urls'] = len([v for v in self.index.values() if v])
+        finally:
+            self.lock.release()
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        if lookups:
+            stats['hit_ratio'] = float(stats['hits'] + stats['revalidated']) / lookups
+        else:
+            stats['hit_ratio'] = 0.0
+        return stats
+
+def describe(variant, headers):
+    """Set the freshness and validators of variant from its headers"""
+    now = time.time()
+    variant['stored'] = now
+    variant['fresh_until'] = fresh_until(headers, now)
+    variant['etag'] = header(headers, 'etag')
+    variant['last_modified'] = header(headers, 'last-modified')
+
+def replace(source, destination):
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(destination)
+        os.rename(source, destination)
+
+class CachingResponse(object):
+    """Relay a response body, keeping a copy for store.
+
+    The copy is handed to store.add(key, entry, path of the copy) when the
+    body has been read to the end, and thrown away if it gets larger than
+    store.max_entry_size or the relay stops short. The proxy's archive
+    keeps its recordings with it too.
+    """
+
+    def __init__(self, store, key, entry, body):
+        self.store = store
+        self.key = key
+        self.entry = entry
+        self.body = body
+        fd, self.temp = tempfile.mkstemp(dir=store.directory, suffix='.tmp')
+        self.spool = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def __iter__(self):
+        for data in self.body:
+            if self.spool is not None:
+                self.size += len(data)
+                if self.store.max_entry_size is not None and \
+                        self.size > self.store.max_entry_size:
+                    self.discard()
+                else:
+                    self.spool.write(data)
+            yield data
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+            try:
+                self.store.add(self.key, self.entry, self.temp)
+            except (IOError, OSError, ValueError), e:
+                logger.warning('Could not store %s: %s', self.key, e)
+                self.remove_temp()
+
+    def data_ready(self):
+        if hasattr(self.body, 'data_ready'):
+            return self.body.data_ready()
+        return True
+
+    def discard(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+            self.remove_temp()
+
+    def remove_temp(self):
+        try:
+            os.remove(self.temp)
+        except OSError:
+            pass
+
+    def close(self):
+        self.discard()
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+    def __del__(self):
+        self.discard()
+
+shared_caches = {}
+shared_lock = threading.Lock()
+
+def shared_cache(directory, max_entry_size=10 * 1024 * 1024):
+    """The ProxyCache for directory, one per directory so proxies using
+    the same one keep a single index"""
+    directory = os.path.abspath(directory)
+    shared_lock.acquire()
+    try:
+        if directory not in shared_caches:
+            shared_caches[directory] = ProxyCache(directory, max_entry_size)
+        return shared_caches[directory]
+    finally:
+        shared_lock.release()
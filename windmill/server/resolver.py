@@ -0,0 +1,173 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Cache of the upstream host names the proxy resolves.
+
+    Every new upstream connection used to look its host up again, and the
+    lookup blocks the request's thread. Resolver keeps the addresses for
+    a while, and a host nobody has looked up yet is resolved by one thread
+    while the others asking for it wait, without holding up lookups of
+    other hosts.
+"""
+
+import time
+import socket
+import threading
+
+# Timeout meaning "use the socket module's default", as httplib passes it
+default_timeout = getattr(socket, '_GLOBAL_DEFAULT_TIMEOUT', None)
+
+def is_address(host):
+    """True if host is an IP address, which needs no lookup"""
+    if ':' in host:
+        return True
+    try:
+        socket.inet_aton(host)
+    except (socket.error, UnicodeError):
+        return False
+    return host.replace('.', '').isdigit()
+
+class Resolver(object):
+    """getaddrinfo results by (host, port), kept for ttl seconds.
+
+    Failed lookups are kept for failure_ttl seconds so a host that doesn't
+    resolve doesn't cost a lookup per request either. A ttl of 0 turns
+    the cache off.
+    """
+
+    # Purge expired entries once there are more than this many
+    max_entries = 1000
+
+    def __init__(self, ttl=60, failure_ttl=5):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.lookup = socket.getaddrinfo
+        self.lock = threading.Lock()
+        # key -> (expires at, addresses or the lookup's exception)
+        self.entries = {}
+        # key -> Event set when the lookup in progress is done
+        self.pending = {}
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'failures': 0,
+                         'invalidated': 0}
+
+    def getaddrinfo(self, host, port):
+        """socket.getaddrinfo for a TCP connection to host and port"""
+        if not self.ttl or is_address(host):
+            return self.lookup(host, port, 0, socket.SOCK_STREAM)
+        key = (host, port)
+        waited = False
+        while True:
+            self.lock.acquire()
+            try:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > time.time():
+                    if not waited:
+                        self.counters['hits'] += 1
+                    result = entry[1]
+                    break
+                done = self.pending.get(key)
+                if done is None:
+                    if not waited:
+                        self.counters['misses'] += 1
+                    done = self.pending[key] = threading.Event()
+                    resolving = True
+                else:
+                    if not waited:
+                        self.counters['waits'] += 1
+                    resolving = False
+            finally:
+                self.lock.release()
+            if not resolving:
+                # Another thread is looking it up
+                done.wait()
+                waited = True
+                continue
+            result = None
+            try:
+                try:
+                    result = self.lookup(host, port, 0, socket.SOCK_STREAM)
+                    expires = time.time() + self.ttl
+                except socket.gaierror, e:
+                    result = e
+                    expires = time.time() + self.failure_ttl
+            finally:
+                self.lock.acquire()
+                try:
+                    if result is not None:
+                        if isinstance(result, Exception):
+                            self.counters['failures'] += 1
+                        if len(self.entries) >= self.max_entries:
+                            self.purge()
+                        self.entries[key] = (expires, result)
+                    del self.pending[key]
+                finally:
+                    self.lock.release()
+                done.set()
+            break
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def purge(self):
+        # Called with self.lock held
+        now = time.time()
+        for key, entry in self.entries.items():
+            if entry[0] <= now:
+                del self.entries[key]
+
+    def invalidate(self, host, port):
+        """Forget the addresses of host, it may have moved"""
+        self.lock.acquire()
+        try:
+            if self.entries.pop((host, port), None) is not None:
+                self.counters['invalidated'] += 1
+        finally:
+            self.lock.release()
+
+    def create_connection(self, address, timeout=default_timeout):
+        """socket.create_connection with the cached addresses. If none of
+        them can be connected to, the next lookup asks the resolver again.
+        """
+        host, port = address
+        error = None
+        for family, socktype, proto, name, sockaddr in self.getaddrinfo(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not default_timeout:
+                    sock.settimeout(timeout)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error, e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        self.invalidate(host, port)
+        if error is not None:
+            raise error
+        raise socket.error('getaddrinfo returned an empty list')
+
+    def stats(self):
+        """Return hit, miss and failure counters and the hit ratio"""
+        self.lock.acquire()
+        try:
+            stats = self.counters.copy()
+            stats['entries'] = len(self.entries)
+        finally:
+            self.lock.release()
+        lookups = stats['hits'] + stats['misses'] + stats['waits']
+        if lookups:
+            stats['hit_ratio'] = float(stats['hits'] + stats['waits']) / lookups
+        else:
+            stats['hit_ratio'] = 0.0
+        return stats
@@ -0,0 +1,136 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Namespace routing for the windmill server.
+
+    A request belongs to a namespace when '/<namespace>/' appears anywhere
+    in its path, so /windmill-serv/ is served on every proxied domain.
+    Namespaces are kept in a trie of path segments and a path is matched by
+    walking its segments once instead of searching it for every namespace.
+"""
+
+import threading
+
+class NamespaceRouter(object):
+    """Mapping of namespace name to WSGI application with fast matching.
+
+    Behaves like the dict it replaces, so namespaces can still be added
+    and removed with item assignment while the server is running.
+    """
+
+    def __init__(self, apps=()):
+        self.apps = {}
+        self.hits = {}
+        self.unmatched = 0
+        self.lock = threading.Lock()
+        self.trie = {}
+        for app in apps:
+            self.apps[app.ns] = app
+        self.compile()
+
+    def compile(self):
+        """Rebuild the trie from apps. Readers keep using the old trie
+        until the new one is swapped in."""
+        trie = {}
+        for name in self.apps:
+            node = trie
+            for segment in name.strip('/').split('/'):
+                node = node.setdefault(segment, [{}, None])
+                last = node
+                node = node[0]
+            last[1] = name
+        self.trie = trie
+
+    def __setitem__(self, name, application):
+        self.lock.acquire()
+        try:
+            self.apps[name] = application
+            self.compile()
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, name):
+        self.lock.acquire()
+        try:
+            del self.apps[name]
+            self.hits.pop(name, None)
+            self.compile()
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, name):
+        return self.apps[name]
+
+    def __contains__(self, name):
+        return name in self.apps
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.apps.keys())
+
+    def __len__(self):
+        return len(self.apps)
+
+    def keys(self):
+        return self.apps.keys()
+
+    def items(self):
+        return self.apps.items()
+
+    def get(self, name, default=None):
+        return self.apps.get(name, default)
+
+    def match(self, path):
+        """Return the (name, application) path belongs to, or (None, None).
+
+        The query string must already be removed from path.
+        """
+        trie = self.trie
+        segments = path.split('/')
+        # The namespace has to be preceded and followed by a slash, so
+        # the first and last segments can't start or end one
+        end = len(segments) - 1
+        name = None
+        for start in xrange(1, end):
+            node = trie.get(segments[start])
+            position = start
+            while node is not None:
+                if node[1] is not None:
+                    name = node[1]
+                    break
+                position += 1
+                if position >= end:
+                    break
+                node = node[0].get(segments[position])
+            if name is not None:
+                break
+
+        self.lock.acquire()
+        try:
+            application = self.apps.get(name)
+            if application is None:
+                self.unmatched += 1
+                return None, None
+            self.hits[name] = self.hits.get(name, 0) + 1
+        finally:
+            self.lock.release()
+        return name, application
+
+    def stats(self):
+        """Return requests matched per namespace and unmatched requests"""
+        self.lock.acquire()
+        try:
+            return {'hits': self.hits.copy(), 'unmatched': self.unmatched}
+        finally:
+            self.lock.release()
@@ -0,0 +1,214 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Bounded pool of worker threads fed from a backlog queue.
+
+The pool starts with a few workers and grows on demand up to max_workers.
+Workers that sit idle for longer than idle_timeout exit and are reaped, so the
+number of live threads follows the load instead of growing forever.
+"""
+
+import Queue
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class WorkerPool(object):
+    """Run callables on a bounded set of reusable threads"""
+
+    def __init__(self, max_workers=64, min_workers=4, backlog=256,
+                 idle_timeout=30, name='windmill-worker'):
+        self.max_workers = max(1, max_workers)
+        self.min_workers = min(min_workers, self.max_workers)
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.queue = Queue.Queue(backlog)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.idle = 0
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.spawned = 0
+        self.reaped = 0
+        self.peak_workers = 0
+        self.peak_queue = 0
+        for i in range(self.min_workers):
+            self._spawn()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args) for a worker.
+
+        Blocks while the backlog is full unless block=False is given, in
+        which case False is returned and the job is dropped.
+        """
+        block = kwargs.pop('block', True)
+        timeout = kwargs.pop('timeout', None)
+        if not self.running:
+            return False
+        try:
+            self.queue.put((func, args), block, timeout)
+        except Queue.Full:
+            self.lock.acquire()
+            self.rejected += 1
+            self.lock.release()
+            return False
+        self.lock.acquire()
+        try:
+            self.submitted += 1
+            depth = self.queue.qsize()
+            if depth > self.peak_queue:
+                self.peak_queue = depth
+            self.reap()
+            if self.idle < depth and len(self.workers) < self.max_workers:
+                self._spawn()
+        finally:
+            self.lock.release()
+        return True
+
+    def _spawn(self):
+        # Called with self.lock held (or from __init__)
+        t = threading.Thread(target=self._work,
+                           name='%s-%d' % (self.name, self.spawned))
+        t.setDaemon(True)
+        self.workers.append(t)
+        self.spawned += 1
+        if len(self.workers) > self.peak_workers:
+            self.peak_workers = len(self.workers)
+        t.start()
+
+    def _work(self):
+        me = threading.currentThread()
+        while True:
+            self.lock.acquire()
+            if not self.running and self.queue.empty():
+                # Stopped while this worker was busy, its stop marker
+                # may not have fit in the backlog
+                self._retire(me)
+                self.lock.release()
+                return
+            self.idle += 1
+            self.lock.release()
+            try:
+                job = self.queue.get(True, self.idle_timeout)
+            except Queue.Empty:
+                self.lock.acquire()
+                self.idle -= 1
+                if self.running and len(self.workers) <= self.min_workers:
+                    self.lock.release()
+                    continue
+                self._retire(me)
+                self.lock.release()
+                return
+
+            self.lock.acquire()
+            self.idle -= 1
+            if job is None:
+                self._retire(me)
+                self.lock.release()
+                return
+            self.busy += 1
+            if self.running and self.idle < self.queue.qsize() and \
+                    len(self.workers) < self.max_workers:
+                # submit() may have counted this worker as idle just
+                # before it took the job
+                self._spawn()
+            self.lock.release()
+
+            func, args = job
+            try:
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception('Unhandled exception in worker thread')
+            finally:
+                self.lock.acquire()
+                self.busy -= 1
+                self.completed += 1
+                self.lock.release()
+
+    def _retire(self, worker):
+        # Called with self.lock held
+        if worker in self.workers:
+            self.workers.remove(worker)
+            self.reaped += 1
+
+    def reap(self):
+        """Drop finished threads from the worker list"""
+        alive = [t for t in self.workers if t.isAlive()]
+        self.reaped += len(self.workers) - len(alive)
+        self.workers = alive
+
+    def saturated(self):
+        """True if queued jobs are waiting for a worker: no idle worker
+        will take them and no new one can be spawned"""
+        self.lock.acquire()
+        try:
+            return self.queue.qsize() > self.idle and \
+                   len(self.workers) >= self.max_workers
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return a dictionary of pool size and queue depth counters"""
+        self.lock.acquire()
+        try:
+            self.reap()
+            return {'workers': len(self.workers), 'idle': self.idle,
+                    'busy': self.busy, 'max_workers': self.max_workers,
+                    'min_workers': self.min_workers,
+                    'queue_depth': self.queue.qsize(),
+                    'queue_limit': self.queue.maxsize,
+                    'submitted': self.submitted, 'completed': self.completed,
+                    'rejected': self.rejected, 'spawned': self.spawned,
+                    'reaped': self.reaped, 'peak_workers': self.peak_workers,
+                    'peak_queue_depth': self.peak_queue}
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Stop accepting jobs and tell idle workers to exit"""
+        self.running = False
+        self.lock.acquire()
+        count = len(self.workers)
+        self.lock.release()
+        for i in range(count):
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break
+
+    def join(self, timeout=None):
+        """Wait up to timeout seconds for the workers to exit after stop().
+
+        Returns the number of workers still running.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.lock.acquire()
+        workers = list(self.workers)
+        self.lock.release()
+        for t in workers:
+            if timeout is None:
+                t.join()
+            else:
+                t.join(max(deadline - time.time(), 0))
+        self.lock.acquire()
+        try:
+            self.reap()
+            return len(self.workers)
+        finally:
+            self.lock.release()
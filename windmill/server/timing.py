@@ -0,0 +1,184 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Request lifecycle timing.
+
+    The request handler takes a timestamp as each phase of a request ends,
+    the proxy does the same for its upstream requests. LatencyStats sums
+    them up in to a histogram per phase for each namespace and each
+    upstream host.
+
+    Server side phases are queue (from handing a connection to the worker
+    pool until its first request is read), parse (request line and
+    headers), dispatch (namespace lookup, environ and the proxy admission
+    queue), app (the application call, for proxied requests this includes
+    the upstream request), send (writing the response) and total.
+    Upstream hosts get connect, request (sending the request), first_byte
+    (waiting for the response head), relay (sending the body on to the
+    browser) and total.
+"""
+
+import os
+import time
+import threading
+
+try:
+    import json as simplejson
+except ImportError:
+    import simplejson
+
+def _monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (ImportError, AttributeError, OSError, TypeError):
+        # No clock_gettime here, the wall clock will have to do
+        return time.time
+
+# Seconds from an arbitrary starting point, not affected by clock changes
+now = _monotonic_clock()
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket
+# takes everything slower
+bucket_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram(object):
+    """Counts of durations in buckets of bucket_bounds milliseconds"""
+
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        i = 0
+        for bound in bucket_bounds:
+            if ms <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                if i < len(bucket_bounds):
+                    return float(min(bucket_bounds[i], self.max))
+                break
+        return self.max
+
+    def summary(self):
+        buckets = {}
+        for i, count in enumerate(self.counts):
+            if count:
+                if i < len(bucket_bounds):
+                    buckets['<=%d' % bucket_bounds[i]] = count
+                else:
+                    buckets['>%d' % bucket_bounds[-1]] = count
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = 0.0
+        return {'count': self.count, 'mean_ms': mean, 'max_ms': self.max,
+                'p50_ms': self.percentile(.5), 'p90_ms': self.percentile(.9),
+                'p99_ms': self.percentile(.99), 'buckets': buckets}
+
+class LatencyStats(object):
+    """Histograms of phase durations for namespaces and upstream hosts"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {'namespaces': {}, 'upstreams': {}}
+
+    def record(self, group, key, phases):
+        """Add the durations in the phases dict, phase name to seconds, to
+        the histograms of key in group ('namespaces' or 'upstreams')"""
+        self.lock.acquire()
+        try:
+            histograms = self.groups[group].setdefault(key, {})
+            for phase, seconds in phases.items():
+                if phase not in histograms:
+                    histograms[phase] = Histogram()
+                histograms[phase].add(seconds)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return {group: {key: {phase: summary}}}"""
+        self.lock.acquire()
+        try:
+            result = {}
+            for group, keys in self.groups.items():
+                result[group] = {}
+                for key, histograms in keys.items():
+                    result[group][key] = dict([(phase, histogram.summary())
+                                       for phase, histogram in histograms.items()])
+            return result
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.groups = {'namespaces': {}, 'upstreams': {}}
+        finally:
+            self.lock.release()
+
+class StatsApplication(object):
+    """Serve the server's counters and latency histograms as JSON. Those
+    of its worker processes, if it has any, are under 'processes' by pid."""
+
+    def __init__(self, httpd):
+        self.httpd = httpd
+
+    def __call__(self, environ, start_response):
+        reset = environ['REQUEST_METHOD'] == 'POST' and \
+                environ['PATH_INFO'].rstrip('/').endswith('/reset')
+        if reset:
+            self.httpd.latency.reset()
+        stats = self.httpd.server_stats()
+        workers = getattr(self.httpd, 'workers', None)
+        if workers is not None:
+            stats['processes'] = workers.stats(reset)
+        body = simplejson.dumps(stats)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
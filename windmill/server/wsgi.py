@@ -35,6 +35,11 @@ logger = logging.getLogger(__name__)
 
 import windmill
 from windmill.server import proxy
+from windmill.server.router import NamespaceRouter
+from windmill.server.fileserver import FileServerApplication, shared_cache
+from windmill.server.compression import GzipApplication, accepts_gzip, gzip_string
+from windmill.server import timing
+from windmill.tools import server_tools
 import wsgi_jsonrpc
 import wsgi_xmlrpc
 import wsgi_fileserver
@@ -73,14 +78,14 @@ def reconstruct_url(environ):
 HTTPConnection = httplib.HTTPConnection            
             
 WindmillProxyApplication = proxy.WindmillProxyApplication
-WindmillProxyApplication.ConnectionClass = HTTPConnection            
+WindmillProxyApplication.ConnectionClass = proxy.UpstreamConnection
 
 add_namespace = None
 
 class WindmillChooserApplication(object):
     """Application to handle choosing the proper application to handle each request"""
     def __init__(self, apps, proxy):
-        self.namespaces = dict([ (arg.ns, arg) for arg in apps ])
+        self.namespaces = NamespaceRouter(apps)
         self.proxy = proxy
         
     def add_namespace(self, name, application):
@@ -89,15 +94,15 @@ class WindmillChooserApplication(object):
 
     def handler(self, environ, start_response):
         """Windmill app chooser"""
-        sleep(.2)
-        reconstruct_url(environ)
+        if 'reconstructed_url' not in environ:
+            reconstruct_url(environ)
 
-        for key in self.namespaces:
-            if environ['PATH_INFO'].find('/'+key+'/') is not -1:
-                logger.debug('dispatching request %s to %s' % (environ['reconstructed_url'], key))
-                return self.namespaces[key](environ, start_response)
+        key, application = self.namespaces.match(environ['PATH_INFO'])
+        if application is not None:
+            logger.debug('dispatching request %s to %s', environ['reconstructed_url'], key)
+            return application(environ, start_response)
 
-        logger.debug('dispatching request %s to WindmillProxyApplication' % reconstruct_url(environ))
+        logger.debug('dispatching request %s to WindmillProxyApplication', environ['reconstructed_url'])
         response = self.proxy(environ, start_response)
         return response
             
@@ -142,6 +147,7 @@ class WindmillCompressor(object):
         self.enabled = enabled
         self.js_path = js_path
         self.compressed_windmill = None
+        self.gzipped_windmill = None
         if enabled:
             self._thread = threading.Thread(target=self.compress_file)
             self._thread.start()
@@ -150,6 +156,7 @@ class WindmillCompressor(object):
         compressed_windmill = ''
         for filename in self.js_file_list:
             compressed_windmill += jsmin.jsmin(open(os.path.join(self.js_path, *filename), 'r').read())
+        self.gzipped_windmill = gzip_string(compressed_windmill)
         self.compressed_windmill = compressed_windmill
         
     def __call__(self, environ, start_response):
@@ -163,19 +170,31 @@ class WindmillCompressor(object):
         
         while not self.compressed_windmill:
             sleep(.15)
-            
+
+        if accepts_gzip(environ):
+            start_response('200 Ok', [('Content-Type', 'application/x-javascript',),
+                                      ('Content-Encoding', 'gzip',),
+                                      ('Vary', 'Accept-Encoding',),
+                                      ('Content-Length', str(len(self.gzipped_windmill)),)])
+            return [self.gzipped_windmill]
         start_response('200 Ok', [('Content-Type', 'application/x-javascript',), 
+                                  ('Vary', 'Accept-Encoding',),
                                   ('Content-Length', str(len(self.compressed_windmill)),)])
         return [self.compressed_windmill]
         
         
-def make_windmill_server(http_port=None, js_path=None, compression_enabled=None):
+def make_windmill_server(http_port=None, js_path=None, compression_enabled=None,
+                         engine=None, processes=None):
     if http_port is None:
         http_port = windmill.settings['SERVER_HTTP_PORT']
+    if engine is None:
+        engine = windmill.settings['SERVER_ENGINE']
     if js_path is None:
         js_path = windmill.settings['JS_PATH']
     if compression_enabled is None:
         compression_enabled = not windmill.settings['DISABLE_JS_COMPRESS']
+    if processes is None:
+        processes = windmill.settings['SERVER_PROCESSES']
         
     # Start up all the convergence objects    
     import convergence
@@ -186,15 +205,21 @@ def make_windmill_server(http_port=None, js_path=None, compression_enabled=None)
     jsonrpc_methods_instance = convergence.JSONRPCMethods(queue, test_resolution_suite, command_resolution_suite)
     
     # Start up all the wsgi applications
-    windmill_serv_app = wsgi_fileserver.WSGIFileServerApplication(root_path=js_path, mount_point='/windmill-serv/')
+    windmill_serv_app = FileServerApplication(root_path=js_path, mount_point='/windmill-serv/',
+                                              cache=shared_cache())
     windmill_proxy_app = WindmillProxyApplication()
     windmill_xmlrpc_app =  wsgi_xmlrpc.WSGIXMLRPCApplication(instance=xmlrpc_methods_instance)
     windmill_jsonrpc_app = wsgi_jsonrpc.WSGIJSONRPCApplication(instance=jsonrpc_methods_instance)
-    windmill_compressor_app = WindmillCompressor(os.path.join(js_path, 'js'), compression_enabled)
+    if windmill.settings['SERVER_GZIP']:
+        # Static files are compressed once, RPC responses when they are big
+        windmill_serv_app = GzipApplication(windmill_serv_app, min_size=0, cache_size=512)
+        windmill_xmlrpc_app = GzipApplication(windmill_xmlrpc_app,
+                                              min_size=windmill.settings['SERVER_GZIP_MIN_SIZE'])
+        windmill_jsonrpc_app = GzipApplication(windmill_jsonrpc_app,
+                                               min_size=windmill.settings['SERVER_GZIP_MIN_SIZE'])
     windmill_serv_app.ns = 'windmill-serv'
     windmill_xmlrpc_app.ns = 'windmill-xmlrpc'
     windmill_jsonrpc_app.ns = 'windmill-jsonrpc'
-    windmill_compressor_app.ns = 'windmill-compressor'
     global add_namespace
     import https
     if windmill.has_ssl:
@@ -202,12 +227,107 @@ def make_windmill_server(http_port=None, js_path=None, compression_enabled=None)
         cc = certificate.CertificateCreator()
     else:
         cc = None
-    httpd = https.WindmillHTTPServer(('0.0.0.0', http_port),
-                                     https.WindmillHTTPRequestHandler, cc,
-                                     apps=[windmill_serv_app, windmill_jsonrpc_app,
-                                     windmill_xmlrpc_app, windmill_compressor_app],
-                                     proxy=https.WindmillHTTPSProxyApplication())
+    if engine == 'evented':
+        import evented
+        server_class = evented.WindmillEventedHTTPServer
+        handler_class = evented.EventedRequestHandler
+    else:
+        server_class = https.WindmillHTTPServer
+        handler_class = https.WindmillHTTPRequestHandler
+    server_options = dict(max_workers=windmill.settings['SERVER_MAX_WORKERS'],
+                          min_workers=windmill.settings['SERVER_MIN_WORKERS'],
+                          worker_backlog=windmill.settings['SERVER_WORKER_BACKLOG'],
+                          worker_idle_timeout=windmill.settings['SERVER_WORKER_IDLE_TIMEOUT'],
+                          keepalive=windmill.settings['SERVER_KEEPALIVE'],
+                          keepalive_timeout=windmill.settings['SERVER_KEEPALIVE_TIMEOUT'],
+                          write_buffer_size=windmill.settings['SERVER_WRITE_BUFFER_SIZE'],
+                          shutdown_timeout=windmill.settings['SERVER_SHUTDOWN_TIMEOUT'],
+                          proxy_concurrency=windmill.settings['SERVER_PROXY_CONCURRENCY'],
+                          proxy_queue_size=windmill.settings['SERVER_PROXY_QUEUE_SIZE'],
+                          proxy_queue_timeout=windmill.settings['SERVER_PROXY_QUEUE_TIMEOUT'],
+                          proxy_retry_after=windmill.settings['SERVER_PROXY_RETRY_AFTER'],
+                          rpc_reserved_workers=windmill.settings['SERVER_RPC_RESERVED_WORKERS'],
+                          access_log_size=windmill.settings['SERVER_ACCESS_LOG_SIZE'])
+
+    # Worker processes are forked before this process starts any threads
+    workers = owner_socket = None
+    if processes > 1:
+        import processes as processes_module
+        if processes_module.can_fork_workers():
+            # Workers forward the namespaces this process owns over a
+            # loopback listener
+            owner_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            owner_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            owner_socket.bind(('127.0.0.1', 0))
+            owner_socket.listen(server_class.request_queue_size)
+            owner_address = owner_socket.getsockname()
+
+            def serve_worker(index, pipe, listener):
+                owner_socket.close()
+                if cc is not None:
+                    # Certificates from different processes must not
+                    # share serial numbers
+                    cc.serial_number = index * 1000000
+                parent = processes_module.ParentProcess(pipe, owner_address)
+                forwarders = [processes_module.ForwardingApplication(ns, parent)
+                              for ns in ('windmill-jsonrpc', 'windmill-xmlrpc',
+                                         'windmill-compressor')]
+                worker_httpd = server_class(('0.0.0.0', http_port), handler_class, cc,
+                                            apps=[windmill_serv_app] + forwarders,
+                                            proxy=https.WindmillHTTPSProxyApplication(),
+                                            reuse_port=True, **server_options)
+                # The parent collects this process's counters on listener
+                process_stats_app = timing.StatsApplication(worker_httpd)
+                process_stats_app.ns = 'windmill-process-stats'
+                worker_httpd.add_namespace(process_stats_app.ns, process_stats_app)
+                worker_httpd.add_listener(listener)
+                processes_module.run_worker(worker_httpd, parent)
+
+            workers = processes_module.WorkerProcesses(processes - 1)
+            workers.start(serve_worker)
+        else:
+            logger.warning('Multiple server processes need fork() and SO_REUSEPORT, '
+                           'serving from a single process')
+
+    windmill_compressor_app = WindmillCompressor(os.path.join(js_path, 'js'), compression_enabled)
+    windmill_compressor_app.ns = 'windmill-compressor'
+    try:
+        httpd = server_class(('0.0.0.0', http_port), handler_class, cc,
+                                         apps=[windmill_serv_app, windmill_jsonrpc_app,
+                                         windmill_xmlrpc_app, windmill_compressor_app],
+                                         proxy=https.WindmillHTTPSProxyApplication(),
+                                         reuse_port=workers is not None,
+                                         **server_options)
+    except:
+        if workers is not None:
+            workers.stop()
+            workers.join(0)
+        raise
+    if workers is not None:
+        httpd.workers = workers
+        httpd.add_listener(owner_socket)
+        # Changes to the forwarding state made here or in a worker reach
+        # every process
+        httpd.proxy.shared_state = workers
+        state_app = processes_module.ForwardingStateApplication(workers)
+        state_app.ns = 'windmill-process-state'
+        httpd.add_namespace(state_app.ns, state_app)
     add_namespace = httpd.add_namespace
+    # Worker processes forward this here, the counters of every worker
+    # process are collected with those of this one
+    stats_app = timing.StatsApplication(httpd)
+    stats_app.ns = 'windmill-stats'
+    httpd.add_namespace(stats_app.ns, stats_app)
+
+    # Local clients from windmill.tools skip TCP and go through this
+    rpc_socket = server_tools.rpc_socket_path()
+    if rpc_socket is not None:
+        try:
+            httpd.add_listener(https.bind_unix_socket(rpc_socket,
+                                                      httpd.request_queue_size))
+        except (socket.error, OSError), e:
+            logger.warning('Not listening on %s for RPC requests: %s' %
+                           (rpc_socket, e))
 
     # Attach some objects to httpd for convenience
     httpd.controller_queue = queue
@@ -215,6 +335,7 @@ def make_windmill_server(http_port=None, js_path=None, compression_enabled=None)
     httpd.command_resolution_suite = command_resolution_suite
     httpd.xmlrpc_methods_instance = xmlrpc_methods_instance
     httpd.jsonrpc_methods_instance = jsonrpc_methods_instance
+    xmlrpc_methods_instance._httpd = jsonrpc_methods_instance._httpd = httpd
     
     return httpd
 
@@ -29,6 +29,8 @@ else:
     from windmill.tools.urlparse_25 import urlparse
 import logging
 
+import server_tools
+
 __version__ = str(0.1)
 
 logger = logging.getLogger('tools.jsonrpc_client')
@@ -67,8 +69,10 @@ class _Method(object):
         
 class JSONRPCTransport:
 
-    def __init__(self, uri, proxy_uri=None):
+    def __init__(self, uri, proxy_uri=None, socket_path=None):
         
+        # Unix socket of a local windmill server, preferred when it's there
+        self.socket_path = socket_path
         if proxy_uri is not None:
             self.connection_url = urlparse(proxy_uri)
             self.request_path = uri
@@ -80,24 +84,32 @@ class JSONRPCTransport:
                'Content-Type':'application/json',
                'Accept':'application/json'}
             
-    def request(self, request_body):
-        
+    def make_connection(self):
         if self.connection_url.scheme == 'http':
             if self.connection_url == '':
                 port = 80
             else:
                 port = self.connection_url.port 
-            connection = httplib.HTTPConnection(self.connection_url.hostname+':'+str(port))
+            return httplib.HTTPConnection(self.connection_url.hostname+':'+str(port))
         elif self.connection_url.scheme == 'https':
             if self.connection_url == '':
                 port = 443
             else:
                 port = self.connection_url.port
-            connection = httplib.HTTPSConnection(self.connection_url.hostname+':'+str(port))
+            return httplib.HTTPSConnection(self.connection_url.hostname+':'+str(port))
         else:
             raise Exception, 'unsupported transport'
+
+    def request(self, request_body):
+        
+        connection = server_tools.connect_unix_socket(self.socket_path)
+        if connection is not None:
+            request_path = urlparse(self.request_path).path
+        else:
+            connection = self.make_connection()
+            request_path = self.request_path
             
-        connection.request('POST', self.request_path, body=request_body, headers=self.headers)
+        connection.request('POST', request_path, body=request_body, headers=self.headers)
         self.response = connection.getresponse()
         if self.response.status == 200:
             result = self.response.read(1)
@@ -14,7 +14,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import stat
 import time
+import socket
+import tempfile
 import httplib, urllib
 import xmlrpclib
 import sys
@@ -58,3 +62,82 @@ class ProxiedTransport(xmlrpclib.Transport):
     def send_host(self, connection, host):
         connection.putheader('Host', self.realhost)
 
+def rpc_socket_path():
+    """Path of the Unix socket the windmill server takes RPC requests on,
+    None if SERVER_RPC_SOCKET turns it off or there are no Unix sockets"""
+    import windmill
+    path = windmill.settings['SERVER_RPC_SOCKET']
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    if path is True:
+        # In a directory of this user's, where no one else can put a
+        # socket of theirs in its place
+        path = os.path.join(tempfile.gettempdir(), 'windmill-%d' % os.getuid(),
+                            '%s.sock' % windmill.settings['SERVER_HTTP_PORT'])
+    return path
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection to a server listening on the Unix socket at path"""
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+def connect_unix_socket(path):
+    """Return a connected UnixHTTPConnection to path, None if nothing
+    listens there or the socket isn't this user's"""
+    if path is None:
+        return None
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        # Another user's socket could pose as the server
+        return None
+    connection = UnixHTTPConnection(path)
+    try:
+        connection.connect()
+    except socket.error:
+        # Left behind by a server that didn't shut down
+        return None
+    return connection
+
+class LocalTransport(ProxiedTransport):
+    """XML-RPC transport using the server's Unix socket when it listens on
+    one, and its proxy port otherwise"""
+
+    def __init__(self, proxy, socket_path, user_agent='python.httplib'):
+        ProxiedTransport.__init__(self, proxy, user_agent)
+        self.socket_path = socket_path
+        self.local = False
+
+    def make_connection(self, host):
+        self.realhost = host
+        connection = connect_unix_socket(self.socket_path)
+        self.local = connection is not None
+        if connection is None:
+            connection = httplib.HTTPConnection(self.proxy)
+        if hasattr(xmlrpclib.Transport, 'single_request'):
+            # python 2.7 transports use HTTPConnection directly
+            return connection
+        wrapper = httplib.HTTP()
+        wrapper._setup(connection)
+        return wrapper
+
+    def send_request(self, connection, handler, request_body):
+        if self.local:
+            connection.putrequest('POST', handler)
+        else:
+            ProxiedTransport.send_request(self, connection, handler,
+                                          request_body)
+